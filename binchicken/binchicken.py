@@ -17,6 +17,9 @@ from snakemake.io import load_configfile
 from ruamel.yaml import YAML
 import copy
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from binchicken.workflow.scripts.merge_otu_tables import merge_otu_tables
+from binchicken.workflow.scripts.appraise_ipc import appraise_ipc_path, has_appraise_ipc
 
 FAST_AVIARY_MODE = "fast"
 COMPREHENSIVE_AVIARY_MODE = "comprehensive"
@@ -26,6 +29,8 @@ MEGAHIT_ASSEMBLY = "megahit"
 PRECLUSTER_NEVER_MODE = "never"
 PRECLUSTER_SIZE_DEP_MODE = "large"
 PRECLUSTER_ALWAYS_MODE = "always"
+SINGLEM_APPRAISE_ENGINE = "singlem"
+NATIVE_APPRAISE_ENGINE = "native"
 SUFFIX_RE = r"(_|\.)R?1$"
 
 def build_reads_list(forward, reverse):
@@ -95,6 +100,16 @@ def copy_input(input, output, suppress=False):
         os.remove(output)
         os.symlink(input, output)
 
+def copy_appraise_input(input, output):
+    copy_input(input, output)
+
+    # Carry over the Arrow IPC copy, never leaving one from a previous run beside a different table
+    ipc_output = appraise_ipc_path(output)
+    if os.path.lexists(ipc_output):
+        os.remove(ipc_output)
+    if has_appraise_ipc(input):
+        copy_input(appraise_ipc_path(input), ipc_output, suppress=True)
+
 def read_list(path):
     with open(path) as f:
         contents = [line.strip() for line in f]
@@ -130,6 +145,25 @@ def run_workflow(config, workflow, output_dir, cores=16, dryrun=False,
     logging.info(f"Executing: {cmd}")
     subprocess.check_call(cmd, shell=True)
 
+def deinterleave_download(input, output_forward, output_reverse, compression_level, threads):
+    logging.info(f"Deinterleaving single-file download: {input}")
+    cmd = (
+        "python {script} "
+        "--input {input} "
+        "--output-forward {output_f} "
+        "--output-reverse {output_r} "
+        "--compression-level {compression_level} "
+        "--threads {threads} "
+    ).format(
+        script = importlib.resources.files("binchicken.workflow.scripts").joinpath("deinterleave.py"),
+        input = input,
+        output_f = output_forward,
+        output_r = output_reverse,
+        compression_level = compression_level,
+        threads = threads,
+    )
+    return extern.run(cmd).strip().split("\t")
+
 def download_sra(args):
     config_items = {
         "sra": args.forward,
@@ -177,6 +211,7 @@ def download_sra(args):
         single_ended = {}
 
     if not single_ended and not args.dryrun and args.sra != "build":
+        single_file_downloads = []
         for f, r in zip(expected_forward, expected_reverse):
             if os.path.isfile(f) & os.path.isfile(r):
                 continue
@@ -188,40 +223,27 @@ def download_sra(args):
             if not os.path.isfile(u):
                 raise Exception(f"Missing downloads: {f} and {r}")
 
-            logging.info(f"Checking single-file download for interleaved: {u}")
-            cmd = (
-                "python {script} "
-                "--input {input} "
-                "--start-check-pairs {start_check_pairs} "
-                "--end-check-pairs {end_check_pairs} "
-            ).format(
-                script = importlib.resources.files("binchicken.workflow.scripts").joinpath("is_interleaved.py"),
-                input = u,
-                start_check_pairs = 5,
-                end_check_pairs = 5,
-            )
-            output = extern.run(cmd).strip().split("\t")
+            single_file_downloads.append((u, f, r))
+
+        if single_file_downloads:
+            compression_level = args.download_compression_level if args.download_compression_level is not None else args.intermediate_compression_level
+            workers = max(1, min(len(single_file_downloads), args.cores))
+            threads = max(1, args.cores // workers)
+            logging.info(f"Deinterleaving {len(single_file_downloads)} single-file downloads with {workers} workers")
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                outputs = executor.map(
+                    lambda download: deinterleave_download(*download, compression_level, threads),
+                    single_file_downloads,
+                    )
 
-            if output[0] != "True":
-                sra_name = os.path.basename(u).replace(SRA_SUFFIX, "")
-                single_ended[sra_name] = output[1]
-                logging.warning(f"Download {u} was not interleaved: {output[1]}")
-                continue
+                for (u, _, _), output in zip(single_file_downloads, outputs):
+                    if output[0] != "True":
+                        sra_name = os.path.basename(u).replace(SRA_SUFFIX, "")
+                        single_ended[sra_name] = output[1]
+                        logging.warning(f"Download {u} was not interleaved: {output[1]}")
+                        continue
 
-            logging.info(f"Download {u} was interleaved: {output[1]}")
-            logging.info(f"Deinterleaving {u}")
-            cmd = (
-                "gunzip -c {input} | "
-                "paste - - - - - - - - | "
-                "tee >(cut -f 1-4 | tr '\t' '\n' | pigz --best --processes {threads} > {output_f}) "
-                "| cut -f 5-8 | tr '\t' '\n' | pigz --best --processes {threads} > {output_r}"
-            ).format(
-                input = u,
-                output_f = f,
-                output_r = r,
-                threads = max(1, args.cores // 2),
-            )
-            extern.run(cmd)
+                    logging.info(f"Download {u} was interleaved: {output[1]}")
 
     if single_ended:
         with open(sra_dir + "single_ended.tsv", "w") as f:
@@ -305,11 +327,17 @@ def set_standard_args(args):
     args.sample_query_list = None
     args.sample_query_dir = None
     args.sample_read_size = None
+    args.read_size_cache = None
+    args.read_size_estimate = False
     args.genome_transcripts = None
     args.genome_transcripts_list = None
     args.genome_singlem = None
     args.taxa_of_interest = None
     args.appraise_sequence_identity = 1
+    args.appraise_extra_sequence_identities = []
+    args.appraise_batch_size = None
+    args.appraise_engine = SINGLEM_APPRAISE_ENGINE
+    args.query_processing_scan = False
     args.min_sequence_coverage = 1
     args.single_assembly = False
     args.no_genomes = False
@@ -325,6 +353,7 @@ def set_standard_args(args):
     args.abundance_weighted_samples = []
     args.kmer_precluster = PRECLUSTER_NEVER_MODE
     args.precluster_distances = None
+    args.precluster_sketch_cache = None
     args.precluster_size = 100
     args.prodigal_meta = False
 
@@ -493,6 +522,13 @@ def coassemble(args):
     else:
         raise ValueError(f"Invalid kmer precluster mode: {args.kmer_precluster}")
 
+    # Query processing, no genomes, update appraise and the native engine replace sharded appraise
+    prior_appraise = getattr(args, "coassemble_unbinned", None) and getattr(args, "coassemble_binned", None)
+    if args.sample_query or args.sample_query_dir or args.no_genomes or prior_appraise or args.appraise_engine == NATIVE_APPRAISE_ENGINE:
+        appraise_batch_size = 0
+    else:
+        appraise_batch_size = args.appraise_batch_size if args.appraise_batch_size else 0
+
     if not args.precluster_size:
         args.precluster_size = args.max_recovery_samples * 5
 
@@ -522,6 +558,10 @@ def coassemble(args):
         # Clustering config
         "taxa_of_interest": args.taxa_of_interest if args.taxa_of_interest else None,
         "appraise_sequence_identity": args.appraise_sequence_identity / 100 if args.appraise_sequence_identity > 1 else args.appraise_sequence_identity,
+        "appraise_extra_sequence_identities": [i / 100 if i > 1 else i for i in args.appraise_extra_sequence_identities],
+        "appraise_batch_size": appraise_batch_size,
+        "appraise_engine": args.appraise_engine,
+        "query_processing_scan": args.query_processing_scan,
         "min_coassembly_coverage": args.min_sequence_coverage,
         "single_assembly": args.single_assembly,
         "no_genomes": args.no_genomes,
@@ -535,14 +575,22 @@ def coassemble(args):
         "abundance_weighted_samples": args.abundance_weighted_samples,
         "kmer_precluster": kmer_precluster,
         "precluster_distances": args.precluster_distances,
+        "precluster_sketch_cache": os.path.abspath(args.precluster_sketch_cache) if args.precluster_sketch_cache else None,
+        "genome_singlem": bool(args.genome_singlem),
+        "sample_read_size": bool(args.sample_read_size),
+        "read_size_cache": os.path.abspath(args.read_size_cache) if args.read_size_cache else None,
+        "read_size_estimate": args.read_size_estimate,
         "precluster_size": args.precluster_size,
         "prodigal_meta": args.prodigal_meta,
+        "pipe_batch_size": args.pipe_batch_size,
         # Coassembly config
         "assemble_unmapped": args.assemble_unmapped,
         "run_qc": args.run_qc,
         "unmapping_min_appraised": args.unmapping_min_appraised,
         "unmapping_max_identity": args.unmapping_max_identity,
         "unmapping_max_alignment": args.unmapping_max_alignment,
+        "unmapping_streaming": args.unmapping_streaming,
+        "intermediate_compression_level": args.intermediate_compression_level,
         "aviary_speed": args.aviary_speed,
         "assembly_strategy": args.assembly_strategy,
         "run_aviary": args.run_aviary,
@@ -771,11 +819,11 @@ def update(args):
         else:
             raise ValueError("Prior assemblies require elusive clusters")
 
-    copy_input(
+    copy_appraise_input(
         os.path.abspath(args.coassemble_unbinned),
         os.path.join(args.output, "coassemble", "appraise", "unbinned.otu_table.tsv")
     )
-    copy_input(
+    copy_appraise_input(
         os.path.abspath(args.coassemble_binned),
         os.path.join(args.output, "coassemble", "appraise", "binned.otu_table.tsv")
     )
@@ -838,13 +886,7 @@ def generate_genome_singlem(orig_args, new_genomes):
     return os.path.join(args.output, "coassemble", "summarise", "bins_summarised.otu_table.tsv")
 
 def combine_genome_singlem(genome_singlem, new_genome_singlem, path):
-    with open(path, "w") as f:
-        with open(genome_singlem) as g:
-            f.write(g.read())
-
-        with open(new_genome_singlem) as g:
-            g.readline()
-            f.write(g.read())
+    merge_otu_tables([genome_singlem, new_genome_singlem], path)
 
 def iterate(args):
     if not ((args.genomes or args.genomes_list) and (args.forward or args.forward_list)):
@@ -933,6 +975,14 @@ def iterate(args):
 
         args.exclude_coassemblies = cumulative_exclude + new_exclude_coassemblies + additional_exclude_coassemblies
 
+        sketch_cache = os.path.join(args.coassemble_output, "sketch")
+        if not args.precluster_sketch_cache and os.path.isdir(sketch_cache):
+            args.precluster_sketch_cache = sketch_cache
+
+        read_size_cache = os.path.join(args.coassemble_output, "read_size_cache.tsv")
+        if not args.read_size_cache and os.path.isfile(read_size_cache):
+            args.read_size_cache = read_size_cache
+
     try:
         args.coassemble_unbinned
     except AttributeError:
@@ -1111,6 +1161,7 @@ def build(args):
     args.abundance_weighted_samples_list = None
     args.kmer_precluster = PRECLUSTER_NEVER_MODE
     args.download_limit = 1
+    args.download_compression_level = None
 
     # Create mock input files
     forward_reads = [os.path.join(args.output, "sample_" + s + ".1.fq") for s in ["1", "2", "3"]]
@@ -1367,6 +1418,8 @@ def main():
         coassemble_base = parser.add_argument_group("Base input arguments")
         add_base_arguments(coassemble_base)
         coassemble_base.add_argument("--singlem-metapackage", help="SingleM metapackage for sequence searching. [default: use path from SINGLEM_METAPACKAGE_PATH env variable]")
+        default_pipe_batch_size = 1
+        coassemble_base.add_argument("--pipe-batch-size", type=int, help=f"Number of samples or genomes per SingleM pipe job, so the metapackage is loaded once per batch. Batched outputs are split back into per-sample and per-genome OTU tables [default: {default_pipe_batch_size}]", default=default_pipe_batch_size)
         # Midpoint arguments
         coassemble_midpoint = parser.add_argument_group("Intermediate results input arguments")
         coassemble_midpoint.add_argument("--sample-singlem", nargs='+', help="SingleM otu tables for each sample, in the form \"[sample name]_read.otu_table.tsv\". If provided, SingleM pipe sample is skipped")
@@ -1376,6 +1429,8 @@ def main():
         coassemble_midpoint.add_argument("--sample-query-list", help="Queried SingleM otu tables for each sample against genome database, in the form \"[sample name]_query.otu_table.tsv\" newline separated. If provided, SingleM pipe and appraise are skipped")
         coassemble_midpoint.add_argument("--sample-query-dir", help="Directory containing Queried SingleM otu tables for each sample against genome database, in the form \"[sample name]_query.otu_table.tsv\". If provided, SingleM pipe and appraise are skipped")
         coassemble_midpoint.add_argument("--sample-read-size", help="Comma separated list of sample name and size (bp). If provided, sample read counting is skipped")
+        coassemble_midpoint.add_argument("--read-size-cache", help="Read size cache from a previous run (e.g. coassemble/read_size_cache.tsv). Read files with unchanged path, size and modification time are not recounted. [default: count all read files, or reuse cache from --coassemble-output for iterate]")
+        coassemble_midpoint.add_argument("--read-size-estimate", action="store_true", help="Estimate sample read sizes from records sampled at the start and interior of each read file, scaled by file size, instead of counting every base. 95%% confidence intervals are reported in read_size_estimate.tsv")
         coassemble_midpoint.add_argument("--genome-transcripts", nargs='+', help="Genome transcripts for reference database, in the form \"[genome]_protein.fna\"")
         coassemble_midpoint.add_argument("--genome-transcripts-list", help="Genome transcripts for reference database, in the form \"[genome]_protein.fna\" newline separated")
         coassemble_midpoint.add_argument("--genome-singlem", help="Combined SingleM otu tables for genome transcripts. If provided, genome SingleM is skipped")
@@ -1384,6 +1439,11 @@ def main():
         coassemble_clustering.add_argument("--taxa-of-interest", help="Only consider sequences from this GTDB taxa (e.g. p__Planctomycetota, or 'p__Bacillota|p__Bacteroidota') [default: all]")
         appraise_sequence_identity_default = 0.96
         coassemble_clustering.add_argument("--appraise-sequence-identity", type=int, help=f"Minimum sequence identity for SingleM appraise against reference database. e.g. 96% for Species-level or 86% Genus-level [default: {appraise_sequence_identity_default}]", default=appraise_sequence_identity_default)
+        coassemble_clustering.add_argument("--appraise-extra-sequence-identities", nargs='+', type=int, help="Additional sequence identities (e.g. 86 89) for which binned/unbinned tables are produced in the same pass, at appraise/identity_[identity]. Requires SingleM query otu tables (--sample-query) [default: none]", default=[])
+        coassemble_clustering.add_argument("--appraise-batch-size", type=int, help="Appraise samples in parallel batches of this size against the reference database, merging the results. Ignored when SingleM query otu tables are provided [default: appraise all samples in one job]")
+        coassemble_clustering.add_argument("--appraise-engine", help=f"Engine for appraising samples against the reference database. {NATIVE_APPRAISE_ENGINE} compares packed windows with multiple threads, and supports --appraise-extra-sequence-identities [default: {SINGLEM_APPRAISE_ENGINE}]",
+                                    default=SINGLEM_APPRAISE_ENGINE, choices=[SINGLEM_APPRAISE_ENGINE, NATIVE_APPRAISE_ENGINE])
+        coassemble_clustering.add_argument("--query-processing-scan", action="store_true", help="Process SingleM query outputs as a single lazy scan across all samples, rather than sample by sample [default: False]")
         min_sequence_coverage_default = 10
         coassemble_clustering.add_argument("--min-sequence-coverage", type=int, help=f"Minimum combined coverage for sequence inclusion [default: {min_sequence_coverage_default}]", default=min_sequence_coverage_default)
         coassemble_clustering.add_argument("--single-assembly", action="store_true", help="Skip appraise to discover samples to differential abundance binning. Forces --num-coassembly-samples and --max-coassembly-samples to 1 and sets --max-coassembly-size to None")
@@ -1401,7 +1461,8 @@ def main():
         coassemble_clustering.add_argument("--abundance-weighted-samples-list", help="Restrict sequence weighting to these samples, newline separated. Remaining samples will still be used for coassembly [default: use all samples]", default=[])
         coassemble_clustering.add_argument("--kmer-precluster", help="Run kmer preclustering using unbinned window sequences as kmers. [default: large; perform preclustering when given >1000 samples]",
                                     default=PRECLUSTER_SIZE_DEP_MODE, choices=[PRECLUSTER_NEVER_MODE, PRECLUSTER_SIZE_DEP_MODE, PRECLUSTER_ALWAYS_MODE])
-        coassemble_clustering.add_argument("--precluster-distances", help="Distance file in the format of `sourmash scripts pairwise`. If provided, kmer sketching and clustering is skipped.")
+        coassemble_clustering.add_argument("--precluster-distances", help="Distance file in the format of `sourmash scripts pairwise`, or compact binary distances (.dist) from a previous run (sketch/samples.dist). If provided, kmer sketching and clustering is skipped.")
+        coassemble_clustering.add_argument("--precluster-sketch-cache", help="Sketch directory from a previous run (e.g. coassemble/sketch). Samples with unchanged unbinned windows reuse these sketches. [default: sketch all samples, or reuse sketches from --coassemble-output for iterate]")
         coassemble_clustering.add_argument("--precluster-size", type=int, help="# of samples within each sample's precluster [default: 5 * max-recovery-samples]")
         coassemble_clustering.add_argument("--prodigal-meta", action="store_true", help="Use prodigal \"-p meta\" argument (for testing)")
         # Coassembly options
@@ -1410,6 +1471,7 @@ def main():
         coassemble_coassembly.add_argument("--sra", action="store_true", help="Download reads from SRA (forward read argument intepreted as SRA IDs). Also sets --run-qc.")
         default_download_limit = 3
         coassemble_coassembly.add_argument("--download-limit", type=int, help=f"Parallel download limit [default: {default_download_limit}]", default=default_download_limit)
+        coassemble_coassembly.add_argument("--download-compression-level", type=int, choices=range(0, 10), metavar="{0-9}", help="Gzip compression level of deinterleaved single-file downloads [default: --intermediate-compression-level]")
         coassemble_coassembly.add_argument("--run-qc", action="store_true", help="Run Fastp QC on reads")
         unmapping_min_appraised_default = 0.1
         coassemble_coassembly.add_argument("--unmapping-min-appraised", type=float, help=f"Minimum fraction of sequences binned to justify unmapping [default: {unmapping_min_appraised_default}]", default=unmapping_min_appraised_default)
@@ -1417,6 +1479,9 @@ def main():
         coassemble_coassembly.add_argument("--unmapping-max-identity", type=float, help=f"Maximum sequence identity of mapped sequences kept for coassembly [default: {unmapping_max_identity_default}%]", default=unmapping_max_identity_default)
         unmapping_max_alignment_default = 99
         coassemble_coassembly.add_argument("--unmapping-max-alignment", type=float, help=f"Maximum percent alignment of mapped sequences kept for coassembly [default: {unmapping_max_alignment_default}%]", default=unmapping_max_alignment_default)
+        coassemble_coassembly.add_argument("--unmapping-streaming", action="store_true", help="Stream alignments through the unmapping filter into compressed reads, without writing intermediate BAM files")
+        default_intermediate_compression_level = 1
+        coassemble_coassembly.add_argument("--intermediate-compression-level", type=int, choices=range(1, 10), metavar="{1-9}", help=f"Gzip compression level of intermediate reads (QC, unmapped and deinterleaved downloads), which are read once by Aviary [default: {default_intermediate_compression_level}]", default=default_intermediate_compression_level)
         add_aviary_options(coassemble_coassembly)
         # General options
         coassemble_general = parser.add_argument_group("General options")
@@ -1463,6 +1528,9 @@ def main():
     update_base.add_argument("--sra", action="store_true", help="Download reads from SRA (forward read argument intepreted as SRA IDs). Also sets --run-qc.")
     default_download_limit = 3
     update_base.add_argument("--download-limit", type=int, help=f"Parallel download limit [default: {default_download_limit}]", default=default_download_limit)
+    update_base.add_argument("--download-compression-level", type=int, choices=range(0, 10), metavar="{0-9}", help="Gzip compression level of deinterleaved single-file downloads [default: --intermediate-compression-level]")
+    default_pipe_batch_size = 1
+    update_base.add_argument("--pipe-batch-size", type=int, help=f"Number of samples or genomes per SingleM pipe job, so the metapackage is loaded once per batch. Batched outputs are split back into per-sample and per-genome OTU tables [default: {default_pipe_batch_size}]", default=default_pipe_batch_size)
     # Coassembly options
     update_coassembly = update_parser.add_argument_group("Coassembly options")
     add_coassemble_output_arguments(update_coassembly)
@@ -1476,6 +1544,9 @@ def main():
     update_coassembly.add_argument("--unmapping-max-identity", type=float, help=f"Maximum sequence identity of mapped sequences kept for coassembly [default: {unmapping_max_identity_default}%]", default=unmapping_max_identity_default)
     unmapping_max_alignment_default = 99
     update_coassembly.add_argument("--unmapping-max-alignment", type=float, help=f"Maximum percent alignment of mapped sequences kept for coassembly [default: {unmapping_max_alignment_default}%]", default=unmapping_max_alignment_default)
+    update_coassembly.add_argument("--unmapping-streaming", action="store_true", help="Stream alignments through the unmapping filter into compressed reads, without writing intermediate BAM files")
+    default_intermediate_compression_level = 1
+    update_coassembly.add_argument("--intermediate-compression-level", type=int, choices=range(1, 10), metavar="{1-9}", help=f"Gzip compression level of intermediate reads (QC, unmapped and deinterleaved downloads), which are read once by Aviary [default: {default_intermediate_compression_level}]", default=default_intermediate_compression_level)
     add_aviary_options(update_coassembly)
     # General options
     update_general = update_parser.add_argument_group("General options")
@@ -1570,6 +1641,10 @@ def main():
             base_argument_verification(args)
         if (args.sample_query or args.sample_query_list or args.sample_query_dir) and not (args.sample_singlem or args.sample_singlem_list or args.sample_singlem_dir):
             raise Exception("Input SingleM query (--sample-query) requires SingleM otu tables (--sample-singlem) for coverage")
+        if args.appraise_extra_sequence_identities and not (args.sample_query or args.sample_query_list or args.sample_query_dir) and args.appraise_engine != NATIVE_APPRAISE_ENGINE:
+            raise Exception("Additional sequence identities (--appraise-extra-sequence-identities) require SingleM query otu tables (--sample-query) or the native appraise engine (--appraise-engine native)")
+        if len(set(args.appraise_extra_sequence_identities)) != len(args.appraise_extra_sequence_identities):
+            raise Exception("Additional sequence identities (--appraise-extra-sequence-identities) must not be repeated")
         if args.assemble_unmapped and args.single_assembly:
             raise Exception("Assemble unmapped is incompatible with single-sample assembly")
         if args.assemble_unmapped and not args.genomes and not args.genomes_list:
@@ -1581,6 +1656,10 @@ def main():
             (args.coassembly_samples and args.coassembly_samples_list) or (args.abundance_weighted_samples and args.abundance_weighted_samples_list) or \
             (args.anchor_samples and args.anchor_samples_list):
             raise Exception("General, list and directory arguments are mutually exclusive")
+        if args.appraise_batch_size is not None and args.appraise_batch_size < 1:
+            raise Exception("Appraise batch size (--appraise-batch-size) must be at least 1")
+        if args.pipe_batch_size < 1:
+            raise Exception("SingleM pipe batch size (--pipe-batch-size) must be at least 1")
         if args.single_assembly:
             if 1 > args.max_recovery_samples:
                 raise Exception("Max recovery samples (--max-recovery-samples) must be at least 1")
@@ -1,14 +1,22 @@
 #############
 ### Setup ###
 #############
-ruleorder: no_genomes > query_processing > update_appraise > singlem_appraise
+ruleorder: no_genomes > query_processing > update_appraise > native_appraise > singlem_appraise
 ruleorder: mock_download_sra > download_sra
 ruleorder: prior_assemble > aviary_assemble
-ruleorder: provided_distances > distance_samples
+ruleorder: provided_distances > update_distances > distance_samples
+ruleorder: provided_distances > compact_distances
+ruleorder: harvest_read_size > count_bp_reads
+ruleorder: map_reads_streaming > bam_to_fastq
+ruleorder: singlem_appraise_merge > singlem_appraise_filtered
 
 import os
+import sys
+import math
 import polars as pl
 from binchicken.binchicken import FAST_AVIARY_MODE, DYNAMIC_ASSEMBLY_STRATEGY, METASPADES_ASSEMBLY, MEGAHIT_ASSEMBLY
+from binchicken.workflow.scripts.collect_reference_bins import load_reference_sets, reference_key
+from binchicken.workflow.scripts.split_otu_table import batch_inputs, singlem_sample_name
 os.umask(0o002)
 
 output_dir = os.path.abspath("coassemble")
@@ -21,6 +29,15 @@ mapped_reads_2 = {read: output_dir + f"/mapping/{read}_unmapped.2.fq.gz" for rea
 qc_reads_1 = {read: output_dir + f"/qc/{read}_1.fastq.gz" for read in config["reads_1"]}
 qc_reads_2 = {read: output_dir + f"/qc/{read}_2.fastq.gz" for read in config["reads_2"]}
 
+# SingleM pipe batches, with new genomes batched separately so updates only pipe new genomes
+read_batches = batch_inputs(config["reads_1"], config["pipe_batch_size"])
+new_genomes = set(config["new_genomes"]) if config["new_genomes"] else set()
+genome_batches = {
+    **batch_inputs(set(config["genomes"] or []) - new_genomes, config["pipe_batch_size"]),
+    **{"new_" + b: g for b, g in batch_inputs(new_genomes, config["pipe_batch_size"]).items()},
+    }
+appraise_batches = batch_inputs(config["reads_1"], config["appraise_batch_size"]) if config["appraise_batch_size"] else {}
+
 def get_mem_mb(wildcards, threads, attempt):
     return 8 * 1000 * threads * attempt
 
@@ -29,15 +46,48 @@ def get_runtime(base_hours):
         return f"{attempt * base_hours}h"
     return runtime_func
 
+# SingleM pipe batches use a thread per input, up to this many
+PIPE_BATCH_THREADS = 8
+
+def get_batch_threads(batches):
+    def threads_func(wildcards):
+        return min(len(batches[wildcards.batch]), PIPE_BATCH_THREADS)
+    return threads_func
+
+# Batch runtime covers hours_per_input for each input per thread, capped at max_hours per attempt
+def get_batch_runtime(batches, hours_per_input, max_hours):
+    def runtime_func(wildcards, threads, attempt):
+        hours = math.ceil(len(batches[wildcards.batch]) * hours_per_input / threads)
+        return f"{attempt * min(hours, max_hours)}h"
+    return runtime_func
+
+def read_otu_table(read):
+    return output_dir + f"/pipe/{read}_read.otu_table.tsv"
+
+def genome_otu_table(genome):
+    return output_dir + f"/pipe/{genome}_bin.otu_table.tsv"
+
+# Batched SingleM pipe tables are split by checkpoint, unless every table is already present (e.g. provided)
+def get_read_otu_tables(reads):
+    otu_tables = [read_otu_table(read) for read in reads]
+    if config["pipe_batch_size"] > 1 and not all(os.path.exists(t) for t in otu_tables):
+        checkpoints.singlem_split_reads_all.get()
+    return otu_tables
+
 def get_genomes(wildcards, version=None):
     version = version if version else wildcards.version
     if version == "":
-        return expand(output_dir + "/pipe/{genome}_bin.otu_table.tsv", genome=config["genomes"])
+        genomes = config["genomes"]
     elif version == "new_":
-        return expand(output_dir + "/pipe/{genome}_bin.otu_table.tsv", genome=config["new_genomes"])
+        genomes = config["new_genomes"]
     else:
         raise ValueError("Version should be empty or 'new'")
 
+    otu_tables = [genome_otu_table(genome) for genome in genomes]
+    if config["pipe_batch_size"] > 1 and not all(os.path.exists(t) for t in otu_tables):
+        checkpoints.singlem_split_genomes_all.get(version=version)
+    return otu_tables
+
 def get_reads(wildcards, forward=True, version=None):
     version = version if version else wildcards.version
     if version == "" or version == "whole":
@@ -58,9 +108,6 @@ def get_reads(wildcards, forward=True, version=None):
     else:
         raise ValueError("Version should be empty, 'whole' or 'unmapped'")
 
-def get_cat(wildcards):
-    return "zcat" if [r for r in get_reads(wildcards).values()][0].endswith(".gz") else "cat"
-
 def get_reads_coassembly(wildcards, forward=True, recover=False):
     checkpoint_output = checkpoints.cluster_graph.get(**wildcards).output[0]
     elusive_clusters = pl.read_csv(checkpoint_output, separator="\t")
@@ -82,6 +129,38 @@ def get_reads_coassembly(wildcards, forward=True, recover=False):
     reads = get_reads(wildcards, forward=forward, version=version)
     return [reads[n] for n in sample_names]
 
+def get_coassembly_samples():
+    """
+    Samples assembled or recovered by the selected coassemblies
+    """
+    checkpoint_output = checkpoints.cluster_graph.get().output.elusive_clusters
+    elusive_clusters = pl.read_csv(checkpoint_output, separator="\t", schema_overrides={"samples": str, "recover_samples": str})
+
+    samples = (
+        pl.concat([elusive_clusters.get_column("samples"), elusive_clusters.get_column("recover_samples")])
+        .str.split(",")
+        .explode()
+        .unique()
+        .to_list()
+    )
+    return sorted(s for s in samples if s in config["reads_1"])
+
+def get_reference_key(wildcards):
+    manifest = checkpoints.collect_reference_bins.get().output.manifest
+    sample_keys, _ = load_reference_sets(manifest)
+    return sample_keys.get(wildcards.read, reference_key([]))
+
+def get_reference_genomes(wildcards):
+    manifest = checkpoints.collect_reference_bins.get().output.manifest
+    _, key_genomes = load_reference_sets(manifest)
+    return [output_dir + f"/mapping/genomes/{genome}.fna" for genome in key_genomes[wildcards.key]]
+
+def get_extra_appraise(filename):
+    return [
+        output_dir + f"/appraise/identity_{round(identity * 100)}/{filename}"
+        for identity in config["appraise_extra_sequence_identities"]
+    ]
+
 def get_coassemblies(wildcards):
     checkpoint_output = checkpoints.cluster_graph.get().output[0]
     elusive_clusters = pl.read_csv(checkpoint_output, separator="\t")
@@ -96,6 +175,8 @@ rule all:
         output_dir + "/commands/recover_commands.sh" if not config["run_aviary"] else [],
         output_dir + "/commands/done" if config["run_aviary"] else [],
         output_dir + "/summary.tsv",
+        get_extra_appraise("unbinned.otu_table.tsv"),
+        get_extra_appraise("binned.otu_table.tsv"),
     localrule: True
 
 rule summary:
@@ -111,31 +192,85 @@ rule summary:
 #####################
 ### SingleM reads ###
 #####################
-rule singlem_pipe_reads:
-    input:
-        reads_1 = lambda wildcards: config["reads_1"][wildcards.read],
-        reads_2 = lambda wildcards: config["reads_2"][wildcards.read],
-    output:
-        output_dir + "/pipe/{read}_read.otu_table.tsv"
-    log:
-        logs_dir + "/pipe/{read}_read.log"
-    benchmark:
-        benchmarks_dir + "/pipe/{read}_read.tsv"
-    params:
-        singlem_metapackage = config["singlem_metapackage"]
-    threads: 1
-    resources:
-        mem_mb=get_mem_mb,
-        runtime = get_runtime(base_hours = 24),
-    conda:
-        "env/singlem.yml"
-    shell:
-        "singlem pipe "
-        "--forward {input.reads_1} "
-        "--reverse {input.reads_2} "
-        "--otu-table {output} "
-        "--metapackage {params.singlem_metapackage} "
-        "&> {log}"
+if config["pipe_batch_size"] == 1:
+    rule singlem_pipe_reads:
+        input:
+            reads_1 = lambda wildcards: config["reads_1"][wildcards.read],
+            reads_2 = lambda wildcards: config["reads_2"][wildcards.read],
+        output:
+            output_dir + "/pipe/{read}_read.otu_table.tsv"
+        log:
+            logs_dir + "/pipe/{read}_read.log"
+        benchmark:
+            benchmarks_dir + "/pipe/{read}_read.tsv"
+        params:
+            singlem_metapackage = config["singlem_metapackage"]
+        threads: 1
+        resources:
+            mem_mb=get_mem_mb,
+            runtime = get_runtime(base_hours = 24),
+        conda:
+            "env/singlem.yml"
+        shell:
+            "singlem pipe "
+            "--forward {input.reads_1} "
+            "--reverse {input.reads_2} "
+            "--otu-table {output} "
+            "--metapackage {params.singlem_metapackage} "
+            "&> {log}"
+
+else:
+    rule singlem_pipe_reads_batch:
+        input:
+            reads_1 = lambda wildcards: [config["reads_1"][r] for r in read_batches[wildcards.batch]],
+            reads_2 = lambda wildcards: [config["reads_2"][r] for r in read_batches[wildcards.batch]],
+        output:
+            temp(output_dir + "/pipe/batches/read_{batch}.otu_table.tsv")
+        log:
+            logs_dir + "/pipe/batches/read_{batch}.log"
+        benchmark:
+            benchmarks_dir + "/pipe/batches/read_{batch}.tsv"
+        params:
+            singlem_metapackage = config["singlem_metapackage"]
+        threads: get_batch_threads(read_batches)
+        resources:
+            mem_mb=get_mem_mb,
+            runtime = get_batch_runtime(read_batches, hours_per_input = 4, max_hours = 24),
+        conda:
+            "env/singlem.yml"
+        shell:
+            "singlem pipe "
+            "--forward {input.reads_1} "
+            "--reverse {input.reads_2} "
+            "--otu-table {output} "
+            "--metapackage {params.singlem_metapackage} "
+            "--threads {threads} "
+            "&> {log}"
+
+    # Each batched OTU table is read once, writing every sample's OTU table and listing them
+    rule singlem_split_reads:
+        input:
+            otu_table = output_dir + "/pipe/batches/read_{batch}.otu_table.tsv",
+        output:
+            manifest = output_dir + "/pipe/batches/read_{batch}.split.tsv",
+        log:
+            logs_dir + "/pipe/batches/read_{batch}_split.log"
+        params:
+            batch_samples = lambda wildcards: [singlem_sample_name(config["reads_1"][read]) for read in read_batches[wildcards.batch]],
+            otu_tables = lambda wildcards: [read_otu_table(read) for read in read_batches[wildcards.batch]],
+        threads: 1
+        localrule: True
+        script:
+            "scripts/split_otu_table.py"
+
+    checkpoint singlem_split_reads_all:
+        input:
+            expand(output_dir + "/pipe/batches/read_{batch}.split.tsv", batch=read_batches),
+        output:
+            output_dir + "/pipe/batches/reads_split.tsv"
+        localrule: True
+        shell:
+            "cat {input} > {output}"
 
 #######################
 ### SingleM genomes ###
@@ -165,36 +300,94 @@ rule genome_transcripts:
         "{params.prodigal_meta} "
         "&> {log} "
 
-rule singlem_pipe_genomes:
-    input:
-        output_dir + "/transcripts/{genome}_protein.fna"
-    output:
-        output_dir + "/pipe/{genome}_bin.otu_table.tsv"
-    log:
-        logs_dir + "/pipe/{genome}_bin.log"
-    benchmark:
-        benchmarks_dir + "/pipe/{genome}_bin.tsv"
-    params:
-        singlem_metapackage = config["singlem_metapackage"]
-    threads: 1
-    resources:
-        mem_mb=get_mem_mb,
-        runtime = get_runtime(base_hours = 1),
-    group: "singlem_bins"
-    conda:
-        "env/singlem.yml"
-    shell:
-        "singlem pipe "
-        "--forward {input} "
-        "--otu-table {output} "
-        "--metapackage {params.singlem_metapackage} "
-        "&> {log}"
+if config["pipe_batch_size"] == 1:
+    rule singlem_pipe_genomes:
+        input:
+            output_dir + "/transcripts/{genome}_protein.fna"
+        output:
+            output_dir + "/pipe/{genome}_bin.otu_table.tsv"
+        log:
+            logs_dir + "/pipe/{genome}_bin.log"
+        benchmark:
+            benchmarks_dir + "/pipe/{genome}_bin.tsv"
+        params:
+            singlem_metapackage = config["singlem_metapackage"]
+        threads: 1
+        resources:
+            mem_mb=get_mem_mb,
+            runtime = get_runtime(base_hours = 1),
+        group: "singlem_bins"
+        conda:
+            "env/singlem.yml"
+        shell:
+            "singlem pipe "
+            "--forward {input} "
+            "--otu-table {output} "
+            "--metapackage {params.singlem_metapackage} "
+            "&> {log}"
+
+else:
+    rule singlem_pipe_genomes_batch:
+        input:
+            lambda wildcards: [output_dir + f"/transcripts/{genome}_protein.fna" for genome in genome_batches[wildcards.batch]],
+        output:
+            temp(output_dir + "/pipe/batches/bin_{batch}.otu_table.tsv")
+        log:
+            logs_dir + "/pipe/batches/bin_{batch}.log"
+        benchmark:
+            benchmarks_dir + "/pipe/batches/bin_{batch}.tsv"
+        params:
+            singlem_metapackage = config["singlem_metapackage"]
+        threads: get_batch_threads(genome_batches)
+        resources:
+            mem_mb=get_mem_mb,
+            runtime = get_batch_runtime(genome_batches, hours_per_input = 0.25, max_hours = 4),
+        group: "singlem_bins"
+        conda:
+            "env/singlem.yml"
+        shell:
+            "singlem pipe "
+            "--forward {input} "
+            "--otu-table {output} "
+            "--metapackage {params.singlem_metapackage} "
+            "--threads {threads} "
+            "&> {log}"
+
+    # Each batched OTU table is read once, writing every genome's OTU table and listing them
+    rule singlem_split_genomes:
+        input:
+            otu_table = output_dir + "/pipe/batches/bin_{batch}.otu_table.tsv",
+        output:
+            manifest = output_dir + "/pipe/batches/bin_{batch}.split.tsv",
+        log:
+            logs_dir + "/pipe/batches/bin_{batch}_split.log"
+        params:
+            batch_samples = lambda wildcards: [genome + "_protein" for genome in genome_batches[wildcards.batch]],
+            otu_tables = lambda wildcards: [genome_otu_table(genome) for genome in genome_batches[wildcards.batch]],
+        threads: 1
+        localrule: True
+        script:
+            "scripts/split_otu_table.py"
+
+    # New genome batches are split separately, so updates only pipe new genomes
+    checkpoint singlem_split_genomes_all:
+        input:
+            lambda wildcards: [
+                output_dir + f"/pipe/batches/bin_{batch}.split.tsv"
+                for batch in genome_batches if batch.startswith(wildcards.version)
+                ],
+        output:
+            output_dir + "/pipe/batches/{version,(new_)?}bins_split.tsv"
+        localrule: True
+        shell:
+            "cat {input} > {output}"
 
 rule singlem_summarise_genomes:
     input:
         lambda wildcards: get_genomes(wildcards)
     output:
-        output_dir + "/summarise/{version,.*}bins_summarised.otu_table.tsv"
+        # Provided genome OTU tables are used as is, without comparing against the merging script
+        output_dir + ("/summarise/{version,.+}bins_summarised.otu_table.tsv" if config["genome_singlem"] else "/summarise/{version,.*}bins_summarised.otu_table.tsv")
     log:
         logs_dir + "/summarise/{version,.*}genomes.log"
     benchmark:
@@ -202,22 +395,15 @@ rule singlem_summarise_genomes:
     params:
         singlem_metapackage = config["singlem_metapackage"]
     localrule: True
-    conda:
-        "env/singlem.yml"
-    shell:
-        "singlem summarise "
-        "--input-otu-tables {input} "
-        "--output-otu-table {output} "
-        "--exclude-off-target-hits "
-        "--metapackage {params.singlem_metapackage} "
-        "&> {log}"
+    script:
+        "scripts/merge_otu_tables.py"
 
 ########################
 ### SingleM appraise ###
 ########################
 rule singlem_appraise:
     input:
-        reads = expand(output_dir + "/pipe/{read}_read.otu_table.tsv", read=config["reads_1"]),
+        reads = lambda wildcards: get_read_otu_tables(config["reads_1"]),
         bins = output_dir + "/summarise/bins_summarised.otu_table.tsv",
     output:
         unbinned = temp(output_dir + "/appraise/unbinned_raw.otu_table.tsv"),
@@ -247,6 +433,54 @@ rule singlem_appraise:
         "--output-found-in "
         "&> {log}"
 
+rule singlem_appraise_batch:
+    input:
+        reads = lambda wildcards: get_read_otu_tables(appraise_batches[wildcards.batch]),
+        bins = output_dir + "/summarise/bins_summarised.otu_table.tsv",
+    output:
+        unbinned = temp(output_dir + "/appraise/batches/{batch}_unbinned_raw.otu_table.tsv"),
+        binned = temp(output_dir + "/appraise/batches/{batch}_binned_raw.otu_table.tsv"),
+    log:
+        logs_dir + "/appraise/batches/{batch}_appraise.log"
+    benchmark:
+        benchmarks_dir + "/appraise/batches/{batch}_appraise.tsv"
+    params:
+        sequence_identity = config["appraise_sequence_identity"],
+        singlem_metapackage = config["singlem_metapackage"],
+    threads: 1
+    resources:
+        mem_mb=get_mem_mb,
+        runtime = get_runtime(base_hours = 24),
+    conda:
+        "env/singlem.yml"
+    shell:
+        "singlem appraise "
+        "--metagenome-otu-tables {input.reads} "
+        "--genome-otu-tables {input.bins} "
+        "--metapackage {params.singlem_metapackage} "
+        "--output-unaccounted-for-otu-table {output.unbinned} "
+        "--output-binned-otu-table {output.binned} "
+        "--imperfect "
+        "--sequence-identity {params.sequence_identity} "
+        "--output-found-in "
+        "&> {log}"
+
+rule singlem_appraise_merge:
+    input:
+        unbinned = expand(output_dir + "/appraise/batches/{batch}_unbinned_raw.otu_table.tsv", batch=appraise_batches),
+        binned = expand(output_dir + "/appraise/batches/{batch}_binned_raw.otu_table.tsv", batch=appraise_batches),
+    output:
+        unbinned = output_dir + "/appraise/unbinned.otu_table.tsv" if config["appraise_batch_size"] else [],
+        binned = output_dir + "/appraise/binned.otu_table.tsv" if config["appraise_batch_size"] else [],
+    log:
+        logs_dir + "/appraise/merge.log"
+    params:
+        bad_package = "S3.18.EIF_2_alpha",
+    threads: 1
+    localrule: True
+    script:
+        "scripts/merge_appraise.py"
+
 rule singlem_appraise_filtered:
     input:
         unbinned = output_dir + "/appraise/unbinned_raw.otu_table.tsv",
@@ -254,12 +488,30 @@ rule singlem_appraise_filtered:
     output:
         unbinned = output_dir + "/appraise/unbinned.otu_table.tsv",
         binned = output_dir + "/appraise/binned.otu_table.tsv",
+    log:
+        logs_dir + "/appraise/filtered.log"
     params:
         bad_package = "S3.18.EIF_2_alpha",
+    threads: 1
     localrule: True
-    shell:
-        "grep -v {params.bad_package} {input.unbinned} > {output.unbinned} && "
-        "grep -v {params.bad_package} {input.binned} > {output.binned}"
+    script:
+        "scripts/merge_appraise.py"
+
+rule singlem_appraise_filtered_identity:
+    input:
+        unbinned = output_dir + "/appraise/identity_{identity}/unbinned_raw.otu_table.tsv",
+        binned = output_dir + "/appraise/identity_{identity}/binned_raw.otu_table.tsv",
+    output:
+        unbinned = output_dir + "/appraise/identity_{identity}/unbinned.otu_table.tsv",
+        binned = output_dir + "/appraise/identity_{identity}/binned.otu_table.tsv",
+    log:
+        logs_dir + "/appraise/identity_{identity}/filtered.log"
+    params:
+        bad_package = "S3.18.EIF_2_alpha",
+    threads: 1
+    localrule: True
+    script:
+        "scripts/merge_appraise.py"
 
 #####################################
 ### Update appraise (alternative) ###
@@ -304,31 +556,63 @@ rule update_appraise:
 ###################################
 rule query_processing:
     input:
-        pipe_reads = expand(output_dir + "/pipe/{read}_read.otu_table.tsv", read=config["reads_1"]),
+        pipe_reads = lambda wildcards: get_read_otu_tables(config["reads_1"]),
         query_reads = expand(output_dir + "/query/{read}_query.otu_table.tsv", read=config["reads_1"]),
     output:
         unbinned = temp(output_dir + "/appraise/unbinned_raw.otu_table.tsv"),
         binned = temp(output_dir + "/appraise/binned_raw.otu_table.tsv"),
+        extra_unbinned = [temp(f) for f in get_extra_appraise("unbinned_raw.otu_table.tsv")],
+        extra_binned = [temp(f) for f in get_extra_appraise("binned_raw.otu_table.tsv")],
     log:
         logs_dir + "/query/processing.log"
     benchmark:
         benchmarks_dir + "/query/processing.tsv"
     params:
         sequence_identity = config["appraise_sequence_identity"],
+        extra_sequence_identities = config["appraise_extra_sequence_identities"],
         window_size = 60,
-    threads: 1
+        scan = config["query_processing_scan"],
+        partial_dir = output_dir + "/appraise/query_processing_partial",
+    threads: 64
     resources:
         mem_mb=get_mem_mb,
         runtime = get_runtime(base_hours = 24),
     script:
         "scripts/query_processing.py"
 
+#####################################
+### Native appraise (alternative) ###
+#####################################
+rule native_appraise:
+    input:
+        reads = lambda wildcards: get_read_otu_tables(config["reads_1"]),
+        bins = output_dir + "/summarise/bins_summarised.otu_table.tsv",
+    output:
+        unbinned = temp(output_dir + "/appraise/unbinned_raw.otu_table.tsv") if config["appraise_engine"] == "native" else [],
+        binned = temp(output_dir + "/appraise/binned_raw.otu_table.tsv") if config["appraise_engine"] == "native" else [],
+        extra_unbinned = [temp(f) for f in get_extra_appraise("unbinned_raw.otu_table.tsv")] if config["appraise_engine"] == "native" else [],
+        extra_binned = [temp(f) for f in get_extra_appraise("binned_raw.otu_table.tsv")] if config["appraise_engine"] == "native" else [],
+    log:
+        logs_dir + "/appraise/native_appraise.log"
+    benchmark:
+        benchmarks_dir + "/appraise/native_appraise.tsv"
+    params:
+        sequence_identity = config["appraise_sequence_identity"],
+        extra_sequence_identities = config["appraise_extra_sequence_identities"],
+        window_size = 60,
+    threads: 64
+    resources:
+        mem_mb=get_mem_mb,
+        runtime = get_runtime(base_hours = 24),
+    script:
+        "scripts/native_appraise.py"
+
 ################################
 ### No genomes (alternative) ###
 ################################
 rule no_genomes:
     input:
-        reads = expand(output_dir + "/pipe/{read}_read.otu_table.tsv", read=config["reads_1"]),
+        reads = lambda wildcards: get_read_otu_tables(config["reads_1"]),
     output:
         unbinned = temp(output_dir + "/appraise/unbinned_raw.otu_table.tsv") if config["no_genomes"] else [],
         binned = temp(output_dir + "/appraise/binned_raw.otu_table.tsv") if config["no_genomes"] else [],
@@ -346,22 +630,42 @@ rule count_bp_reads:
         reads_1 = lambda wildcards: get_reads(wildcards).values(),
         reads_2 = lambda wildcards: get_reads(wildcards, forward=False).values()
     output:
-        output_dir + "/{version,.*}read_size.csv"
+        # Provided sample read sizes are used as is, without comparing against the counting script
+        read_size = output_dir + ("/{version,.+}read_size.csv" if config["sample_read_size"] else "/{version,.*}read_size.csv"),
     params:
         names = list(config["reads_1"].keys()),
-        cat = get_cat,
+        cache = config["read_size_cache"],
+        estimate = config["read_size_estimate"],
+        # Not outputs, so provided read sizes do not trigger recounting
+        cache_output = lambda wildcards: output_dir + f"/{wildcards.version}read_size_cache.tsv",
+        estimate_output = lambda wildcards: output_dir + f"/{wildcards.version}read_size_estimate.tsv",
     threads: 8
     resources:
         mem_mb=get_mem_mb,
         runtime = get_runtime(base_hours = 24),
-    conda:
-        "env/general.yml"
-    shell:
-        "parallel -k -j {threads} "
-        "echo -n {{1}}, '&&' "
-        "{params.cat} {{2}} {{3}} '|' sed -n 2~4p '|' tr -d '\"\n\"' '|' wc -m "
-        "::: {params.names} :::+ {input.reads_1} :::+ {input.reads_2} "
-        "> {output}"
+    log:
+        logs_dir + "/{version}count_bp_reads.log"
+    benchmark:
+        benchmarks_dir + "/{version}count_bp_reads.tsv"
+    script:
+        "scripts/count_bp_reads.py"
+
+def get_read_sizes(wildcards):
+    if wildcards.version == "qc_":
+        return [output_dir + f"/qc/{read}.json" for read in get_coassembly_samples()]
+    else:
+        return [output_dir + f"/mapping/{read}_unmapped.bases" for read in get_coassembly_samples()]
+
+rule harvest_read_size:
+    input:
+        sizes = get_read_sizes,
+    output:
+        read_size = output_dir + "/{version,qc_|unmapped_}read_size.csv",
+    localrule: True
+    log:
+        logs_dir + "/{version}harvest_read_size.log"
+    script:
+        "scripts/count_bp_reads.py"
 
 rule abundance_weighting:
     input:
@@ -386,9 +690,12 @@ rule sketch_samples:
     input:
         unbinned = output_dir + "/appraise/unbinned.otu_table.tsv",
     output:
-        sketch = output_dir + "/sketch/samples.sig"
+        sketch = output_dir + "/sketch/samples.sig.zip",
+        digests = output_dir + "/sketch/samples_digests.tsv",
+        changed = output_dir + "/sketch/changed.sig.zip" if config["precluster_sketch_cache"] else [],
     params:
         taxa_of_interest = config["taxa_of_interest"],
+        sketch_cache = config["precluster_sketch_cache"],
     threads: 64
     resources:
         mem_mb=get_mem_mb,
@@ -404,7 +711,8 @@ rule provided_distances:
     input:
         unbinned = output_dir + "/appraise/unbinned.otu_table.tsv",
     output:
-        distance = output_dir + "/sketch/samples.csv" if config["precluster_distances"] else [],
+        distance = (output_dir + "/sketch/samples.dist" if config["precluster_distances"].endswith(".dist") else output_dir + "/sketch/samples.csv") \
+            if config["precluster_distances"] else [],
     params:
         precluster_distances = config["precluster_distances"],
     threads: 1
@@ -412,9 +720,29 @@ rule provided_distances:
     shell:
         "cp {params.precluster_distances} {output.distance}"
 
+rule update_distances:
+    input:
+        sketch = output_dir + "/sketch/samples.sig.zip",
+        changed = output_dir + "/sketch/changed.sig.zip",
+        digests = output_dir + "/sketch/samples_digests.tsv",
+    output:
+        distance = output_dir + "/sketch/samples.csv" if config["precluster_sketch_cache"] else [],
+    params:
+        sketch_cache = config["precluster_sketch_cache"],
+    threads: 64
+    resources:
+        mem_mb=get_mem_mb,
+        runtime = get_runtime(base_hours = 48),
+    log:
+        logs_dir + "/precluster/distance.log"
+    benchmark:
+        benchmarks_dir + "/precluster/distance.tsv"
+    script:
+        "scripts/update_distances.py"
+
 rule distance_samples:
     input:
-        sketch = output_dir + "/sketch/samples.sig",
+        sketch = output_dir + "/sketch/samples.sig.zip",
     output:
         distance = output_dir + "/sketch/samples.csv"
     threads: 64
@@ -434,10 +762,30 @@ rule distance_samples:
         "-c {threads} "
         "&> {log} "
 
+rule compact_distances:
+    input:
+        distance = output_dir + "/sketch/samples.csv",
+    output:
+        distance = output_dir + "/sketch/samples.dist",
+    params:
+        min_jaccard = 0.01,
+        top_k = config["precluster_size"],
+        samples = config["reads_1"],
+    threads: 1
+    resources:
+        mem_mb=get_mem_mb,
+        runtime = get_runtime(base_hours = 24),
+    log:
+        logs_dir + "/precluster/compact_distances.log"
+    benchmark:
+        benchmarks_dir + "/precluster/compact_distances.tsv"
+    script:
+        "scripts/compact_distances.py"
+
 rule target_elusive:
     input:
         unbinned = output_dir + "/appraise/unbinned.otu_table.tsv",
-        distances = output_dir + "/sketch/samples.csv" if config["kmer_precluster"] else [],
+        distances = output_dir + "/sketch/samples.dist" if config["kmer_precluster"] else [],
     output:
         output_edges = output_dir + "/target/elusive_edges.tsv",
         output_targets = output_dir + "/target/targets.tsv",
@@ -576,6 +924,7 @@ rule qc_reads:
         quality_cutoff = 15,
         unqualified_percent_limit = 40,
         min_length = 70,
+        compression_level = config["intermediate_compression_level"],
     threads: 16
     resources:
         mem_mb=get_mem_mb,
@@ -598,28 +947,71 @@ rule qc_reads:
         "-q {params.quality_cutoff} "
         "-u {params.unqualified_percent_limit} "
         "-l {params.min_length} "
+        "-z {params.compression_level} "
         "&> {log}"
 
-rule collect_genomes:
+checkpoint collect_reference_bins:
     input:
         appraise_binned = output_dir + "/appraise/binned.otu_table.tsv",
         appraise_unbinned = output_dir + "/appraise/unbinned.otu_table.tsv",
     output:
-        temp(output_dir + "/mapping/{read}_reference.fna"),
-    threads: 1
+        manifest = output_dir + "/mapping/reference_bins.tsv",
+    threads: 64
     params:
-        genomes = config["genomes"],
-        sample = "{read}",
+        samples = list(config["reads_1"]),
         min_appraised = config["unmapping_min_appraised"],
+    resources:
+        mem_mb=get_mem_mb,
+        runtime = get_runtime(base_hours = 4),
+    script:
+        "scripts/collect_reference_bins.py"
+
+rule prefix_genome:
+    input:
+        lambda wildcards: config["genomes"][wildcards.genome],
+    output:
+        temp(output_dir + "/mapping/genomes/{genome}.fna"),
+    threads: 1
     localrule: True
     script:
         "scripts/collect_reference_bins.py"
 
+rule collect_genomes:
+    input:
+        get_reference_genomes,
+    output:
+        temp(output_dir + "/mapping/references/{key}.fna"),
+    threads: 1
+    localrule: True
+    shell:
+        "cat /dev/null {input} > {output}"
+
+rule index_reference:
+    input:
+        output_dir + "/mapping/references/{key}.fna",
+    output:
+        temp(output_dir + "/mapping/references/{key}.mmi"),
+    threads: 8
+    resources:
+        mem_mb=get_mem_mb,
+        runtime = get_runtime(base_hours = 4),
+    log:
+        logs_dir + "/mapping/references/{key}_index.log",
+    conda:
+        "env/coverm.yml"
+    shell:
+        "minimap2 "
+        "-x sr "
+        "-t {threads} "
+        "-d {output} "
+        "{input} "
+        "&> {log} "
+
 rule map_reads:
     input:
         reads_1 = lambda wildcards: config["reads_1"][wildcards.read] if not config["run_qc"] else output_dir + "/qc/{read}_1.fastq.gz",
         reads_2 = lambda wildcards: config["reads_2"][wildcards.read] if not config["run_qc"] else output_dir + "/qc/{read}_2.fastq.gz",
-        genomes = output_dir + "/mapping/{read}_reference.fna",
+        genomes = lambda wildcards: output_dir + f"/mapping/references/{get_reference_key(wildcards)}.mmi",
     output:
         dir = temp(directory(output_dir + "/mapping/{read}_coverm")),
     group: "unmapping"
@@ -636,6 +1028,7 @@ rule map_reads:
     shell:
         "coverm make "
         "-r {input.genomes} "
+        "--minimap2-reference-is-index "
         "-1 {input.reads_1} "
         "-2 {input.reads_2} "
         "-o {output.dir} "
@@ -649,7 +1042,6 @@ rule filter_bam_files:
         temp(output_dir + "/mapping/{read}_unmapped.bam"),
     group: "unmapping"
     params:
-        genomes = "{read}_reference.fna",
         reads_1 = lambda wildcards: os.path.basename(config["reads_1"][wildcards.read]) if not config["run_qc"] else wildcards.read + "_1.fastq.gz",
         sequence_identity = config["unmapping_max_identity"],
         alignment_percent = config["unmapping_max_alignment"],
@@ -665,7 +1057,7 @@ rule filter_bam_files:
         "env/coverm.yml"
     shell:
         "coverm filter "
-        "-b {input}/{params.genomes}.{params.reads_1}.bam "
+        "-b {input}/*.{params.reads_1}.bam "
         "-o {output} "
         "--inverse "
         "--min-read-percent-identity-pair {params.sequence_identity} "
@@ -679,7 +1071,13 @@ rule bam_to_fastq:
     output:
         reads_1 = output_dir + "/mapping/{read}_unmapped.1.fq.gz",
         reads_2 = output_dir + "/mapping/{read}_unmapped.2.fq.gz",
+        bases = output_dir + "/mapping/{read}_unmapped.bases",
     group: "unmapping"
+    params:
+        # Deinterleave with Bin Chicken's Python, while samtools comes from the rule environment
+        python = sys.executable,
+        script = workflow.basedir + "/scripts/deinterleave.py",
+        compression_level = config["intermediate_compression_level"],
     threads: 32
     resources:
         mem_mb=get_mem_mb,
@@ -692,17 +1090,88 @@ rule bam_to_fastq:
         "samtools fastq "
         "-@ $(({threads} - 1)) "
         "{input} "
-        "-1 {output.reads_1} "
-        "-2 {output.reads_2} "
         "-0 /dev/null "
         "-s /dev/null "
         "-n "
-        "&> {log} "
+        "2> {log} "
+        "| {params.python} {params.script} "
+        "--input - "
+        "--output-forward {output.reads_1} "
+        "--output-reverse {output.reads_2} "
+        "--output-bases {output.bases} "
+        "--compression-level {params.compression_level} "
+        "--threads {threads} "
+        "--allow-empty "
+        "--strict "
+        "--output /dev/null "
+        "2>> {log}"
+
+rule map_reads_streaming:
+    input:
+        reads_1 = lambda wildcards: config["reads_1"][wildcards.read] if not config["run_qc"] else output_dir + "/qc/{read}_1.fastq.gz",
+        reads_2 = lambda wildcards: config["reads_2"][wildcards.read] if not config["run_qc"] else output_dir + "/qc/{read}_2.fastq.gz",
+        genomes = lambda wildcards: output_dir + f"/mapping/references/{get_reference_key(wildcards)}.mmi",
+    output:
+        reads_1 = output_dir + "/mapping/{read}_unmapped.1.fq.gz" if config["unmapping_streaming"] else [],
+        reads_2 = output_dir + "/mapping/{read}_unmapped.2.fq.gz" if config["unmapping_streaming"] else [],
+        bases = output_dir + "/mapping/{read}_unmapped.bases" if config["unmapping_streaming"] else [],
+    group: "unmapping"
+    params:
+        sequence_identity = config["unmapping_max_identity"],
+        alignment_percent = config["unmapping_max_alignment"],
+        python = sys.executable,
+        script = workflow.basedir + "/scripts/deinterleave.py",
+        compression_level = config["intermediate_compression_level"],
+    threads: 32
+    resources:
+        mem_mb=get_mem_mb,
+        runtime = get_runtime(base_hours = 12),
+    log:
+        logs_dir + "/mapping/{read}_streaming.log",
+    benchmark:
+        benchmarks_dir + "/mapping/{read}_streaming.tsv"
+    conda:
+        "env/coverm.yml"
+    shell:
+        # Unsorted minimap2 output keeps mates adjacent, so pairs are filtered and deinterleaved without BAM files on disk
+        "minimap2 "
+        "-a "
+        "-x sr "
+        "-t {threads} "
+        "{input.genomes} "
+        "{input.reads_1} "
+        "{input.reads_2} "
+        "2> {log} "
+        "| coverm filter "
+        "-b /dev/stdin "
+        "-o /dev/stdout "
+        "--inverse "
+        "--min-read-percent-identity-pair {params.sequence_identity} "
+        "--min-read-aligned-percent-pair {params.alignment_percent} "
+        "--proper-pairs-only "
+        "2>> {log} "
+        "| samtools fastq "
+        "-0 /dev/null "
+        "-s /dev/null "
+        "-n "
+        "- "
+        "2>> {log} "
+        "| {params.python} {params.script} "
+        "--input - "
+        "--output-forward {output.reads_1} "
+        "--output-reverse {output.reads_2} "
+        "--output-bases {output.bases} "
+        "--compression-level {params.compression_level} "
+        "--threads {threads} "
+        "--allow-empty "
+        "--strict "
+        "--output /dev/null "
+        "2>> {log}"
 
 rule finish_mapping:
     input:
-        mapped_reads_1.values(),
-        mapped_reads_2.values(),
+        lambda wildcards: [mapped_reads_1[s] for s in get_coassembly_samples()],
+        lambda wildcards: [mapped_reads_2[s] for s in get_coassembly_samples()],
     output:
         output_dir + "/mapping/done"
     localrule: True
@@ -711,8 +1180,8 @@ rule finish_mapping:
 
 rule finish_qc:
     input:
-        qc_reads_1.values(),
-        qc_reads_2.values(),
+        lambda wildcards: [qc_reads_1[s] for s in get_coassembly_samples()],
+        lambda wildcards: [qc_reads_2[s] for s in get_coassembly_samples()],
     output:
         output_dir + "/qc/done"
     localrule: True
@@ -7,6 +7,7 @@ import os
 import polars as pl
 import logging
 from binchicken.binchicken import SUFFIX_RE
+from binchicken.workflow.scripts.appraise_ipc import scan_appraise
 
 APPRAISE_COLUMNS = {
     "gene": str,
@@ -57,21 +58,32 @@ def pipeline(unbinned, binned, samples=None):
                 )
         )
 
-    gene_sequences = (
-        unbinned
-        .select("gene", "sequence")
-        .unique()
+    # Mean weight over all samples with the gene, computed from observed rows only
+    # Unobserved samples contribute zero weight but count towards the number of samples
+    total_coverage = total_coverage.with_row_index("total_id")
+    samples_per_gene = (
+        total_coverage
+        .group_by("gene")
+        .agg(num_samples = pl.len())
     )
 
     weighted = (
-        total_coverage
-        .join(gene_sequences, on=["gene"])
-        .join(unbinned, on=["sample", "gene", "sequence"], how="full")
-        .filter(pl.col("sample").is_not_null())
-        .with_columns(pl.col("coverage").fill_null(0))
+        unbinned
+        .select("sample", "gene", "sequence", pl.col("coverage").fill_null(0))
+        .join(total_coverage, on=["sample", "gene"], how="inner")
         .with_columns(weight = pl.col("coverage") / pl.col("total_coverage"))
         .group_by("gene", "sequence")
-        .agg(pl.mean("weight"))
+        .agg(
+            weight_sum = pl.sum("weight"),
+            num_observed = pl.len(),
+            num_observed_samples = pl.col("total_id").n_unique(),
+            )
+        .join(samples_per_gene, on="gene")
+        .select(
+            "gene",
+            "sequence",
+            weight = pl.col("weight_sum") / (pl.col("num_samples") + pl.col("num_observed") - pl.col("num_observed_samples")),
+            )
         .filter(pl.col("weight") > 0)
     )
 
@@ -93,8 +105,9 @@ if __name__ == "__main__":
     weighted_path = snakemake.output.weighted
     samples = snakemake.params.samples
 
-    unbinned = pl.read_csv(unbinned_path, separator="\t", schema_overrides=APPRAISE_COLUMNS)
-    binned = pl.read_csv(binned_path, separator="\t", schema_overrides=APPRAISE_COLUMNS)
+    columns = ["gene", "sample", "sequence", "coverage"]
+    unbinned = scan_appraise(unbinned_path, columns=columns, schema_overrides=APPRAISE_COLUMNS).collect()
+    binned = scan_appraise(binned_path, columns=columns, schema_overrides=APPRAISE_COLUMNS).collect()
 
     weighted = pipeline(unbinned, binned, samples)
     weighted.write_csv(weighted_path, separator="\t")
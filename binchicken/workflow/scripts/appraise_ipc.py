@@ -0,0 +1,94 @@
+#######################
+### appraise_ipc.py ###
+#######################
+# Author: Samuel Aroney
+
+import os
+import polars as pl
+import polars.selectors as cs
+import pyarrow as pa
+
+APPRAISE_IPC_SCHEMA = {
+    "gene": pl.Categorical,
+    "sample": pl.Categorical,
+    "sequence": pl.String,
+    "num_hits": pl.Int64,
+    "coverage": pl.Float64,
+    "taxonomy": pl.Categorical,
+    "found_in": pl.String,
+    }
+APPRAISE_IPC_SUFFIX = ".arrow"
+# Rows written per slice of the staged table, bounding memory
+APPRAISE_BATCH_ROWS = 1_000_000
+
+def appraise_ipc_path(otu_table_path):
+    """
+    Arrow IPC copy written alongside an appraise OTU table
+    """
+    return otu_table_path.removesuffix(".tsv") + APPRAISE_IPC_SUFFIX
+
+def has_appraise_ipc(otu_table_path):
+    """
+    Whether the appraise OTU table has an Arrow IPC copy at least as new as itself
+
+    Provided OTU tables replacing a previous run's are older than any copy left behind, so are read as TSV
+    """
+    ipc_path = appraise_ipc_path(otu_table_path)
+    return os.path.exists(ipc_path) and os.path.getmtime(ipc_path) >= os.path.getmtime(otu_table_path)
+
+def sink_appraise(otu_table, otu_table_path, BATCH_ROWS=APPRAISE_BATCH_ROWS):
+    """
+    Stream an appraise OTU table to TSV with its Arrow IPC copy, uncompressed for memory-mapping
+
+    The input is read once, staged as text IPC, then written in slices of BATCH_ROWS rows.
+    IPC files cannot change dictionaries between batches, so dictionary columns use the full set of
+    categories from the staged table, and are written with large string values, as polars 1.2 writes
+    invalid string view dictionaries. The copy is moved into place last, so a partial copy is never read.
+    """
+    ipc_path = appraise_ipc_path(otu_table_path)
+    staged_path = ipc_path + ".staged"
+    otu_table.lazy().sink_ipc(staged_path, compression=None)
+
+    try:
+        staged = pl.scan_ipc(staged_path, memory_map=True)
+        columns = staged.collect_schema().names()
+        num_rows = staged.select(pl.len()).collect().item()
+        schema = {
+            column: pl.Enum(staged.select(pl.col(column).drop_nulls().unique().sort()).collect().to_series())
+                if dtype == pl.Categorical else dtype
+            for column, dtype in APPRAISE_IPC_SCHEMA.items()
+            }
+        arrow_schema = pl.DataFrame(schema=schema).to_arrow(compat_level=pl.CompatLevel.oldest()).schema
+
+        with open(otu_table_path, "wb") as f, pa.ipc.new_file(ipc_path + ".tmp", arrow_schema) as writer:
+            f.write(("\t".join(columns) + "\n").encode())
+            for offset in range(0, num_rows, BATCH_ROWS):
+                batch = staged.slice(offset, BATCH_ROWS).collect()
+                batch.write_csv(f, separator="\t", include_header=False)
+                writer.write_table(
+                    batch.select(schema.keys()).cast(schema).to_arrow(compat_level=pl.CompatLevel.oldest())
+                    )
+    finally:
+        os.remove(staged_path)
+
+    os.replace(ipc_path + ".tmp", ipc_path)
+
+def scan_appraise(otu_table_path, columns=None, schema_overrides=None):
+    """
+    Lazily read an appraise OTU table, memory-mapping its Arrow IPC copy where available
+
+    Categorical columns are returned as strings, matching the OTU table
+    """
+    if has_appraise_ipc(otu_table_path):
+        otu_table = pl.scan_ipc(appraise_ipc_path(otu_table_path), memory_map=True)
+    else:
+        otu_table = pl.scan_csv(otu_table_path, separator="\t", schema_overrides=schema_overrides)
+
+    if columns:
+        otu_table = otu_table.select(columns)
+
+    otu_table = otu_table.with_columns(cs.categorical().cast(pl.String))
+    if schema_overrides:
+        otu_table = otu_table.cast({k: v for k, v in schema_overrides.items() if k in otu_table.collect_schema()})
+
+    return otu_table
@@ -6,8 +6,10 @@
 import polars as pl
 import os
 import numpy as np
-import extern
+import hashlib
+import functools
 from binchicken.binchicken import SUFFIX_RE
+from binchicken.workflow.scripts.appraise_ipc import scan_appraise
 
 def trimmed_mean(data, trim=0.1):
     cut = int(np.floor(len(data) * trim))
@@ -17,92 +19,152 @@ def trimmed_mean(data, trim=0.1):
         a = sorted(data)
         return np.mean(a[cut:-cut])
 
+REFERENCE_BINS_COLUMNS = {
+    "sample": str,
+    "genome": str,
+}
+
 def pipeline(appraise_binned, appraise_unbinned, sample, MIN_APPRAISED=0.1, TRIM_FRACTION=0.1):
+    reference_bins = batch_pipeline(
+        appraise_binned,
+        appraise_unbinned,
+        [sample],
+        MIN_APPRAISED=MIN_APPRAISED,
+        TRIM_FRACTION=TRIM_FRACTION,
+        )
+
+    return set(reference_bins.get_column("genome").to_list())
+
+def batch_pipeline(appraise_binned, appraise_unbinned, samples, MIN_APPRAISED=0.1, TRIM_FRACTION=0.1):
+    """
+    Reference bins for every sample in one grouped pass
+
+    A bin is chosen when the trimmed mean of its coverage over the sample's genes is positive.
+    Genes without the bin have zero coverage and sort first, so the trimmed mean is positive
+    exactly when the bin has positive coverage in more genes than are trimmed from each end.
+    """
     print(f"Polars using {str(pl.thread_pool_size())} threads")
+    samples = list(samples)
+
+    def assign_samples(df):
+        return (
+            df
+            .with_columns(
+                pl.col("sample", "gene", "found_in").cast(str),
+                pl.col("num_hits").cast(int),
+                pl.col("coverage").cast(float),
+                )
+            .with_columns(
+                pl.when(pl.col("sample").is_in(samples))
+                    .then(pl.col("sample"))
+                    .otherwise(pl.col("sample").str.replace(SUFFIX_RE, ""))
+                )
+            .filter(pl.col("sample").is_in(samples))
+        )
+
+    appraise_binned = assign_samples(appraise_binned)
+    appraise_unbinned = assign_samples(appraise_unbinned)
 
-    appraise_binned = (
+    appraised_samples = (
         appraise_binned
-        .with_columns(
-            pl.col("sample").cast(str),
-            sample_remove_suffix = pl.col("sample").str.replace(SUFFIX_RE, ""),
+        .group_by("sample")
+        .agg(num_binned = pl.col("num_hits").sum())
+        .join(
+            appraise_unbinned.group_by("sample").agg(num_unbinned = pl.col("num_hits").sum()),
+            on="sample", how="full", coalesce=True,
             )
-        .filter((pl.col("sample") == sample) | (pl.col("sample_remove_suffix") == sample))
+        .fill_null(0)
+        .filter((pl.col("num_binned") + pl.col("num_unbinned")) > 0)
+        .filter(pl.col("num_binned") / (pl.col("num_binned") + pl.col("num_unbinned")) >= MIN_APPRAISED)
+        .select("sample")
     )
 
-    appraise_unbinned = (
-        appraise_unbinned
-        .with_columns(
-            pl.col("sample").cast(str),
-            sample_remove_suffix = pl.col("sample").str.replace(SUFFIX_RE, ""),
-            )
-        .filter((pl.col("sample") == sample) | (pl.col("sample_remove_suffix") == sample))
+    genes_per_sample = (
+        appraise_binned
+        .group_by("sample")
+        .agg(cut = (pl.col("gene").n_unique() * TRIM_FRACTION).floor().cast(int))
     )
 
-    num_binned = sum(appraise_binned.get_column("num_hits").to_list())
-    num_unbinned = sum(appraise_unbinned.get_column("num_hits").to_list())
-    try:
-        perc_binned = num_binned / (num_binned + num_unbinned)
-    except ZeroDivisionError:
-        return set()
-
-    if perc_binned < MIN_APPRAISED:
-        return set()
-
     reference_bins = (
         appraise_binned
+        .join(appraised_samples, on="sample", how="semi")
         .with_columns(pl.col("found_in").str.split(","))
         .explode("found_in")
         .with_columns(pl.col("found_in").str.replace("_protein$", ""))
-        .group_by(["gene", "found_in"])
+        .group_by(["sample", "gene", "found_in"])
         .agg(pl.col("coverage").sum())
-        .pivot(values="coverage", index="gene", on="found_in", aggregate_function=None)
-        .unpivot(index="gene", variable_name="found_in", value_name="coverage")
-        .fill_null(0)
-        .group_by("found_in")
-        .agg(
-            (pl.col("coverage").len() * TRIM_FRACTION).floor().cast(int).alias("cut"),
-            pl.col("coverage")
-            )
-        .with_columns(
-            pl.col("coverage")
-                .list.sort()
-                .list.slice(pl.col("cut"), pl.col("coverage").list.len() - 2 * pl.col("cut"))
-                .list.mean()
-            )
-        .filter(pl.col("coverage") > 0)
-        .get_column("found_in")
-        .to_list()
+        .group_by(["sample", "found_in"])
+        .agg(num_covered = (pl.col("coverage") > 0).sum())
+        .join(genes_per_sample, on="sample")
+        .filter(pl.col("num_covered") > pl.col("cut"))
+        .select("sample", genome = pl.col("found_in"))
+        .sort(["sample", "genome"])
     )
 
-    return set(reference_bins)
+    return reference_bins
+
+def reference_key(genomes):
+    """
+    Content address for a set of reference genomes, so samples selecting the same set share one reference
+    """
+    return hashlib.sha256("\n".join(sorted(genomes)).encode()).hexdigest()[:16]
+
+@functools.lru_cache(maxsize=4)
+def _load_reference_sets(manifest_path, mtime):
+    sample_genomes = (
+        pl.read_csv(manifest_path, separator="\t", schema_overrides=REFERENCE_BINS_COLUMNS)
+        .group_by("sample")
+        .agg(pl.col("genome").sort())
+    )
+
+    sample_keys = {}
+    key_genomes = {reference_key([]): []}
+    for sample, genomes in sample_genomes.iter_rows():
+        key = reference_key(genomes)
+        sample_keys[sample] = key
+        key_genomes[key] = genomes
+
+    return sample_keys, key_genomes
+
+def load_reference_sets(manifest_path):
+    """
+    Map samples to reference keys, and reference keys to genomes, from the reference bins manifest
+    """
+    return _load_reference_sets(manifest_path, os.path.getmtime(manifest_path))
+
+def prefix_genome(genome_path, bin_name, output_path, CHUNK_SIZE=16 * 1024 * 1024):
+    """
+    Copy genome with headers prefixed by bin name, in bulk chunks
+    """
+    prefix = f">{bin_name}~".encode()
+    with open(genome_path, "rb") as infile, open(output_path, "wb") as outfile:
+        at_line_start = True
+        while chunk := infile.read(CHUNK_SIZE):
+            if at_line_start and chunk.startswith(b">"):
+                chunk = prefix + chunk[1:]
+            outfile.write(chunk.replace(b"\n>", b"\n" + prefix))
+            at_line_start = chunk.endswith(b"\n")
 
 if __name__ == "__main__":
     os.environ["POLARS_MAX_THREADS"] = str(snakemake.threads)
     import polars as pl
 
-    binned_path = snakemake.input.appraise_binned
-    unbinned_path = snakemake.input.appraise_unbinned
-    genomes = snakemake.params.genomes
-    sample = snakemake.params.sample
-    MIN_APPRAISED = snakemake.params.min_appraised
-    sample_read = snakemake.wildcards.read
-    output_path = snakemake.output
-
-    appraise_binned = pl.read_csv(binned_path, separator="\t")
-    appraise_unbinned = pl.read_csv(unbinned_path, separator="\t")
+    if snakemake.rule == "collect_reference_bins":
+        binned_path = snakemake.input.appraise_binned
+        unbinned_path = snakemake.input.appraise_unbinned
+        samples = snakemake.params.samples
+        MIN_APPRAISED = snakemake.params.min_appraised
+        manifest_path = snakemake.output.manifest
 
-    reference_bins = pipeline(appraise_binned, appraise_unbinned, sample, MIN_APPRAISED=MIN_APPRAISED)
+        columns = ["gene", "sample", "num_hits", "coverage", "found_in"]
+        appraise_binned = scan_appraise(binned_path, columns=columns).collect()
+        appraise_unbinned = scan_appraise(unbinned_path, columns=columns).collect()
 
-    if len(reference_bins) == 0:
-        print(f"Warning: No reference bins found for {sample_read}")
-        cmd = f"touch {output_path}"
-        extern.run(cmd)
+        reference_bins = batch_pipeline(appraise_binned, appraise_unbinned, samples, MIN_APPRAISED=MIN_APPRAISED)
+        for sample in set(samples) - set(reference_bins.get_column("sample").to_list()):
+            print(f"Warning: No reference bins found for {sample}")
+        reference_bins.write_csv(manifest_path, separator="\t")
     else:
-        with open(str(output_path), "w") as outfile:
-            for bin in reference_bins:
-                bin_name = os.path.splitext(os.path.basename(genomes[bin]))[0]
-                with open(genomes[bin], "r") as infile:
-                    for line in infile:
-                        if line.startswith(">"):
-                            line = f">{bin_name}~{line[1:]}"
-                        outfile.write(line)
+        genome_path = snakemake.input[0]
+        bin_name = os.path.splitext(os.path.basename(genome_path))[0]
+        prefix_genome(genome_path, bin_name, snakemake.output[0])
@@ -0,0 +1,153 @@
+############################
+### compact_distances.py ###
+############################
+# Author: Samuel Aroney
+
+import polars as pl
+import numpy as np
+import os
+import logging
+from binchicken.binchicken import SUFFIX_RE
+
+# Binary layout: magic, header (n_samples, names_nbytes, n_pairs), newline-separated sample names,
+# padding to 8 bytes, then (query, match, jaccard) triplets indexing into the sample names
+COMPACT_DISTANCES_MAGIC = b"BCDIST01"
+COMPACT_DISTANCES_HEADER = np.dtype([("n_samples", "<u8"), ("names_nbytes", "<u8"), ("n_pairs", "<u8")])
+COMPACT_DISTANCES_DTYPE = np.dtype([("query", "<u4"), ("match", "<u4"), ("jaccard", "<f4")])
+COMPACT_DISTANCES_SUFFIX = ".dist"
+
+def strip_read_suffix(column, samples):
+    """
+    Sample name of a sketch, removing read suffixes unless the name is already a sample
+    """
+    return (
+        pl.when(pl.col(column).is_in(samples))
+            .then(pl.col(column))
+            .otherwise(pl.col(column).str.replace(SUFFIX_RE, ""))
+    )
+
+def index_distances(query_names, match_names):
+    """
+    Map pairwise sample names to a sorted sample dictionary and integer indices
+    """
+    names, inverse = np.unique(np.concatenate([query_names, match_names]), return_inverse=True)
+    inverse = inverse.astype(np.uint32)
+
+    return names, inverse[:len(query_names)], inverse[len(query_names):]
+
+def prune_top_k(query_idx, match_idx, jaccard, TOP_K):
+    """
+    Keep pairs within the top K matches of either sample
+    """
+    num_pairs = len(jaccard)
+    if num_pairs == 0:
+        return np.arange(0)
+
+    source = np.concatenate([query_idx, match_idx])
+    weight = np.concatenate([jaccard, jaccard])
+    pair = np.concatenate([np.arange(num_pairs), np.arange(num_pairs)])
+
+    order = np.lexsort((-weight, source))
+    sorted_source = source[order]
+    rank = np.arange(len(order)) - np.searchsorted(sorted_source, sorted_source, side="left")
+
+    return np.unique(pair[order][rank < TOP_K])
+
+def write_compact_distances(path, names, query_idx, match_idx, jaccard):
+    names_bytes = "\n".join(names).encode()
+    header = np.array([(len(names), len(names_bytes), len(jaccard))], dtype=COMPACT_DISTANCES_HEADER)
+    padding = -(len(COMPACT_DISTANCES_MAGIC) + header.nbytes + len(names_bytes)) % 8
+
+    pairs = np.empty(len(jaccard), dtype=COMPACT_DISTANCES_DTYPE)
+    pairs["query"] = query_idx
+    pairs["match"] = match_idx
+    pairs["jaccard"] = jaccard
+
+    with open(path, "wb") as f:
+        f.write(COMPACT_DISTANCES_MAGIC)
+        f.write(header.tobytes())
+        f.write(names_bytes)
+        f.write(b"\0" * padding)
+        f.write(pairs.tobytes())
+
+def read_compact_distances(path):
+    """
+    Read sample names and memory-map the (query, match, jaccard) triplets
+    """
+    with open(path, "rb") as f:
+        magic = f.read(len(COMPACT_DISTANCES_MAGIC))
+        if magic != COMPACT_DISTANCES_MAGIC:
+            raise ValueError(f"Not a compact distances file: {path}")
+        header = np.frombuffer(f.read(COMPACT_DISTANCES_HEADER.itemsize), dtype=COMPACT_DISTANCES_HEADER)[0]
+        names_bytes = f.read(int(header["names_nbytes"]))
+
+    names = np.array(names_bytes.decode().split("\n") if header["n_samples"] > 0 else [], dtype=object)
+    offset = len(COMPACT_DISTANCES_MAGIC) + COMPACT_DISTANCES_HEADER.itemsize + len(names_bytes)
+    offset += -offset % 8
+
+    if header["n_pairs"] == 0:
+        return names, np.empty(0, dtype=COMPACT_DISTANCES_DTYPE)
+
+    pairs = np.memmap(path, dtype=COMPACT_DISTANCES_DTYPE, mode="r", offset=offset, shape=(int(header["n_pairs"]),))
+    return names, pairs
+
+def pipeline(distances_path, output_path, samples=set(), MIN_JACCARD=0.01, TOP_K=None):
+    """
+    Compact pairwise distances between samples, pruned to the top K matches of each sample
+
+    Read suffixes are stripped before pruning, so pairs merged under one sample name are summed and
+    ranked together, as when clustering from the distances directly.
+    """
+    logging.info(f"Polars using {str(pl.thread_pool_size())} threads")
+
+    sample_distances = (
+        pl.scan_csv(distances_path)
+        .select("query_name", "match_name", "jaccard")
+        .filter(pl.col("jaccard") > MIN_JACCARD)
+        .with_columns(
+            strip_read_suffix("query_name", samples),
+            strip_read_suffix("match_name", samples),
+            )
+        # Self-distances are replaced when clustering
+        .filter(pl.col("query_name") != pl.col("match_name"))
+        .group_by("query_name", "match_name")
+        .agg(pl.col("jaccard").sum())
+        .collect(streaming=True)
+    )
+
+    logging.info(f"Indexing {sample_distances.height} pairwise distances")
+    names, query_idx, match_idx = index_distances(
+        sample_distances.get_column("query_name").to_numpy(),
+        sample_distances.get_column("match_name").to_numpy(),
+        )
+    jaccard = sample_distances.get_column("jaccard").to_numpy().astype(np.float32)
+    del sample_distances
+
+    if TOP_K:
+        logging.info(f"Pruning to top {TOP_K} matches per sample")
+        keep = prune_top_k(query_idx, match_idx, jaccard, TOP_K)
+        query_idx, match_idx, jaccard = query_idx[keep], match_idx[keep], jaccard[keep]
+
+    logging.info(f"Writing {len(jaccard)} distances for {len(names)} samples")
+    write_compact_distances(output_path, names, query_idx, match_idx, jaccard)
+
+    logging.info("Done")
+
+if __name__ == "__main__":
+    os.environ["POLARS_MAX_THREADS"] = str(snakemake.threads)
+    import polars as pl
+
+    logging.basicConfig(
+        filename=snakemake.log[0],
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s: %(message)s',
+        datefmt='%Y/%m/%d %I:%M:%S %p'
+        )
+
+    pipeline(
+        snakemake.input.distance,
+        snakemake.output.distance,
+        samples=set(snakemake.params.samples),
+        MIN_JACCARD=snakemake.params.min_jaccard,
+        TOP_K=snakemake.params.top_k,
+        )
@@ -0,0 +1,299 @@
+#########################
+### count_bp_reads.py ###
+#########################
+# Author: Samuel Aroney
+
+import os
+import json
+import math
+import zlib
+import logging
+import polars as pl
+from concurrent.futures import ThreadPoolExecutor
+from binchicken.workflow.scripts.is_interleaved import open_reads
+
+CHUNK_SIZE = 16 * 1024 * 1024
+SAMPLE_RECORDS = 10000
+NUM_BLOCKS = 8
+BLOCK_SIZE = 4 * 1024 * 1024
+GZIP_MAGIC = b"\x1f\x8b\x08"
+# Two-sided 95% normal quantile
+CONFIDENCE_Z = 1.96
+# Minimum relative half-width of intervals from the first block alone, which cannot show
+# changes in compression ratio or read length along the file
+SINGLE_BLOCK_MIN_ERROR = 0.05
+CACHE_COLUMNS = {
+    "path": str,
+    "size": int,
+    "mtime": int,
+    "bases": int,
+    }
+
+def count_bases(fastq_reads, CHUNK_SIZE=CHUNK_SIZE):
+    """
+    Count sequence characters (second line of each record, excluding newlines)
+    """
+    f, process = open_reads(fastq_reads)
+    bases = 0
+    line_number = 0
+    remainder = b""
+    try:
+        while chunk := f.read(CHUNK_SIZE):
+            lines = (remainder + chunk).split(b"\n")
+            remainder = lines.pop()
+            # Sequence lines are 1 mod 4 from the start of the file
+            bases += sum(map(len, lines[(1 - line_number) % 4::4]))
+            line_number += len(lines)
+    finally:
+        f.close()
+
+    if remainder and line_number % 4 == 1:
+        bases += len(remainder)
+
+    return bases
+
+def sample_block(data, max_records, aligned=True):
+    """
+    Bases and bytes of up to max_records complete records from decompressed data
+
+    Unaligned data (from the middle of a file) is resynchronised to the first record start
+    """
+    lines = data.split(b"\n")
+    # Final line may be partial
+    lines.pop()
+
+    start = 0
+    if not aligned:
+        # Quality lines may start with @, so also check the separator and sequence/quality lengths
+        start = next((
+            i for i in range(min(len(lines) - 3, 8))
+            if lines[i].startswith(b"@") and lines[i + 2].startswith(b"+") and len(lines[i + 1]) == len(lines[i + 3])
+            ), None)
+        if start is None:
+            return []
+
+    records = lines[start:start + min((len(lines) - start) // 4, max_records) * 4]
+    return [
+        (len(records[i + 1]), sum(map(len, records[i:i + 4])) + 4)
+        for i in range(0, len(records), 4)
+        ]
+
+def read_gzip_block(f, offset, BLOCK_SIZE=BLOCK_SIZE):
+    """
+    Decompress up to BLOCK_SIZE bytes from the first gzip member starting at or after offset
+
+    Returns decompressed data and the compressed bytes consumed, or None if no member is found.
+    Single-member gzip files only have a member at the start.
+    """
+    f.seek(offset)
+    window = f.read(BLOCK_SIZE)
+    candidates = [0] if offset == 0 else []
+    position = window.find(GZIP_MAGIC, 1 if offset == 0 else 0)
+    while position != -1 and len(candidates) < 16:
+        candidates.append(position)
+        position = window.find(GZIP_MAGIC, position + 1)
+
+    for candidate in candidates:
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        f.seek(offset + candidate)
+        data = b""
+        fed = 0
+        try:
+            while len(data) < BLOCK_SIZE and not decompressor.eof:
+                chunk = f.read(64 * 1024)
+                if not chunk:
+                    break
+                fed += len(chunk)
+                data += decompressor.decompress(chunk)
+        except zlib.error:
+            continue
+
+        if data.startswith(b"@") or offset > 0:
+            return data, fed - len(decompressor.unused_data) - len(decompressor.unconsumed_tail)
+
+    return None
+
+def estimate_bases(fastq_reads, SAMPLE_RECORDS=SAMPLE_RECORDS, NUM_BLOCKS=NUM_BLOCKS, BLOCK_SIZE=BLOCK_SIZE):
+    """
+    Estimate sequence bases from records sampled at the start and interior of the file
+
+    Bases per (compressed) file byte is measured in each sampled block and scaled by file size.
+    Returns the estimate and a 95% confidence interval. Blocks that cannot be sampled (e.g. the
+    interior of single-member gzip files) are skipped. If only the first block remains, the interval
+    comes from groups of records within it, widened to the spread of a single group and at least
+    SINGLE_BLOCK_MIN_ERROR, as one contiguous block cannot show variation along the file.
+    """
+    file_size = os.path.getsize(fastq_reads)
+    if file_size == 0:
+        return 0, 0, 0
+
+    compressed = fastq_reads.endswith(".gz")
+    records_per_block = max(1, SAMPLE_RECORDS // NUM_BLOCKS)
+    blocks = []
+    with open(fastq_reads, "rb") as f:
+        for i in range(NUM_BLOCKS):
+            offset = file_size * i // NUM_BLOCKS
+            # The first block may be the only one sampled, so it takes the full sample
+            max_records = SAMPLE_RECORDS if i == 0 else records_per_block
+            if compressed:
+                block = read_gzip_block(f, offset, BLOCK_SIZE=BLOCK_SIZE)
+                if block is None:
+                    continue
+                data, consumed = block
+                records = sample_block(data, max_records, aligned=(i == 0))
+                scale = len(data) / consumed if consumed else 0
+            else:
+                f.seek(offset)
+                data = f.read(BLOCK_SIZE)
+                records = sample_block(data, max_records, aligned=(i == 0))
+                scale = 1
+
+            if records:
+                blocks.append((records, scale))
+
+    if not blocks:
+        return 0, 0, 0
+
+    single_block = len(blocks) == 1
+    if single_block:
+        logging.warning(f"Only the start of {fastq_reads} could be sampled, so its estimate may not reflect the whole file")
+        # Split the only block into groups of records
+        records, scale = blocks[0]
+        group_size = max(1, math.ceil(len(records) / NUM_BLOCKS))
+        blocks = [(records[i:i + group_size], scale) for i in range(0, len(records), group_size)]
+
+    ratios = [
+        sum(b for b, _ in records) / sum(n for _, n in records) * scale
+        for records, scale in blocks
+        ]
+    mean = sum(ratios) / len(ratios)
+    if len(ratios) > 1:
+        sd = math.sqrt(sum((r - mean) ** 2 for r in ratios) / (len(ratios) - 1))
+        # Groups within one block are not independent samples of the file
+        half_width = CONFIDENCE_Z * sd if single_block else CONFIDENCE_Z * sd / math.sqrt(len(ratios))
+    else:
+        half_width = mean
+    if single_block:
+        half_width = max(half_width, SINGLE_BLOCK_MIN_ERROR * mean)
+
+    estimate = mean * file_size
+    return round(estimate), max(0, round(estimate - half_width * file_size)), round(estimate + half_width * file_size)
+
+def file_key(path):
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    return path, stat.st_size, stat.st_mtime_ns
+
+def load_cache(cache_path):
+    if not cache_path or not os.path.isfile(cache_path):
+        return pl.DataFrame(schema=CACHE_COLUMNS)
+
+    return pl.read_csv(cache_path, separator="\t", schema_overrides=CACHE_COLUMNS)
+
+def pipeline(names, reads_1, reads_2, cache=None, ESTIMATE=False, threads=1, CHUNK_SIZE=CHUNK_SIZE):
+    """
+    Count bases for each sample's paired reads, reusing cached counts for unchanged read files
+
+    Returns read sizes (sample, bases) and the updated cache. With ESTIMATE, uncached files are
+    estimated from sampled records instead, read sizes gain 95% interval columns (lower, upper),
+    and estimates are not added to the cache.
+    """
+    if cache is None:
+        cache = pl.DataFrame(schema=CACHE_COLUMNS)
+
+    cached = {(p, s, m): b for p, s, m, b in cache.iter_rows()}
+    keys = {path: file_key(path) for path in set(reads_1) | set(reads_2)}
+    uncached = sorted(path for path, key in keys.items() if key not in cached)
+    if ESTIMATE:
+        logging.info(f"Estimating {len(uncached)} read files, reusing {len(keys) - len(uncached)} cached counts")
+    else:
+        logging.info(f"Counting {len(uncached)} read files, reusing {len(keys) - len(uncached)} cached counts")
+
+    # (bases, lower, upper) for each file, with exact counts having no interval
+    sizes = {key: (bases, bases, bases) for key, bases in cached.items()}
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        if ESTIMATE:
+            estimates = executor.map(estimate_bases, uncached)
+            for path, estimate in zip(uncached, estimates):
+                sizes[keys[path]] = estimate
+        else:
+            counts = executor.map(lambda path: count_bases(path, CHUNK_SIZE=CHUNK_SIZE), uncached)
+            for path, bases in zip(uncached, counts):
+                cached[keys[path]] = bases
+                sizes[keys[path]] = (bases, bases, bases)
+
+    read_size = pl.DataFrame({
+        "sample": names,
+        "bases": [sizes[keys[r1]][0] + sizes[keys[r2]][0] for r1, r2 in zip(reads_1, reads_2)],
+        "lower": [sizes[keys[r1]][1] + sizes[keys[r2]][1] for r1, r2 in zip(reads_1, reads_2)],
+        "upper": [sizes[keys[r1]][2] + sizes[keys[r2]][2] for r1, r2 in zip(reads_1, reads_2)],
+        }, schema={"sample": str, "bases": int, "lower": int, "upper": int})
+    if not ESTIMATE:
+        read_size = read_size.select("sample", "bases")
+
+    # Keep prior entries for other files so the cache can be shared across runs
+    updated_cache = pl.DataFrame(
+        [[p, s, m, b] for (p, s, m), b in cached.items()],
+        orient="row",
+        schema=CACHE_COLUMNS,
+        ).unique(subset=["path"], keep="last", maintain_order=True)
+
+    return read_size, updated_cache
+
+def fastp_bases(json_path):
+    """
+    Bases remaining after fastp filtering, for both reads of the pair
+    """
+    with open(json_path) as f:
+        return json.load(f)["summary"]["after_filtering"]["total_bases"]
+
+def harvest_read_size(paths, names=None):
+    """
+    Read sizes from fastp reports ({read}.json) or base counts written while producing the reads ({read}_unmapped.bases)
+    """
+    if names is None:
+        names = [os.path.basename(path).removesuffix(".json").removesuffix("_unmapped.bases") for path in paths]
+
+    bases = []
+    for path in paths:
+        if path.endswith(".json"):
+            bases.append(fastp_bases(path))
+        else:
+            with open(path) as f:
+                bases.append(int(f.read().strip()))
+
+    return pl.DataFrame({"sample": names, "bases": bases}, schema={"sample": str, "bases": int})
+
+if __name__ == "__main__":
+    os.environ["POLARS_MAX_THREADS"] = str(snakemake.threads)
+    import polars as pl
+
+    logging.basicConfig(
+        filename=snakemake.log[0],
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s: %(message)s',
+        datefmt='%Y/%m/%d %I:%M:%S %p'
+        )
+
+    if snakemake.rule == "harvest_read_size":
+        read_size = harvest_read_size(snakemake.input.sizes)
+    else:
+        read_size, updated_cache = pipeline(
+            snakemake.params.names,
+            snakemake.input.reads_1,
+            snakemake.input.reads_2,
+            cache=load_cache(snakemake.params.cache),
+            ESTIMATE=snakemake.params.estimate,
+            threads=snakemake.threads,
+            )
+        updated_cache.write_csv(snakemake.params.cache_output + ".tmp", separator="\t")
+        os.replace(snakemake.params.cache_output + ".tmp", snakemake.params.cache_output)
+
+        if snakemake.params.estimate:
+            total, lower, upper = read_size.select("bases", "lower", "upper").sum().row(0)
+            logging.info(f"Estimated {total} total bases (95% CI {lower}-{upper})")
+            read_size.write_csv(snakemake.params.estimate_output, separator="\t")
+
+    read_size.select("sample", "bases").write_csv(snakemake.output.read_size, include_header=False)
+
+    logging.info("Done")
@@ -0,0 +1,211 @@
+#######################
+### deinterleave.py ###
+#######################
+# Author: Samuel Aroney
+
+import os
+import sys
+import argparse
+import logging
+import gzip
+import shutil
+import subprocess
+from itertools import chain
+from binchicken.workflow.scripts.is_interleaved import open_reads
+
+CHUNK_SIZE = 16 * 1024 * 1024
+LINES_PER_PAIR = 8
+
+class Compressor:
+    """
+    Gzip writer, compressing with pigz where available
+    """
+    def __init__(self, path, level, threads):
+        self.path = path
+        if shutil.which("pigz"):
+            self.output = open(path, "wb")
+            self.process = subprocess.Popen(["pigz", f"-{level}", "-p", str(threads), "-c"], stdin=subprocess.PIPE, stdout=self.output)
+            self.f = self.process.stdin
+        else:
+            self.output = None
+            self.process = None
+            self.f = gzip.open(path, "wb", compresslevel=level)
+
+    def write(self, data):
+        self.f.write(data)
+
+    def close(self):
+        self.f.close()
+        if self.process is not None:
+            returncode = self.process.wait()
+            self.output.close()
+            if returncode != 0:
+                raise Exception(f"Compression of {self.path} failed")
+
+    def abort(self):
+        try:
+            self.close()
+        except (Exception, BrokenPipeError):
+            pass
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def read_metadata(header):
+    """
+    Header text after the read name (matching is_interleaved READ_METADATA_REGEX)
+    """
+    _, space, metadata = header.rstrip(b"\r").partition(b" ")
+    return space + metadata
+
+def count_bases(lines):
+    """
+    Sequence characters in complete records
+    """
+    return sum(map(len, lines[1::4]))
+
+def split_pairs(lines):
+    """
+    Split complete interleaved records into forward and reverse text
+
+    Returns index of the first mismatched pair, or None
+    """
+    forward_headers = lines[0::LINES_PER_PAIR]
+    reverse_headers = lines[4::LINES_PER_PAIR]
+    for i, (f, r) in enumerate(zip(forward_headers, reverse_headers)):
+        if read_metadata(f) != read_metadata(r):
+            return None, None, i
+
+    forward = b"\n".join(chain.from_iterable(zip(*[lines[i::LINES_PER_PAIR] for i in range(4)])))
+    reverse = b"\n".join(chain.from_iterable(zip(*[lines[i::LINES_PER_PAIR] for i in range(4, 8)])))
+    return forward + b"\n", reverse + b"\n", None
+
+def pipeline(fastq_reads, output_forward, output_reverse, output_bases=None, COMPRESSION_LEVEL=6, ALLOW_EMPTY=False, threads=1, CHUNK_SIZE=CHUNK_SIZE):
+    """
+    Deinterleave reads in a single streaming pass, aborting at the first mismatched pair
+
+    Returns (outcome, reason) as in is_interleaved. On failure, no outputs are left behind.
+    On success, total sequence bases are written to output_bases if given.
+    """
+    f, process = open_reads(fastq_reads, threads)
+    compress_threads = max(1, threads // 2)
+    forward_out = Compressor(output_forward, COMPRESSION_LEVEL, compress_threads)
+    reverse_out = Compressor(output_reverse, COMPRESSION_LEVEL, compress_threads)
+
+    remainder = b""
+    pair_count = 0
+    bases = 0
+    outcome, reason = True, "Duplicate read names in consecutive reads with even readcount"
+    # Decompression status is only meaningful once the stream has been read to the end
+    read_to_end = False
+    aborted = False
+    try:
+        while chunk := f.read(CHUNK_SIZE):
+            lines = (remainder + chunk).split(b"\n")
+            complete = (len(lines) - 1) // LINES_PER_PAIR * LINES_PER_PAIR
+            remainder = b"\n".join(lines[complete:])
+
+            if complete == 0:
+                continue
+
+            forward, reverse, mismatch = split_pairs(lines[:complete])
+            if mismatch is not None:
+                outcome, reason = False, f"Consecutive reads do not match (read pair {pair_count + mismatch + 1})"
+                break
+
+            forward_out.write(forward)
+            reverse_out.write(reverse)
+            pair_count += complete // LINES_PER_PAIR
+            bases += count_bases(lines[:complete])
+        else:
+            read_to_end = True
+            trailing = [l for l in remainder.split(b"\n") if l]
+            if trailing:
+                # A final record without newline completes a pair
+                if len(trailing) == LINES_PER_PAIR:
+                    forward, reverse, mismatch = split_pairs(trailing)
+                    if mismatch is not None:
+                        outcome, reason = False, f"Consecutive reads do not match (read pair {pair_count + 1})"
+                    else:
+                        forward_out.write(forward)
+                        reverse_out.write(reverse)
+                        pair_count += 1
+                        bases += count_bases(trailing)
+                else:
+                    outcome, reason = False, "Odd readcount"
+            elif pair_count == 0 and not ALLOW_EMPTY:
+                outcome, reason = False, "Empty file"
+    except BaseException:
+        aborted = True
+        forward_out.abort()
+        reverse_out.abort()
+        raise
+    finally:
+        f.close()
+        if process is not None:
+            if not read_to_end:
+                process.kill()
+            # A truncated or corrupt input must not be committed as complete outputs
+            if process.wait() != 0 and read_to_end and not aborted:
+                forward_out.abort()
+                reverse_out.abort()
+                raise Exception(f"Decompression of {fastq_reads} failed")
+
+    if not outcome:
+        forward_out.abort()
+        reverse_out.abort()
+        return outcome, reason
+
+    forward_out.close()
+    reverse_out.close()
+    logging.info(f"Deinterleaved {pair_count} read pairs with {bases} bases")
+
+    if output_bases:
+        with open(output_bases, "w") as f:
+            f.write(f"{bases}\n")
+
+    return outcome, reason
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--debug", help="output debug information", action="store_true")
+    parser.add_argument("--quiet", help="only output errors", action="store_true")
+
+    parser.add_argument("--input", help="Input interleaved fastq file (can be gzipped)")
+    parser.add_argument("--output-forward", help="Output gzipped forward reads")
+    parser.add_argument("--output-reverse", help="Output gzipped reverse reads")
+    parser.add_argument("--output-bases", help="Output file for total sequence bases")
+    parser.add_argument("--output", type=argparse.FileType("w"), default=sys.stdout, help="Output file")
+
+    parser.add_argument("--compression-level", type=int, default=6, help="Gzip compression level of outputs")
+    parser.add_argument("--allow-empty", action="store_true", help="Write empty outputs for empty input")
+    parser.add_argument("--strict", action="store_true", help="Exit with an error if reads are not interleaved")
+    parser.add_argument("--threads", type=int, default=1, help="Number of threads to use")
+
+    args = parser.parse_args(arguments)
+
+    # Setup logging
+    if args.debug:
+        loglevel = logging.DEBUG
+    elif args.quiet:
+        loglevel = logging.ERROR
+    else:
+        loglevel = logging.INFO
+    logging.basicConfig(level=loglevel, format="%(asctime)s %(levelname)s: %(message)s", datefmt="%Y/%m/%d %I:%M:%S %p")
+
+    output_outcome, output_reason = pipeline(
+        args.input,
+        args.output_forward,
+        args.output_reverse,
+        output_bases=args.output_bases,
+        COMPRESSION_LEVEL=args.compression_level,
+        ALLOW_EMPTY=args.allow_empty,
+        threads=args.threads,
+        )
+
+    args.output.write(f"{output_outcome}\t{output_reason}\n")
+    if args.strict and not output_outcome:
+        logging.error(f"Reads from {args.input} are not interleaved: {output_reason}")
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
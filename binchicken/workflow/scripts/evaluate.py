@@ -5,6 +5,7 @@
 
 import polars as pl
 import os
+from binchicken.workflow.scripts.appraise_ipc import scan_appraise
 
 SINGLEM_COLUMNS = {
     "gene": str,
@@ -338,7 +339,7 @@ if __name__ == "__main__":
     summary_stats_path = snakemake.output.summary_stats
 
     target_otu_table = pl.read_csv(target_path, separator="\t", schema_overrides=TARGET_COLUMNS)
-    binned_otu_table = pl.read_csv(binned_path, separator="\t", schema_overrides=APPRAISE_COLUMNS)
+    binned_otu_table = scan_appraise(binned_path, schema_overrides=APPRAISE_COLUMNS).collect()
     elusive_clusters = pl.read_csv(elusive_clusters_path, separator="\t", schema_overrides=CLUSTER_COLUMNS)
     elusive_edges = pl.read_csv(elusive_edges_path, separator="\t", schema_overrides=EDGE_COLUMNS)
     recovered_otu_table = pl.read_csv(recovered_otu_table_path, separator="\t", schema_overrides=SINGLEM_COLUMNS)
@@ -1,6 +1,6 @@
-###########################
-### query_processing.py ###
-###########################
+#########################
+### is_interleaved.py ###
+#########################
 # Author: Samuel Aroney
 
 import os
@@ -8,12 +8,16 @@ import sys
 import argparse
 import logging
 import gzip
+import shutil
+import subprocess
+from collections import deque
 import polars as pl
 
 READS_COLUMNS={
     "read": str,
     "number": int,
     }
+CHUNK_SIZE = 16 * 1024 * 1024
 
 def is_interleaved(reads, total_count):
     """
@@ -42,35 +46,107 @@ def is_interleaved(reads, total_count):
 
     return True, "Duplicate read names in consecutive reads with even readcount"
 
-def pipeline(fastq_reads, START_CHECK_PAIRS, END_CHECK_PAIRS):
-    start_list = []
-    end_list = []
-    read_count = 0
+def open_reads(fastq_reads, threads=1):
+    """
+    Open reads as a binary stream, decompressing with pigz where available
+    """
+    if fastq_reads == "-":
+        return sys.stdin.buffer, None
 
-    if fastq_reads.endswith(".gz"):
-        f = gzip.open(fastq_reads, "rt")
-    else:
-        f = open(fastq_reads)
+    if not fastq_reads.endswith(".gz"):
+        return open(fastq_reads, "rb"), None
 
-    for line_count, line in enumerate(f):
-        if line_count % 4 != 0:
-            continue
+    if threads > 1 and shutil.which("pigz"):
+        process = subprocess.Popen(["pigz", "-dc", "-p", str(threads), fastq_reads], stdout=subprocess.PIPE)
+        return process.stdout, process
 
-        read_count += 1
-        if len(start_list) < START_CHECK_PAIRS * 2:
-            start_list.append([line.strip(), read_count])
+    return gzip.open(fastq_reads, "rb"), None
 
-        end_list.append([line.strip(), read_count])
-        if len(end_list) > END_CHECK_PAIRS * 2:
-            end_list.pop(0)
+def split_lines(buffer):
+    lines = buffer.split(b"\n")
+    if lines[-1] == b"":
+        lines.pop()
+    return lines
 
-    f.close()
+def read_tail(f, file_size, num_lines):
+    """
+    Read at least the last num_lines lines of an uncompressed file by seeking backwards from the end
+    """
+    block_size = 64 * 1024
+    while True:
+        offset = max(0, file_size - block_size)
+        f.seek(offset)
+        tail = f.read(file_size - offset)
+        if offset == 0 or tail.count(b"\n") > num_lines:
+            return tail
+        block_size *= 2
+
+def pipeline(fastq_reads, START_CHECK_PAIRS, END_CHECK_PAIRS, threads=1, CHUNK_SIZE=CHUNK_SIZE):
+    """
+    Count reads with binary chunk scans, keeping the header lines from the first and last pairs
+    """
+    start_lines = START_CHECK_PAIRS * 2 * 4
+    end_lines = END_CHECK_PAIRS * 2 * 4
+
+    compressed = fastq_reads.endswith(".gz")
+    f, process = open_reads(fastq_reads, threads)
+    head = b""
+    head_newlines = 0
+    tail_chunks = deque()
+    tail_newlines = 0
+    newline_count = 0
+    last_byte = b""
 
     try:
-        line_count
-    except UnboundLocalError:
+        while chunk := f.read(CHUNK_SIZE):
+            chunk_newlines = chunk.count(b"\n")
+            newline_count += chunk_newlines
+            last_byte = chunk[-1:]
+
+            if head_newlines <= start_lines:
+                head += chunk
+                head_newlines += chunk_newlines
+
+            if not compressed:
+                continue
+
+            # Keep only enough trailing chunks to cover the final reads
+            tail_chunks.append(chunk)
+            tail_newlines += chunk_newlines
+            while len(tail_chunks) > 1 and tail_newlines - tail_chunks[0].count(b"\n") > end_lines:
+                tail_newlines -= tail_chunks.popleft().count(b"\n")
+
+        if compressed:
+            tail = b"".join(tail_chunks)
+        else:
+            tail = read_tail(f, f.tell(), end_lines)
+    finally:
+        f.close()
+        if process is not None and process.wait() != 0:
+            raise Exception(f"Decompression of {fastq_reads} failed")
+
+    if not last_byte:
         return False, "Empty file"
 
+    line_count = newline_count + (last_byte != b"\n")
+    read_count = (line_count + 3) // 4
+
+    start_list = [
+        [line.decode().strip(), i // 4 + 1]
+        for i, line in enumerate(split_lines(head)[:start_lines])
+        if i % 4 == 0
+        ][:START_CHECK_PAIRS * 2]
+
+    tail_lines = split_lines(tail)
+    # The first tail line may be partial, but the final headers lie within the last end_lines lines
+    tail_lines = tail_lines[-min(len(tail_lines), line_count, end_lines):]
+    first_index = line_count - len(tail_lines)
+    end_list = [
+        [line.decode().strip(), (first_index + i) // 4 + 1]
+        for i, line in enumerate(tail_lines)
+        if (first_index + i) % 4 == 0
+        ][-END_CHECK_PAIRS * 2:] if END_CHECK_PAIRS > 0 else []
+
     reads = pl.DataFrame(start_list + end_list, orient="row", schema=READS_COLUMNS)
 
     return is_interleaved(reads, read_count)
@@ -102,7 +178,7 @@ def main(arguments):
     import polars as pl
     logging.info(f"Polars using {str(pl.thread_pool_size())} threads")
 
-    output_outcome, output_reason = pipeline(args.input, args.start_check_pairs, args.end_check_pairs)
+    output_outcome, output_reason = pipeline(args.input, args.start_check_pairs, args.end_check_pairs, threads=args.threads)
 
     args.output.write(f"{output_outcome}\t{output_reason}\n")
 
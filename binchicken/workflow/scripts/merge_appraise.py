@@ -0,0 +1,57 @@
+#########################
+### merge_appraise.py ###
+#########################
+# Author: Samuel Aroney
+
+import os
+import logging
+import polars as pl
+from binchicken.workflow.scripts.appraise_ipc import sink_appraise
+
+BAD_PACKAGE = "S3.18.EIF_2_alpha"
+
+def merge_tables(tables, output, BAD_PACKAGE=BAD_PACKAGE):
+    """
+    Concatenate appraise OTU tables as text, excluding the bad package, with bounded memory
+
+    Tables are read once, writing a typed Arrow IPC copy alongside for downstream scripts
+    """
+    sink_appraise(
+        pl.concat([pl.scan_csv(table, separator="\t", infer_schema_length=0) for table in tables])
+        .filter(pl.col("gene") != BAD_PACKAGE),
+        output,
+        )
+
+def pipeline(unbinned_tables, binned_tables, output_unbinned, output_binned, BAD_PACKAGE=BAD_PACKAGE):
+    logging.info(f"Polars using {str(pl.thread_pool_size())} threads")
+
+    logging.info(f"Merging {len(unbinned_tables)} unbinned appraise shards")
+    merge_tables(unbinned_tables, output_unbinned, BAD_PACKAGE=BAD_PACKAGE)
+
+    logging.info(f"Merging {len(binned_tables)} binned appraise shards")
+    merge_tables(binned_tables, output_binned, BAD_PACKAGE=BAD_PACKAGE)
+
+    logging.info("Done")
+
+if __name__ == "__main__":
+    os.environ["POLARS_MAX_THREADS"] = str(snakemake.threads)
+    import polars as pl
+
+    logging.basicConfig(
+        filename=snakemake.log[0],
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s: %(message)s',
+        datefmt='%Y/%m/%d %I:%M:%S %p'
+        )
+
+    # Single tables when filtering, shards when merging
+    unbinned_tables = snakemake.input.unbinned
+    binned_tables = snakemake.input.binned
+
+    pipeline(
+        [unbinned_tables] if isinstance(unbinned_tables, str) else list(unbinned_tables),
+        [binned_tables] if isinstance(binned_tables, str) else list(binned_tables),
+        snakemake.output.unbinned,
+        snakemake.output.binned,
+        BAD_PACKAGE=snakemake.params.bad_package,
+        )
@@ -0,0 +1,106 @@
+###########################
+### merge_otu_tables.py ###
+###########################
+# Author: Samuel Aroney
+
+import os
+import json
+import logging
+import polars as pl
+
+OTU_TABLE_COLUMNS = ["gene", "sample", "sequence", "num_hits", "coverage", "taxonomy"]
+# Tables scanned together, bounding memory and open files
+FILES_PER_CHUNK = 1000
+
+def read_target_domains(metapackage):
+    """
+    Target domains of each package in a SingleM metapackage, keyed by gene
+
+    Packages without target domains (older package versions) are omitted, so all their hits are kept
+    """
+    with open(os.path.join(metapackage, "CONTENTS.json")) as f:
+        packages = json.load(f)["singlem_packages"]
+
+    target_domains = {}
+    for package in packages:
+        with open(os.path.join(metapackage, package, "CONTENTS.json")) as f:
+            package_domains = json.load(f).get("target_domains")
+        if package_domains is not None:
+            target_domains[os.path.basename(package).removesuffix(".spkg")] = package_domains
+
+    return target_domains
+
+def exclude_off_target_hits(otu_table, target_domains):
+    """
+    Drop hits assigned to a domain outside their package's target domains, as SingleM summarise does
+
+    Hits without domain-level taxonomy, or from genes outside the metapackage, are kept
+    """
+    targets = pl.LazyFrame(
+        {"gene": list(target_domains), "target_domains": list(target_domains.values())},
+        schema={"gene": str, "target_domains": pl.List(str)},
+        )
+
+    return (
+        otu_table
+        .join(targets, on="gene", how="left")
+        .with_columns(
+            domain = pl.col("taxonomy").str.split("; ").list.get(1, null_on_oob=True).str.strip_prefix("d__"),
+            )
+        .filter(
+            pl.col("target_domains").is_null()
+            | pl.col("domain").is_null()
+            | pl.col("target_domains").list.contains(pl.col("domain"))
+            )
+        .select(OTU_TABLE_COLUMNS)
+    )
+
+def merge_otu_tables(tables, output, target_domains=None, FILES_PER_CHUNK=FILES_PER_CHUNK):
+    """
+    Concatenate OTU tables as text in chunks of files, writing a single header
+    """
+    num_rows = 0
+    with open(output, "wb") as f:
+        f.write(("\t".join(OTU_TABLE_COLUMNS) + "\n").encode())
+        for i in range(0, len(tables), FILES_PER_CHUNK):
+            chunk = (
+                pl.scan_csv(tables[i:i + FILES_PER_CHUNK], separator="\t", infer_schema_length=0)
+                .select(OTU_TABLE_COLUMNS)
+            )
+            if target_domains is not None:
+                chunk = exclude_off_target_hits(chunk, target_domains)
+            chunk = chunk.collect()
+
+            chunk.write_csv(f, separator="\t", include_header=False)
+            num_rows += chunk.height
+
+    return num_rows
+
+def pipeline(tables, output, metapackage=None, FILES_PER_CHUNK=FILES_PER_CHUNK):
+    logging.info(f"Polars using {str(pl.thread_pool_size())} threads")
+
+    target_domains = read_target_domains(metapackage) if metapackage else None
+    if target_domains is not None:
+        logging.info(f"Excluding off-target hits for {len(target_domains)} packages")
+
+    logging.info(f"Merging {len(tables)} OTU tables")
+    num_rows = merge_otu_tables(tables, output, target_domains=target_domains, FILES_PER_CHUNK=FILES_PER_CHUNK)
+    logging.info(f"Wrote {num_rows} OTUs")
+
+if __name__ == "__main__":
+    os.environ["POLARS_MAX_THREADS"] = str(snakemake.threads)
+    import polars as pl
+
+    logging.basicConfig(
+        filename=snakemake.log[0],
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s: %(message)s',
+        datefmt='%Y/%m/%d %I:%M:%S %p'
+        )
+
+    pipeline(
+        list(snakemake.input),
+        snakemake.output[0],
+        metapackage=snakemake.params.singlem_metapackage,
+        )
+    logging.info("Done")
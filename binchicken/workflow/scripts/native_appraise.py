@@ -0,0 +1,276 @@
+##########################
+### native_appraise.py ###
+##########################
+# Author: Samuel Aroney
+
+import os
+import math
+import logging
+import numpy as np
+import polars as pl
+from concurrent.futures import ThreadPoolExecutor
+
+OUTPUT_COLUMNS = ["gene", "sample", "sequence", "num_hits", "coverage", "taxonomy", "found_in"]
+
+# 2-bit codes for ACGT, with other characters (gaps, N) flagged for exact comparison
+OTHER_CODE = 255
+BASE_CODES = np.full(256, OTHER_CODE, dtype=np.uint8)
+for i, bases in enumerate(["Aa", "Cc", "Gg", "Tt"]):
+    for base in bases:
+        BASE_CODES[ord(base)] = i
+
+BASES_PER_WORD = 32
+LOW_BITS = np.uint64(0x5555555555555555)
+# Candidate pairs joined and verified at once, bounding memory for low-complexity seeds
+CANDIDATE_CHUNK_SIZE = 1 << 20
+
+def popcount(x):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x)
+    return np.unpackbits(x.view(np.uint8).reshape(x.shape + (8,)), axis=-1).sum(axis=-1)
+
+def encode_windows(sequences, width):
+    """
+    Raw bytes and base codes of windows, padded with gaps to width
+
+    Returns raw (n, width), codes (n, width) with other characters as 0, and whether each window has other characters
+    """
+    raw = np.frombuffer("".join(s.ljust(width, "-") for s in sequences).encode(), dtype=np.uint8).reshape(len(sequences), width)
+    codes = BASE_CODES[raw]
+    other = codes == OTHER_CODE
+    codes[other] = 0
+    return raw, codes, other.any(axis=1)
+
+def pack_codes(codes):
+    """
+    Pack base codes into 2-bit uint64 words
+    """
+    n, width = codes.shape
+    words = -(-width // BASES_PER_WORD)
+    padded = np.zeros((n, words * BASES_PER_WORD), dtype=np.uint64)
+    padded[:, :width] = codes
+    shifts = (2 * np.arange(BASES_PER_WORD)).astype(np.uint64)
+    return (padded.reshape(n, words, BASES_PER_WORD) << shifts).sum(axis=2, dtype=np.uint64)
+
+def block_bounds(width, MAX_DIVERGENCE):
+    """
+    Seed blocks such that windows within MAX_DIVERGENCE share at least one identical block (pigeonhole)
+    """
+    num_blocks = min(width, max(MAX_DIVERGENCE + 1, -(-width // BASES_PER_WORD)))
+    return np.linspace(0, width, num_blocks + 1).astype(int)
+
+def block_keys(codes, bounds):
+    """
+    Integer key of each block, as (block, window) arrays flattened block-major
+    """
+    keys = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        shifts = (2 * np.arange(end - start)).astype(np.uint64)
+        keys.append((codes[:, start:end].astype(np.uint64) << shifts).sum(axis=1, dtype=np.uint64))
+    return np.concatenate(keys) if keys else np.empty(0, dtype=np.uint64)
+
+def hamming(query, genome, packed_query, packed_genome, raw_query, raw_genome, other_query, other_genome):
+    """
+    Hamming distance of candidate (query, genome) window pairs
+    """
+    x = packed_query[query] ^ packed_genome[genome]
+    divergence = popcount((x | (x >> np.uint64(1))) & LOW_BITS).sum(axis=1)
+
+    # Gaps and ambiguous bases share code 0, so compare those windows exactly
+    other = other_query[query] | other_genome[genome]
+    if other.any():
+        divergence[other] = (raw_query[query[other]] != raw_genome[genome[other]]).sum(axis=1)
+
+    return divergence
+
+def query_chunks(candidate_counts, CANDIDATE_CHUNK_SIZE):
+    """
+    Bounds of consecutive query chunks with at most CANDIDATE_CHUNK_SIZE candidates, or a single query each
+    """
+    cumulative = np.cumsum(candidate_counts)
+    bounds = [0]
+    while bounds[-1] < len(candidate_counts):
+        done = cumulative[bounds[-1] - 1] if bounds[-1] > 0 else 0
+        end = np.searchsorted(cumulative, done + CANDIDATE_CHUNK_SIZE, side="right")
+        bounds.append(max(end, bounds[-1] + 1))
+    return bounds
+
+def nearest_windows(query_sequences, genome_sequences, MAX_DIVERGENCE, CANDIDATE_CHUNK_SIZE=CANDIDATE_CHUNK_SIZE):
+    """
+    Genome windows at minimum divergence from each query window, if within MAX_DIVERGENCE
+
+    Candidates share an identical seed block, then are verified by Hamming distance on packed windows.
+    Queries are processed in chunks by their number of seed matches, so candidates are never all held at once.
+    Returns a frame of (query, genome, divergence) indices.
+    """
+    empty = pl.DataFrame(schema={"query": pl.UInt32, "genome": pl.UInt32, "divergence": pl.UInt32})
+    if len(query_sequences) == 0 or len(genome_sequences) == 0:
+        return empty
+
+    width = max(max(map(len, query_sequences)), max(map(len, genome_sequences)))
+    raw_query, codes_query, other_query = encode_windows(query_sequences, width)
+    raw_genome, codes_genome, other_genome = encode_windows(genome_sequences, width)
+    packed_query = pack_codes(codes_query)
+    packed_genome = pack_codes(codes_genome)
+
+    exhaustive = MAX_DIVERGENCE >= width
+    if exhaustive:
+        candidate_counts = np.full(len(query_sequences), len(genome_sequences))
+    else:
+        bounds = block_bounds(width, MAX_DIVERGENCE)
+        num_blocks = len(bounds) - 1
+        keys_query = block_keys(codes_query, bounds).reshape(num_blocks, len(query_sequences))
+        seeds_genome = pl.DataFrame({
+            "block": np.repeat(np.arange(num_blocks, dtype=np.uint16), len(genome_sequences)),
+            "key": block_keys(codes_genome, bounds),
+            "genome": np.tile(np.arange(len(genome_sequences), dtype=np.uint32), num_blocks),
+            })
+        seed_counts = seeds_genome.group_by("block", "key").len()
+
+        def query_seeds(start, end):
+            return pl.DataFrame({
+                "block": np.repeat(np.arange(num_blocks, dtype=np.uint16), end - start),
+                "key": keys_query[:, start:end].ravel(),
+                "query": np.tile(np.arange(start, end, dtype=np.uint32), num_blocks),
+                })
+
+        candidate_counts = (
+            query_seeds(0, len(query_sequences))
+            .join(seed_counts, on=["block", "key"], how="left")
+            .group_by("query")
+            .agg(pl.col("len").sum())
+            .sort("query")
+            .get_column("len")
+            .to_numpy()
+        )
+
+    nearest = []
+    chunks = query_chunks(candidate_counts, CANDIDATE_CHUNK_SIZE)
+    for start, end in zip(chunks[:-1], chunks[1:]):
+        if exhaustive:
+            candidates = pl.DataFrame({"query": np.arange(start, end, dtype=np.uint32)}).join(
+                pl.DataFrame({"genome": np.arange(len(genome_sequences), dtype=np.uint32)}), how="cross"
+                )
+        else:
+            candidates = (
+                query_seeds(start, end)
+                .join(seeds_genome, on=["block", "key"], how="inner")
+                .select("query", "genome")
+                .unique()
+            )
+        if candidates.height == 0:
+            continue
+
+        query = candidates.get_column("query").to_numpy()
+        genome = candidates.get_column("genome").to_numpy()
+        divergence = hamming(query, genome, packed_query, packed_genome, raw_query, raw_genome, other_query, other_genome)
+
+        nearest.append(
+            pl.DataFrame({"query": query, "genome": genome, "divergence": divergence.astype(np.uint32)})
+            .filter(pl.col("divergence") <= MAX_DIVERGENCE)
+            .filter(pl.col("divergence") == pl.col("divergence").min().over("query"))
+        )
+
+    return pl.concat(nearest) if nearest else empty
+
+def appraise_gene(gene, queries, genomes, MAX_DIVERGENCE):
+    """
+    Minimum divergence and genomes found at that divergence for each metagenome window of a gene
+    """
+    nearest = nearest_windows(
+        queries.get_column("sequence").to_list(),
+        genomes.get_column("sequence").to_list(),
+        MAX_DIVERGENCE,
+        )
+    logging.debug(f"{gene}: {len(queries)} windows, {nearest.get_column('query').n_unique()} within divergence {MAX_DIVERGENCE}")
+
+    return (
+        nearest
+        .join(queries.with_row_index("query"), on="query")
+        .join(genomes.select("samples").with_row_index("genome"), on="genome")
+        .explode("samples")
+        .group_by("gene", "sequence", "divergence")
+        .agg(found_in = pl.col("samples").unique().sort().str.concat(","))
+    )
+
+def pipeline(
+    pipe_reads,
+    genome_table,
+    SEQUENCE_IDENTITIES=[0.86],
+    WINDOW_SIZE=60,
+    threads=1):
+    """
+    Appraise metagenome windows against genome windows within each sequence identity threshold
+
+    Returns a list of (binned, unbinned) per sequence identity threshold, as from query processing
+    """
+    logging.info(f"Polars using {str(pl.thread_pool_size())} threads")
+
+    MAX_DIVERGENCES = [(1 - SEQUENCE_IDENTITY) * WINDOW_SIZE for SEQUENCE_IDENTITY in SEQUENCE_IDENTITIES]
+    MAX_DIVERGENCE = math.floor(max(MAX_DIVERGENCES))
+
+    # Read as text so unchanged columns are written back exactly
+    reads = pl.scan_csv(list(pipe_reads), separator="\t", infer_schema_length=0).collect()
+    genomes = (
+        pl.read_csv(genome_table, separator="\t", infer_schema_length=0)
+        .group_by("gene", "sequence")
+        .agg(samples = pl.col("sample"))
+    )
+    queries = reads.select("gene", "sequence").unique()
+    logging.info(f"Appraising {len(queries)} metagenome windows against {len(genomes)} genome windows within divergence {MAX_DIVERGENCE}")
+
+    genome_partitions = genomes.partition_by("gene", as_dict=True)
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        futures = [
+            executor.submit(appraise_gene, gene, gene_queries, genome_partitions.get((gene,), genomes.clear()), MAX_DIVERGENCE)
+            for (gene,), gene_queries in queries.partition_by("gene", as_dict=True).items()
+            ]
+        hits = pl.concat(
+            [f.result() for f in futures],
+            how="vertical",
+            ) if futures else pl.DataFrame(schema={"gene": str, "sequence": str, "divergence": pl.UInt32, "found_in": str})
+
+    appraised = reads.join(hits, on=["gene", "sequence"], how="left")
+
+    outputs = []
+    for MAX_DIVERGENCE in MAX_DIVERGENCES:
+        is_binned = (pl.col("divergence") <= MAX_DIVERGENCE).fill_null(False)
+        binned = appraised.filter(is_binned).select(OUTPUT_COLUMNS)
+        unbinned = (
+            appraised
+            .filter(~is_binned)
+            .with_columns(pl.lit(None).cast(str).alias("found_in"))
+            .select(OUTPUT_COLUMNS)
+        )
+        outputs.append((binned, unbinned))
+
+    logging.info(f"Binned {outputs[0][0].height} of {reads.height} metagenome windows")
+    return outputs
+
+if __name__ == "__main__":
+    os.environ["POLARS_MAX_THREADS"] = str(snakemake.threads)
+    import polars as pl
+
+    logging.basicConfig(
+        filename=snakemake.log[0],
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s: %(message)s',
+        datefmt='%Y/%m/%d %I:%M:%S %p'
+        )
+
+    SEQUENCE_IDENTITIES = [snakemake.params.sequence_identity] + list(snakemake.params.extra_sequence_identities)
+    output_paths = [(snakemake.output.binned, snakemake.output.unbinned)] + \
+        list(zip(snakemake.output.extra_binned, snakemake.output.extra_unbinned))
+
+    outputs = pipeline(
+        snakemake.input.reads,
+        snakemake.input.bins,
+        SEQUENCE_IDENTITIES=SEQUENCE_IDENTITIES,
+        WINDOW_SIZE=snakemake.params.window_size,
+        threads=snakemake.threads,
+        )
+    for (binned, unbinned), (binned_path, unbinned_path) in zip(outputs, output_paths):
+        binned.write_csv(binned_path, separator="\t")
+        unbinned.write_csv(unbinned_path, separator="\t")
+
+    logging.info("Done")
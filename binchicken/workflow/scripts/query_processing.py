@@ -6,6 +6,11 @@
 import polars as pl
 import os
 import logging
+import hashlib
+import shutil
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
 
 QUERY_COLUMNS = {
     "query_name": str,
@@ -28,6 +33,13 @@ PIPE_COLUMNS = {
     "taxonomy": str,
 }
 
+# Number of sample pairs in flight per worker, so reads overlap with processing without holding every sample in memory
+PAIRS_PER_THREAD = 2
+
+# Number of sample pairs per checkpointed batch
+BATCH_SIZE = 100
+MANIFEST_FILENAME = "manifest.txt"
+
 OUTPUT_COLUMNS={
     "gene": str,
     "sample": str,
@@ -44,9 +56,19 @@ def processing(
     SEQUENCE_IDENTITY=0.86,
     WINDOW_SIZE=60):
 
+    return processing_thresholds(query_read, pipe_read, [SEQUENCE_IDENTITY], WINDOW_SIZE)[0]
+
+def processing_thresholds(
+    query_read,
+    pipe_read,
+    SEQUENCE_IDENTITIES=[0.86],
+    WINDOW_SIZE=60):
+    """
+    Split into binned/unbinned for each sequence identity threshold, joining only once
+    """
     if len(query_read) == 0:
         empty_output = pl.DataFrame(schema=OUTPUT_COLUMNS)
-        return empty_output, empty_output
+        return [(empty_output, empty_output) for _ in SEQUENCE_IDENTITIES]
 
     appraised = (
         query_read
@@ -59,42 +81,259 @@ def processing(
         .join(pipe_read, on=["gene", "sample", "sequence"], how="inner")
         .group_by(["gene", "sample", "sequence", "num_hits", "coverage", "taxonomy", "divergence"])
         .agg(pl.col("found_in").sort().str.concat(","))
-        .with_columns(pl.col("divergence").alias("binned") <= ((1 - SEQUENCE_IDENTITY) * WINDOW_SIZE))
     )
-
-    # Split dataframe into binned/unbinned
-    binned = appraised.filter(pl.col("binned")).drop(["divergence", "binned"])
-    unbinned = (
+    joined = (
         pipe_read
         .join(
             appraised, on=["gene", "sample", "sequence", "num_hits", "coverage", "taxonomy"], how="left", coalesce=True
             )
-        .filter(~pl.col("binned").fill_null(False))
-        .drop(["divergence", "binned"])
-        .with_columns(pl.lit(None).cast(str).alias("found_in"))
     )
 
-    return binned, unbinned
+    outputs = []
+    for SEQUENCE_IDENTITY in SEQUENCE_IDENTITIES:
+        is_binned = pl.col("divergence") <= ((1 - SEQUENCE_IDENTITY) * WINDOW_SIZE)
+
+        # Split dataframe into binned/unbinned
+        binned = appraised.filter(is_binned).drop("divergence")
+        unbinned = (
+            joined
+            .filter(~is_binned.fill_null(False))
+            .drop("divergence")
+            .with_columns(pl.lit(None).cast(str).alias("found_in"))
+        )
+        outputs.append((binned, unbinned))
+
+    return outputs
+
+def process_pair(
+    query,
+    pipe,
+    SEQUENCE_IDENTITIES=[0.86],
+    WINDOW_SIZE=60):
+
+    logging.debug(f"Processing {query} and {pipe}")
+    return processing_thresholds(
+        pl.read_csv(query, separator="\t"),
+        pl.read_csv(pipe, separator="\t"),
+        SEQUENCE_IDENTITIES,
+        WINDOW_SIZE)
 
 def pipeline(
     query_reads,
     pipe_reads,
-    SEQUENCE_IDENTITY=0.86,
+    SEQUENCE_IDENTITIES=[0.86],
+    WINDOW_SIZE=60,
+    threads=1):
+    """
+    Yields a list of (binned, unbinned) per sequence identity threshold for each sample pair
+    """
+    logging.info(f"Processing samples using {threads} workers, sharing {str(pl.thread_pool_size())} Polars threads")
+
+    # Results are yielded in input order, with a bounded number of pairs in flight
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for query, pipe in zip(query_reads, pipe_reads):
+            pending.append(executor.submit(process_pair, query, pipe, SEQUENCE_IDENTITIES, WINDOW_SIZE))
+            if len(pending) >= threads * PAIRS_PER_THREAD:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+def has_rows(table):
+    with open(table) as f:
+        return bool(f.readline()) and bool(f.readline())
+
+def scan_pipeline(
+    query_reads,
+    pipe_reads,
+    SEQUENCE_IDENTITIES=[0.86],
     WINDOW_SIZE=60):
+    """
+    Process all samples as two lazy multi-file scans on the streaming engine
 
+    The divergence threshold and column projection are pushed down to the query scan.
+    Samples with an empty query table are dropped entirely, as in processing.
+    Returns a list of (binned, unbinned) per sequence identity threshold.
+    """
     logging.info(f"Polars using {str(pl.thread_pool_size())} threads")
 
-    for query, pipe in zip(query_reads, pipe_reads):
-        logging.debug(f"Processing {query} and {pipe}")
-        binned, unbinned = processing(
-            pl.read_csv(query, separator="\t"),
-            pl.read_csv(pipe, separator="\t"),
-            SEQUENCE_IDENTITY,
-            WINDOW_SIZE)
-        yield binned, unbinned
+    pairs = [(query, pipe) for query, pipe in zip(query_reads, pipe_reads) if has_rows(query)]
+    logging.info(f"Scanning {len(pairs)} query and pipe table pairs, skipping {len(query_reads) - len(pairs)} empty query tables")
+    if not pairs:
+        empty_output = pl.DataFrame(schema=OUTPUT_COLUMNS)
+        return [(empty_output, empty_output) for _ in SEQUENCE_IDENTITIES]
+    query_reads, pipe_reads = zip(*pairs)
+
+    MAX_DIVERGENCES = [(1 - SEQUENCE_IDENTITY) * WINDOW_SIZE for SEQUENCE_IDENTITY in SEQUENCE_IDENTITIES]
+    keys = ["gene", "sample", "sequence"]
+
+    query = (
+        pl.scan_csv(list(query_reads), separator="\t", schema_overrides=QUERY_COLUMNS)
+        .select(
+            gene = pl.col("marker"),
+            sample = pl.col("query_name"),
+            sequence = pl.col("query_sequence"),
+            found_in = pl.col("sample"),
+            divergence = pl.col("divergence"),
+            )
+    )
+    pipe = pl.scan_csv(list(pipe_reads), separator="\t", schema_overrides=PIPE_COLUMNS)
+
+    # Groups keep divergence, so each threshold is a filter on the loosest threshold's groups
+    within = (
+        query
+        .filter(pl.col("divergence") <= max(MAX_DIVERGENCES))
+        .join(pipe, on=keys, how="inner")
+        .group_by(["gene", "sample", "sequence", "num_hits", "coverage", "taxonomy", "divergence"])
+        .agg(pl.col("found_in").sort().str.concat(","))
+    )
+
+    # Unbinned sequences either have no hits, or one entry per divergence beyond the threshold
+    unhit = pipe.join(query.select(keys).unique(), on=keys, how="anti")
+    beyond = (
+        query
+        .filter(pl.col("divergence") > min(MAX_DIVERGENCES))
+        .select(keys + ["divergence"])
+        .unique()
+        .join(pipe, on=keys, how="inner")
+    )
+    within, unhit, beyond = pl.collect_all([within, unhit, beyond], streaming=True)
+
+    outputs = []
+    for MAX_DIVERGENCE in MAX_DIVERGENCES:
+        binned = (
+            within
+            .filter(pl.col("divergence") <= MAX_DIVERGENCE)
+            .select(OUTPUT_COLUMNS.keys())
+        )
+        unbinned = (
+            pl.concat([unhit, beyond.filter(pl.col("divergence") > MAX_DIVERGENCE).drop("divergence")], how="diagonal")
+            .with_columns(pl.lit(None).cast(str).alias("found_in"))
+            .select(OUTPUT_COLUMNS.keys())
+        )
+        outputs.append((binned, unbinned))
+
+    return outputs
+
+def file_key(path):
+    stat = os.stat(path)
+    return f"{path}\t{stat.st_size}\t{stat.st_mtime_ns}"
+
+def batch_digest(queries, pipes, SEQUENCE_IDENTITIES=[0.86], WINDOW_SIZE=60):
+    """
+    Digest of a batch's thresholds and input files, changing when any input is rewritten
+    """
+    digest = hashlib.sha256(f"{','.join(str(i) for i in SEQUENCE_IDENTITIES)}\t{WINDOW_SIZE}".encode())
+    for query, pipe in zip(queries, pipes):
+        digest.update(f"\n{file_key(query)}\t{file_key(pipe)}".encode())
+
+    return digest.hexdigest()
+
+def concatenate_tables(paths, output_path):
+    """
+    Concatenate TSV files with matching headers, keeping the first header only
+    """
+    with open(output_path, "wb") as out:
+        for i, path in enumerate(paths):
+            with open(path, "rb") as f:
+                header = f.readline()
+                if i == 0:
+                    out.write(header)
+                shutil.copyfileobj(f, out)
+
+def batch_paths(partial_dir, digest, num_thresholds):
+    return [
+        (os.path.join(partial_dir, f"{digest}_{i}_binned.tsv"), os.path.join(partial_dir, f"{digest}_{i}_unbinned.tsv"))
+        for i in range(num_thresholds)
+    ]
+
+def resumable_pipeline(
+    query_reads,
+    pipe_reads,
+    output_paths,
+    partial_dir,
+    SEQUENCE_IDENTITIES=[0.86],
+    WINDOW_SIZE=60,
+    BATCH_SIZE=BATCH_SIZE,
+    threads=1):
+    """
+    Process sample pairs in batches, recording each finished batch in a manifest
+
+    output_paths: list of (binned_path, unbinned_path) per sequence identity threshold
+    A restarted run skips batches already in the manifest, then concatenates all batches into the outputs
+    """
+    if len(set(SEQUENCE_IDENTITIES)) != len(SEQUENCE_IDENTITIES):
+        raise ValueError(f"Repeated sequence identity thresholds: {SEQUENCE_IDENTITIES}")
+
+    os.makedirs(partial_dir, exist_ok=True)
+    manifest_path = os.path.join(partial_dir, MANIFEST_FILENAME)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            finished = set(
+                digest for digest in (line.strip() for line in f)
+                if digest and all(
+                    os.path.isfile(path)
+                    for paths in batch_paths(partial_dir, digest, len(SEQUENCE_IDENTITIES))
+                    for path in paths
+                    )
+                )
+    else:
+        finished = set()
+
+    query_reads = list(query_reads)
+    pipe_reads = list(pipe_reads)
+    batches = []
+    for start in range(0, len(query_reads), BATCH_SIZE):
+        queries = query_reads[start:start + BATCH_SIZE]
+        pipes = pipe_reads[start:start + BATCH_SIZE]
+        batches.append((batch_digest(queries, pipes, SEQUENCE_IDENTITIES, WINDOW_SIZE), queries, pipes))
+
+    num_finished = sum(1 for digest, _, _ in batches if digest in finished)
+    logging.info(f"Processing {len(batches) - num_finished} of {len(batches)} batches, {num_finished} already finished")
+
+    with open(manifest_path, "a") as manifest:
+        for digest, queries, pipes in batches:
+            if digest in finished:
+                continue
+
+            paths = batch_paths(partial_dir, digest, len(SEQUENCE_IDENTITIES))
+            try:
+                with ExitStack() as stack:
+                    files = [
+                        (stack.enter_context(open(b + ".tmp", "wb")), stack.enter_context(open(u + ".tmp", "wb")))
+                        for b, u in paths
+                        ]
+                    first = True
+                    for outputs in pipeline(queries, pipes, SEQUENCE_IDENTITIES=SEQUENCE_IDENTITIES, WINDOW_SIZE=WINDOW_SIZE, threads=threads):
+                        for (binned, unbinned), (binned_file, unbinned_file) in zip(outputs, files):
+                            binned.write_csv(binned_file, separator="\t", include_header=first)
+                            unbinned.write_csv(unbinned_file, separator="\t", include_header=first)
+                        first = False
+            except BaseException:
+                for path in (path + ".tmp" for pair in paths for path in pair):
+                    if os.path.exists(path):
+                        os.remove(path)
+                raise
+
+            for binned_path, unbinned_path in paths:
+                os.replace(binned_path + ".tmp", binned_path)
+                os.replace(unbinned_path + ".tmp", unbinned_path)
+
+            manifest.write(digest + "\n")
+            manifest.flush()
+            os.fsync(manifest.fileno())
+
+    logging.info("Concatenating batches")
+    all_paths = [batch_paths(partial_dir, digest, len(SEQUENCE_IDENTITIES)) for digest, _, _ in batches]
+    for i, (binned_path, unbinned_path) in enumerate(output_paths):
+        concatenate_tables([paths[i][0] for paths in all_paths], binned_path)
+        concatenate_tables([paths[i][1] for paths in all_paths], unbinned_path)
+    shutil.rmtree(partial_dir)
 
 if __name__ == "__main__":
-    os.environ["POLARS_MAX_THREADS"] = str(snakemake.threads)
+    # Workers share one Polars thread pool, so Polars only gets every thread when scanning without workers
+    os.environ["POLARS_MAX_THREADS"] = str(snakemake.threads if snakemake.params.scan else 1)
     import polars as pl
 
     logging.basicConfig(
@@ -104,25 +343,33 @@ if __name__ == "__main__":
         datefmt='%Y/%m/%d %I:%M:%S %p'
         )
 
-    SEQUENCE_IDENTITY = snakemake.params.sequence_identity
+    # Extra sequence identity thresholds produce additional binned/unbinned tables in the same pass
+    SEQUENCE_IDENTITIES = [snakemake.params.sequence_identity] + list(snakemake.params.extra_sequence_identities)
     WINDOW_SIZE = snakemake.params.window_size
     query_reads = snakemake.input.query_reads
     pipe_reads = snakemake.input.pipe_reads
-    binned_path = snakemake.output.binned
-    unbinned_path = snakemake.output.unbinned
-
-    outputs = pipeline(
-        query_reads,
-        pipe_reads,
-        SEQUENCE_IDENTITY=SEQUENCE_IDENTITY,
-        WINDOW_SIZE=WINDOW_SIZE
-        )
+    output_paths = [(snakemake.output.binned, snakemake.output.unbinned)] + \
+        list(zip(snakemake.output.extra_binned, snakemake.output.extra_unbinned))
 
-    with open(binned_path, "ab") as binned_file, open(unbinned_path, "ab") as unbinned_file:
-        first = True
-        for binned, unbinned in outputs:
-            binned.write_csv(binned_file, separator="\t", include_header=first)
-            unbinned.write_csv(unbinned_file, separator="\t", include_header=first)
-            first = False
+    if snakemake.params.scan:
+        outputs = scan_pipeline(
+            query_reads,
+            pipe_reads,
+            SEQUENCE_IDENTITIES=SEQUENCE_IDENTITIES,
+            WINDOW_SIZE=WINDOW_SIZE,
+            )
+        for (binned, unbinned), (binned_path, unbinned_path) in zip(outputs, output_paths):
+            binned.write_csv(binned_path, separator="\t")
+            unbinned.write_csv(unbinned_path, separator="\t")
+    else:
+        resumable_pipeline(
+            query_reads,
+            pipe_reads,
+            output_paths,
+            snakemake.params.partial_dir,
+            SEQUENCE_IDENTITIES=SEQUENCE_IDENTITIES,
+            WINDOW_SIZE=WINDOW_SIZE,
+            threads=snakemake.threads,
+            )
 
     logging.info("Done")
@@ -6,10 +6,11 @@
 import polars as pl
 import os
 import logging
-from sourmash import MinHash, SourmashSignature
+import hashlib
+from sourmash import MinHash, SourmashSignature, load_file_as_signatures
 from sourmash.sourmash_args import SaveSignaturesToLocation
-from concurrent.futures import ProcessPoolExecutor
-import extern
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from binchicken.workflow.scripts.appraise_ipc import scan_appraise
 
 SINGLEM_OTU_TABLE_SCHEMA = {
     "gene": str,
@@ -20,43 +21,104 @@ SINGLEM_OTU_TABLE_SCHEMA = {
     "taxonomy": str,
     }
 
-def process_groups(groups, output_path):
-    with SaveSignaturesToLocation(output_path) as save_sigs:
-        for group in groups:
-            sample, sequences = group
-            mh = MinHash(n=0, ksize=60, scaled=1, track_abundance=False)
-            for seq in sequences:
-                mh.add_sequence(seq.replace("-", "A").replace("N", "A"))
-            signature = SourmashSignature(mh, name=sample)
-            save_sigs.add(signature)
-
-def processing(unbinned, output_path, threads=1):
-    output_dir = os.path.dirname(output_path)
+DIGESTS_COLUMNS = {
+    "sample": str,
+    "digest": str,
+    }
 
+SKETCH_FILENAME = "samples.sig.zip"
+DIGESTS_FILENAME = "samples_digests.tsv"
+
+# Number of batches per worker, so finished sketches reach the writer while others are still computing
+BATCHES_PER_THREAD = 4
+
+def process_groups(groups):
+    signatures = []
+    for group in groups:
+        sample, sequences = group
+        mh = MinHash(n=0, ksize=60, scaled=1, track_abundance=False)
+        for seq in sequences:
+            mh.add_sequence(seq.replace("-", "A").replace("N", "A"))
+        signatures.append(SourmashSignature(mh, name=sample))
+
+    return signatures
+
+def sample_digest(sequences, TAXA_OF_INTEREST=""):
+    """
+    Hash of a sample's sorted window set, so unchanged samples can reuse cached sketches
+    """
+    digest = hashlib.sha256((TAXA_OF_INTEREST or "").encode())
+    for seq in sorted(set(sequences)):
+        digest.update(b"\n" + seq.encode())
+
+    return digest.hexdigest()
+
+def load_cache(cache_dir, digests):
+    """
+    Load cached signatures from a previous sketch directory whose window set digest is unchanged
+    """
+    cache_digests_path = os.path.join(cache_dir, DIGESTS_FILENAME)
+    cache_sketch_path = os.path.join(cache_dir, SKETCH_FILENAME)
+    if not (os.path.isfile(cache_digests_path) and os.path.isfile(cache_sketch_path)):
+        logging.warning(f"No sketch cache found at {cache_dir}")
+        return []
+
+    cached_digests = pl.read_csv(cache_digests_path, separator="\t", schema_overrides=DIGESTS_COLUMNS)
+    reusable = set(
+        digests
+        .join(cached_digests, on=["sample", "digest"], how="inner")
+        .get_column("sample")
+        .to_list()
+    )
+
+    return [s for s in load_file_as_signatures(cache_sketch_path) if s.name in reusable]
+
+def processing(unbinned, output_path, digests_path=None, cache_dir=None, changed_path=None, TAXA_OF_INTEREST="", threads=1):
     logging.info("Grouping samples")
     groups = [(s[0], d.get_column("sequence").to_list()) for s,d in unbinned.set_sorted("sample").select("sample", "sequence").group_by(["sample"])]
-    threads = min(threads, len(groups))
+    digests = pl.DataFrame(
+        [[sample, sample_digest(sequences, TAXA_OF_INTEREST)] for sample, sequences in groups],
+        schema=DIGESTS_COLUMNS,
+        orient="row",
+        )
+
+    cached = load_cache(cache_dir, digests) if cache_dir else []
+    if digests_path:
+        digests.write_csv(digests_path, separator="\t")
+    if cached:
+        cached_samples = set(s.name for s in cached)
+        logging.info(f"Reusing {len(cached_samples)} cached sketches")
+        groups = [g for g in groups if g[0] not in cached_samples]
 
-    # Distribute groups among threads more evenly
-    grouped = [[] for _ in range(threads)]
+    threads = max(1, min(threads, len(groups)))
+    num_batches = max(1, min(threads * BATCHES_PER_THREAD, len(groups)))
+
+    # Distribute groups among batches more evenly
+    grouped = [[] for _ in range(num_batches)]
     for i, group in enumerate(groups):
-        grouped[i % threads].append(group)
+        grouped[i % num_batches].append(group)
 
     del groups
 
     logging.info("Generating sketches in separate threads")
-    with ProcessPoolExecutor(max_workers=threads) as executor:
-        futures = []
-        for i, group_subset in enumerate(grouped):
-            output_subpath = os.path.join(output_dir, f"signatures_thread_{i}.sig")
-            future = executor.submit(process_groups, group_subset, output_subpath)
-            futures.append(future)
-
-        for future in futures:
-            future.result()
-
-    logging.info("Concatenating sketches")
-    extern.run(f"sourmash sig cat {os.path.join(output_dir, 'signatures_thread_*.sig')} -o {output_path}")
+    with ProcessPoolExecutor(max_workers=threads) as executor, SaveSignaturesToLocation(output_path) as save_sigs:
+        for signature in cached:
+            save_sigs.add(signature)
+        del cached
+
+        futures = [executor.submit(process_groups, group_subset) for group_subset in grouped]
+
+        # Newly sketched samples are also written separately for incremental distance calculation
+        if changed_path:
+            with SaveSignaturesToLocation(changed_path) as save_changed:
+                for future in as_completed(futures):
+                    for signature in future.result():
+                        save_sigs.add(signature)
+                        save_changed.add(signature)
+        else:
+            for future in as_completed(futures):
+                for signature in future.result():
+                    save_sigs.add(signature)
 
     logging.info("Done")
     return output_path
@@ -75,10 +137,17 @@ if __name__ == "__main__":
 
     unbinned_path = snakemake.input.unbinned
     TAXA_OF_INTEREST = snakemake.params.taxa_of_interest
+    cache_dir = snakemake.params.sketch_cache
     output_path = snakemake.output.sketch
+    digests_path = snakemake.output.digests
+    changed_path = snakemake.output.changed if snakemake.output.changed else None
     threads = snakemake.threads
 
-    unbinned = pl.read_csv(unbinned_path, separator="\t", schema_overrides=SINGLEM_OTU_TABLE_SCHEMA)
+    unbinned = scan_appraise(
+        unbinned_path,
+        columns=["sample", "sequence", "taxonomy"],
+        schema_overrides=SINGLEM_OTU_TABLE_SCHEMA,
+        ).collect()
 
     if TAXA_OF_INTEREST:
         logging.info(f"Filtering for taxa of interest: {TAXA_OF_INTEREST}")
@@ -86,4 +155,12 @@ if __name__ == "__main__":
             pl.col("taxonomy").str.contains(TAXA_OF_INTEREST)
         )
 
-    signatures = processing(unbinned, output_path, threads=threads)
+    signatures = processing(
+        unbinned,
+        output_path,
+        digests_path=digests_path,
+        cache_dir=cache_dir,
+        changed_path=changed_path,
+        TAXA_OF_INTEREST=TAXA_OF_INTEREST,
+        threads=threads,
+        )
@@ -0,0 +1,70 @@
+##########################
+### split_otu_table.py ###
+##########################
+# Author: Samuel Aroney
+
+import os
+import logging
+import polars as pl
+
+# Stripped in order, matching SingleM's sample naming from input file names
+SINGLEM_SUFFIXES = [".gz", ".fna", ".fq", ".fastq", ".fasta", ".fa"]
+
+def singlem_sample_name(path):
+    """
+    Sample name given by SingleM pipe to reads or transcripts at path
+    """
+    name = os.path.basename(path)
+    for suffix in SINGLEM_SUFFIXES:
+        name = name.removesuffix(suffix)
+    return name
+
+def batch_inputs(names, BATCH_SIZE):
+    """
+    Partition sorted names into numbered batches of up to BATCH_SIZE
+    """
+    names = sorted(names)
+    return {
+        str(i // BATCH_SIZE): names[i:i + BATCH_SIZE]
+        for i in range(0, len(names), BATCH_SIZE)
+        }
+
+def pipeline(otu_table, batch_samples):
+    """
+    Rows of a batched SingleM pipe OTU table belonging to each sample of the batch, in order, as text
+
+    Raises if the table has samples outside the batch, which would otherwise be silently dropped
+    """
+    logging.info(f"Polars using {str(pl.thread_pool_size())} threads")
+
+    otu_table = pl.read_csv(otu_table, separator="\t", infer_schema_length=0)
+    unexpected = set(otu_table.get_column("sample").unique().to_list()) - set(batch_samples)
+    if unexpected:
+        raise ValueError(f"Unexpected samples in batched OTU table: {', '.join(sorted(unexpected))}")
+
+    partitions = otu_table.partition_by("sample", as_dict=True)
+    return [partitions.get((sample,), otu_table.clear()) for sample in batch_samples]
+
+if __name__ == "__main__":
+    os.environ["POLARS_MAX_THREADS"] = str(snakemake.threads)
+    import polars as pl
+
+    logging.basicConfig(
+        filename=snakemake.log[0],
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s: %(message)s',
+        datefmt='%Y/%m/%d %I:%M:%S %p'
+        )
+
+    otu_tables = pipeline(
+        snakemake.input.otu_table,
+        snakemake.params.batch_samples,
+        )
+    for otu_table, output in zip(otu_tables, snakemake.params.otu_tables):
+        otu_table.write_csv(output, separator="\t")
+
+    # Listed only once every table is written, so an interrupted split is rerun
+    with open(snakemake.output.manifest, "w") as f:
+        f.writelines(output + "\n" for output in snakemake.params.otu_tables)
+
+    logging.info("Done")
@@ -10,6 +10,8 @@ import numpy as np
 import scipy.sparse as sp
 import itertools
 from binchicken.binchicken import SUFFIX_RE
+from binchicken.workflow.scripts.compact_distances import strip_read_suffix, index_distances, read_compact_distances, COMPACT_DISTANCES_SUFFIX
+from binchicken.workflow.scripts.appraise_ipc import scan_appraise
 
 EDGES_COLUMNS={
     "style": str,
@@ -29,39 +31,72 @@ def get_clusters(
     if sample_distances.height == 0:
         return pl.DataFrame(schema={"samples": str})
 
-    if MAX_COASSEMBLY_SAMPLES < 2:
-        # Set to 2 to produce paired edges
-        MAX_COASSEMBLY_SAMPLES = 2
-
     sample_distances = (
         sample_distances
         .with_columns(
-            pl.when(pl.col("query_name").is_in(samples))
-                .then(pl.col("query_name"))
-                .otherwise(pl.col("query_name").str.replace(SUFFIX_RE, "")),
-            pl.when(pl.col("match_name").is_in(samples))
-                .then(pl.col("match_name"))
-                .otherwise(pl.col("match_name").str.replace(SUFFIX_RE, "")),
+            strip_read_suffix("query_name", samples),
+            strip_read_suffix("match_name", samples),
             )
     )
 
     logging.info("Converting to sparse array")
-    samples = np.unique(np.concatenate([
-        sample_distances.select("query_name").to_numpy().flatten(),
-        sample_distances.select("match_name").to_numpy().flatten(),
-    ]))
-    sample_to_index = {sample: index for index, sample in enumerate(samples)}
+    names, query_idx, match_idx = index_distances(
+        sample_distances.get_column("query_name").to_numpy(),
+        sample_distances.get_column("match_name").to_numpy(),
+        )
+
+    return cluster_distances(
+        names,
+        query_idx,
+        match_idx,
+        sample_distances.get_column("jaccard").to_numpy().astype(np.float32),
+        anchor_samples=anchor_samples,
+        PRECLUSTER_SIZE=PRECLUSTER_SIZE,
+        MAX_COASSEMBLY_SAMPLES=MAX_COASSEMBLY_SAMPLES,
+        )
+
+def get_clusters_compact(
+        distances_path,
+        anchor_samples=set(),
+        PRECLUSTER_SIZE=2,
+        MAX_COASSEMBLY_SAMPLES=2,
+        MIN_JACCARD=0.01):
+    """
+    Preclusters from compact distances, whose names already have read suffixes stripped
+    """
+    logging.info(f"Reading compact distances from {distances_path}")
+    names, pairs = read_compact_distances(distances_path)
+    pairs = pairs[pairs["jaccard"] > MIN_JACCARD]
+
+    if len(pairs) == 0:
+        return pl.DataFrame(schema={"samples": str})
+
+    return cluster_distances(
+        names,
+        pairs["query"],
+        pairs["match"],
+        pairs["jaccard"].astype(np.float32),
+        anchor_samples=anchor_samples,
+        PRECLUSTER_SIZE=PRECLUSTER_SIZE,
+        MAX_COASSEMBLY_SAMPLES=MAX_COASSEMBLY_SAMPLES,
+        )
+
+def cluster_distances(
+        samples,
+        query_idx,
+        match_idx,
+        jaccard,
+        anchor_samples=set(),
+        PRECLUSTER_SIZE=2,
+        MAX_COASSEMBLY_SAMPLES=2):
+    if MAX_COASSEMBLY_SAMPLES < 2:
+        # Set to 2 to produce paired edges
+        MAX_COASSEMBLY_SAMPLES = 2
 
     logging.info("Initialise the array")
     distances = (
         sp.coo_matrix(
-            (
-                sample_distances.select("jaccard").to_numpy().flatten().astype(np.float32),
-                (
-                    np.array([sample_to_index[name] for name in sample_distances.select("query_name").to_numpy().flatten()]),
-                    np.array([sample_to_index[name] for name in sample_distances.select("match_name").to_numpy().flatten()])
-                )
-            ),
+            (jaccard, (query_idx, match_idx)),
             shape=(len(samples), len(samples))
         )
         .tocsr()
@@ -332,9 +367,16 @@ if __name__ == "__main__":
     samples = set(snakemake.params.samples)
     anchor_samples = set(snakemake.params.anchor_samples)
 
-    unbinned = pl.read_csv(unbinned_path, separator="\t")
+    unbinned = scan_appraise(unbinned_path).collect()
 
-    if distances_path:
+    if distances_path and distances_path.endswith(COMPACT_DISTANCES_SUFFIX):
+        sample_preclusters = get_clusters_compact(
+            distances_path,
+            anchor_samples=anchor_samples,
+            PRECLUSTER_SIZE=PRECLUSTER_SIZE,
+            MAX_COASSEMBLY_SAMPLES=MAX_COASSEMBLY_SAMPLES,
+            )
+    elif distances_path:
         sample_distances = (
             pl.scan_csv(distances_path)
             .select("query_name", "match_name", "jaccard")
@@ -348,6 +390,8 @@ if __name__ == "__main__":
             PRECLUSTER_SIZE=PRECLUSTER_SIZE,
             MAX_COASSEMBLY_SAMPLES=MAX_COASSEMBLY_SAMPLES,
             )
+
+    if distances_path:
         streaming_pipeline(
             unbinned,
             samples,
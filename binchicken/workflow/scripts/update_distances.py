@@ -0,0 +1,106 @@
+###########################
+### update_distances.py ###
+###########################
+# Author: Samuel Aroney
+
+import polars as pl
+import os
+import logging
+import extern
+
+DIGESTS_COLUMNS = {
+    "sample": str,
+    "digest": str,
+    }
+
+def changed_samples(digests, prior_digests):
+    """
+    Samples that are new or whose window set digest differs from the prior run
+    """
+    return set(
+        digests
+        .join(prior_digests, on=["sample", "digest"], how="anti")
+        .get_column("sample")
+        .to_list()
+    )
+
+def merge_distances(prior_distances, changed_distances, samples, changed):
+    """
+    Replace prior distances involving changed samples with recalculated distances
+
+    prior_distances: all-vs-all distances from the prior run (one row per pair)
+    changed_distances: changed-vs-all distances (both orientations for changed pairs, including self matches)
+    samples: all current samples
+    changed: samples with new or changed sketches
+    """
+    samples = list(samples)
+    changed = list(changed)
+
+    retained = (
+        prior_distances
+        .filter(pl.col("query_name").is_in(samples) & pl.col("match_name").is_in(samples))
+        .filter(~pl.col("query_name").is_in(changed) & ~pl.col("match_name").is_in(changed))
+    )
+
+    recalculated = (
+        changed_distances
+        .filter(pl.col("query_name") != pl.col("match_name"))
+        # Pairs of changed samples are found in both orientations, keep one
+        .filter(~pl.col("match_name").is_in(changed) | (pl.col("query_name") < pl.col("match_name")))
+        .select(retained.columns)
+    )
+
+    return pl.concat([retained, recalculated], how="vertical_relaxed")
+
+def pipeline(sketch_path, changed_path, digests_path, prior_dir, output_path, threads=1):
+    prior_distances_path = os.path.join(prior_dir, "samples.csv") if prior_dir else None
+    prior_digests_path = os.path.join(prior_dir, "samples_digests.tsv") if prior_dir else None
+
+    if not (prior_dir and os.path.isfile(prior_distances_path) and os.path.isfile(prior_digests_path)):
+        logging.info("No prior distances found, calculating all pairwise distances")
+        extern.run(f"sourmash scripts pairwise {sketch_path} -o {output_path} -k 60 -s 1 -c {threads}")
+        return
+
+    digests = pl.read_csv(digests_path, separator="\t", schema_overrides=DIGESTS_COLUMNS)
+    prior_digests = pl.read_csv(prior_digests_path, separator="\t", schema_overrides=DIGESTS_COLUMNS)
+    changed = changed_samples(digests, prior_digests)
+    logging.info(f"Found {len(changed)} new or changed samples out of {digests.height}")
+
+    prior_distances = pl.read_csv(prior_distances_path)
+    if changed:
+        changed_distances_path = output_path + ".changed.csv"
+        extern.run(f"sourmash scripts multisearch {changed_path} {sketch_path} -o {changed_distances_path} -k 60 -s 1 -c {threads}")
+        changed_distances = pl.read_csv(changed_distances_path)
+        os.remove(changed_distances_path)
+    else:
+        changed_distances = prior_distances.clear()
+
+    merge_distances(
+        prior_distances,
+        changed_distances,
+        digests.get_column("sample").to_list(),
+        changed,
+        ).write_csv(output_path)
+
+    logging.info("Done")
+
+if __name__ == "__main__":
+    os.environ["POLARS_MAX_THREADS"] = str(snakemake.threads)
+    import polars as pl
+
+    logging.basicConfig(
+        filename=snakemake.log[0],
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s: %(message)s',
+        datefmt='%Y/%m/%d %I:%M:%S %p'
+        )
+    logging.info(f"Polars using {str(pl.thread_pool_size())} threads")
+
+    pipeline(
+        snakemake.input.sketch,
+        snakemake.input.changed,
+        snakemake.input.digests,
+        snakemake.params.sketch_cache,
+        snakemake.output.distance,
+        threads=snakemake.threads,
+        )
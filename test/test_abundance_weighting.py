@@ -253,5 +253,42 @@ class Tests(unittest.TestCase):
         self.assertDataFrameEqual(expected, observed)
 
 
+    def test_abundance_weighting_sparse_matches_dense(self):
+        unbinned = pl.DataFrame([
+            ["S3.1", "sample_1", "AAA", 1, 3, "Root", ""],
+            ["S3.1", "sample_2", "AAA", 1, 7, "Root", ""],
+            ["S3.1", "sample_2", "AAB", 1, 2, "Root", ""],
+            ["S3.1", "sample_3", "AAC", 1, 5, "Root", ""],
+            ["S3.2", "sample_1", "BBA", 1, 4, "Root", ""],
+            ["S3.2", "sample_1", "BBA", 1, 4, "Root", ""],
+            ["S3.2", "sample_3", "BBB", 1, 1, "Root", ""],
+        ], orient="row", schema=APPRAISE_COLUMNS)
+        binned = pl.DataFrame([
+            ["S3.1", "sample_1", "AAD", 1, 9, "Root", ""],
+            ["S3.1", "sample_4", "AAD", 1, 6, "Root", ""],
+            ["S3.2", "sample_2", "BBD", 1, 8, "Root", ""],
+        ], orient="row", schema=APPRAISE_COLUMNS)
+
+        # Dense mean over every sample with the gene, with unobserved sequences as zero coverage
+        total_coverage = (
+            pl.concat([binned, unbinned])
+            .group_by("sample", "gene")
+            .agg(total_coverage = pl.sum("coverage"))
+        )
+        expected = (
+            total_coverage
+            .join(unbinned.select("gene", "sequence").unique(), on=["gene"])
+            .join(unbinned, on=["sample", "gene", "sequence"], how="full")
+            .filter(pl.col("sample").is_not_null())
+            .with_columns(pl.col("coverage").fill_null(0))
+            .with_columns(weight = pl.col("coverage") / pl.col("total_coverage"))
+            .group_by("gene", "sequence")
+            .agg(pl.mean("weight"))
+            .filter(pl.col("weight") > 0)
+        )
+
+        observed = pipeline(unbinned, binned)
+        self.assertDataFrameEqual(expected, observed)
+
 if __name__ == '__main__':
     unittest.main()
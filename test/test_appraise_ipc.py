@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+os.environ["POLARS_MAX_THREADS"] = "1"
+import polars as pl
+from polars.testing import assert_frame_equal
+from bird_tool_utils import in_tempdir
+from binchicken.workflow.scripts.appraise_ipc import appraise_ipc_path, has_appraise_ipc, sink_appraise, scan_appraise
+
+APPRAISE_COLUMNS = ["gene", "sample", "sequence", "num_hits", "coverage", "taxonomy", "found_in"]
+SCHEMA_OVERRIDES = {
+    "gene": str,
+    "sample": str,
+    "sequence": str,
+    "num_hits": int,
+    "coverage": float,
+    "taxonomy": str,
+    "found_in": str,
+}
+
+class Tests(unittest.TestCase):
+    def assertDataFrameEqual(self, a, b):
+        assert_frame_equal(a, b)
+
+    def test_appraise_ipc_path(self):
+        self.assertEqual("appraise/binned.otu_table.arrow", appraise_ipc_path("appraise/binned.otu_table.tsv"))
+
+    def test_scan_appraise(self):
+        otu_table = pl.DataFrame([
+            ["S3.1", "sample_1.1", "AAA", "5", "10.00", "Root", "genome_1_protein"],
+            ["S3.2", "sample_2.1", "GGG", "3", "6.50", "Root; d__Bacteria", None],
+        ], orient="row", schema=APPRAISE_COLUMNS)
+        expected = pl.DataFrame([
+            ["sample_1.1", 5, 10.0, "genome_1_protein"],
+            ["sample_2.1", 3, 6.5, None],
+        ], orient="row", schema={"sample": str, "num_hits": int, "coverage": float, "found_in": str})
+
+        with in_tempdir():
+            otu_table.write_csv("binned.otu_table.tsv", separator="\t")
+            self.assertFalse(has_appraise_ipc("binned.otu_table.tsv"))
+            observed = scan_appraise(
+                "binned.otu_table.tsv",
+                columns=["sample", "num_hits", "coverage", "found_in"],
+                schema_overrides=SCHEMA_OVERRIDES,
+                ).collect()
+            self.assertDataFrameEqual(expected, observed)
+
+            sink_appraise(otu_table, "binned.otu_table.tsv")
+            self.assertTrue(has_appraise_ipc("binned.otu_table.tsv"))
+            self.assertFalse(os.path.exists("binned.otu_table.arrow.tmp"))
+            observed = scan_appraise(
+                "binned.otu_table.tsv",
+                columns=["sample", "num_hits", "coverage", "found_in"],
+                schema_overrides=SCHEMA_OVERRIDES,
+                ).collect()
+            self.assertDataFrameEqual(expected, observed)
+
+    def test_sink_appraise_batches(self):
+        # Categories first seen in later slices, all short, before long plain strings
+        otu_table = pl.DataFrame([
+            ["S3.1", "s1", "AAA", "5", "10.00", "Root", "genome_1_protein,genome_2_protein"],
+            ["S3.2", "s2", "GGG", "3", "6.50", "Root; d__Bacteria", None],
+            ["S3.3", "s3", "CCC", "1", "1.00", "Root; d__Archaea", "genome_3_protein"],
+        ], orient="row", schema=APPRAISE_COLUMNS)
+
+        with in_tempdir():
+            sink_appraise(otu_table.lazy(), "unbinned.otu_table.tsv", BATCH_ROWS=1)
+
+            with open("unbinned.otu_table.tsv") as f:
+                lines = f.read().splitlines()
+            self.assertEqual("\t".join(APPRAISE_COLUMNS), lines[0])
+            self.assertEqual("S3.1\ts1\tAAA\t5\t10.00\tRoot\tgenome_1_protein,genome_2_protein", lines[1])
+            self.assertEqual(4, len(lines))
+
+            observed = pl.read_ipc("unbinned.otu_table.arrow", memory_map=False)
+            self.assertEqual(pl.Categorical, observed.schema["gene"])
+            self.assertEqual(pl.Categorical, observed.schema["taxonomy"])
+            self.assertDataFrameEqual(
+                otu_table.cast(SCHEMA_OVERRIDES),
+                observed.with_columns(pl.col(pl.Categorical).cast(pl.String)),
+                )
+            self.assertFalse(os.path.exists("unbinned.otu_table.arrow.staged"))
+
+    def test_scan_appraise_stale_ipc(self):
+        otu_table = pl.DataFrame([
+            ["S3.1", "sample_1.1", "AAA", "5", "10.00", "Root", None],
+        ], orient="row", schema=APPRAISE_COLUMNS)
+        provided = pl.DataFrame([
+            ["S3.1", "sample_3.1", "CCC", "2", "1.00", "Root", None],
+        ], orient="row", schema=APPRAISE_COLUMNS)
+
+        with in_tempdir():
+            otu_table.write_csv("unbinned.otu_table.tsv", separator="\t")
+            sink_appraise(otu_table, "unbinned.otu_table.tsv")
+
+            # A table replacing the previous one is read as TSV
+            provided.write_csv("unbinned.otu_table.tsv", separator="\t")
+            os.utime("unbinned.otu_table.arrow", (0, 0))
+            self.assertFalse(has_appraise_ipc("unbinned.otu_table.tsv"))
+
+            observed = scan_appraise("unbinned.otu_table.tsv", columns=["sample"]).collect()
+            self.assertEqual(["sample_3.1"], observed.get_column("sample").to_list())
+
+    def test_scan_appraise_empty(self):
+        with in_tempdir():
+            otu_table = pl.DataFrame(schema={c: str for c in APPRAISE_COLUMNS})
+            otu_table.write_csv("unbinned.otu_table.tsv", separator="\t")
+            sink_appraise(otu_table, "unbinned.otu_table.tsv")
+
+            observed = scan_appraise("unbinned.otu_table.tsv", schema_overrides=SCHEMA_OVERRIDES).collect()
+
+        self.assertEqual(APPRAISE_COLUMNS, observed.columns)
+        self.assertEqual(0, observed.height)
+        self.assertEqual(pl.String, observed.schema["sample"])
+
+
+if __name__ == '__main__':
+    unittest.main()
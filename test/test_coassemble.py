@@ -9,6 +9,7 @@ import subprocess
 from snakemake.io import load_configfile
 import polars as pl
 from polars.testing import assert_frame_equal
+from binchicken.workflow.scripts.collect_reference_bins import reference_key
 
 path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
 path_to_conda = os.path.join(path_to_data,'.conda')
@@ -84,6 +85,11 @@ def write_string_to_file(string, filename):
     with open(filename, "w") as f:
         f.write("\n".join(string.split(" ")))
 
+def read_fastq_records(path):
+    with gzip.open(path, "rt") as f:
+        lines = f.read().splitlines()
+    return [tuple(lines[i:i + 4]) for i in range(0, len(lines), 4)]
+
 class Tests(unittest.TestCase):
     def test_coassemble(self):
         with in_tempdir():
@@ -431,6 +437,101 @@ class Tests(unittest.TestCase):
             map_sample_3R_path = os.path.join("test", "coassemble", "mapping", "sample_3_unmapped.2.fq.gz")
             self.assertTrue(os.path.exists(map_sample_3R_path))
 
+    def test_coassemble_unmapping_streaming(self):
+        with in_tempdir():
+            cmd = (
+                f"binchicken coassemble "
+                f"--assemble-unmapped "
+                f"--forward {SAMPLE_READS_FORWARD} "
+                f"--reverse {SAMPLE_READS_REVERSE} "
+                f"--genomes {GENOMES} "
+                f"--genome-transcripts {GENOME_TRANSCRIPTS} "
+                f"--sample-singlem {SAMPLE_SINGLEM} "
+                f"--sample-read-size {SAMPLE_READ_SIZE} "
+                f"--genome-singlem {GENOME_SINGLEM} "
+                f"--singlem-metapackage {METAPACKAGE} "
+                f"--conda-prefix {path_to_conda} "
+            )
+            extern.run(cmd + "--output baseline ")
+            extern.run(cmd + "--unmapping-streaming --output streaming ")
+
+            for sample in ["sample_1", "sample_2", "sample_3"]:
+                for read in ["1", "2"]:
+                    filename = f"{sample}_unmapped.{read}.fq.gz"
+                    baseline = read_fastq_records(os.path.join("baseline", "coassemble", "mapping", filename))
+                    streaming = read_fastq_records(os.path.join("streaming", "coassemble", "mapping", filename))
+
+                    # Secondary and supplementary alignments must not duplicate reads in the output
+                    self.assertEqual(len(streaming), len(set(r[0] for r in streaming)))
+                    self.assertEqual(sorted(baseline), sorted(streaming))
+
+                with open(os.path.join("baseline", "coassemble", "mapping", f"{sample}_unmapped.bases")) as f:
+                    baseline_bases = f.read()
+                with open(os.path.join("streaming", "coassemble", "mapping", f"{sample}_unmapped.bases")) as f:
+                    self.assertEqual(baseline_bases, f.read())
+
+    def test_coassemble_unmapping_streaming_dryrun(self):
+        with in_tempdir():
+            # Unmapping waits for cluster_graph, so unmapped reads are requested directly
+            unmapped_reads = os.path.abspath(os.path.join("test", "coassemble", "mapping", "sample_1_unmapped.1.fq.gz"))
+            cmd = (
+                f"binchicken coassemble "
+                f"--assemble-unmapped "
+                f"--unmapping-streaming "
+                f"--forward {SAMPLE_READS_FORWARD} "
+                f"--reverse {SAMPLE_READS_REVERSE} "
+                f"--genomes {GENOMES} "
+                f"--genome-transcripts {GENOME_TRANSCRIPTS} "
+                f"--sample-singlem {SAMPLE_SINGLEM} "
+                f"--sample-read-size {SAMPLE_READ_SIZE} "
+                f"--genome-singlem {GENOME_SINGLEM} "
+                f"--singlem-metapackage {METAPACKAGE} "
+                f"--output test "
+                f"--conda-prefix {path_to_conda} "
+                f"--dryrun "
+                f"--snakemake-args \" {unmapped_reads} --quiet\" "
+            )
+            output = extern.run(cmd)
+
+            self.assertRegex(output, r"\ncollect_reference_bins +1\n")
+            self.assertRegex(output, r"\nmap_reads_streaming +1\n")
+            self.assertNotRegex(output, r"\nmap_reads +")
+            self.assertNotRegex(output, r"\nfilter_bam_files +")
+            self.assertNotRegex(output, r"\nbam_to_fastq +")
+
+            config = load_configfile(os.path.join("test", "config.yaml"))
+            self.assertTrue(config["unmapping_streaming"])
+
+    def test_coassemble_query_input_extra_identities_dryrun(self):
+        with in_tempdir():
+            cmd = (
+                f"binchicken coassemble "
+                f"--forward {SAMPLE_READS_FORWARD} "
+                f"--reverse {SAMPLE_READS_REVERSE} "
+                f"--genomes {GENOMES} "
+                f"--genome-transcripts {GENOME_TRANSCRIPTS} "
+                f"--sample-query {SAMPLE_QUERY} "
+                f"--sample-singlem {SAMPLE_QUERY_SINGLEM} "
+                f"--sample-read-size {SAMPLE_READ_SIZE} "
+                f"--appraise-extra-sequence-identities 86 89 "
+                f"--output test "
+                f"--conda-prefix {path_to_conda} "
+                f"--dryrun "
+                f"--snakemake-args \" --quiet\" "
+            )
+            output = extern.run(cmd)
+
+            self.assertTrue("query_processing" in output)
+            self.assertTrue("singlem_appraise_filtered_identity" in output)
+
+            config_path = os.path.join("test", "config.yaml")
+            config = load_configfile(config_path)
+            self.assertEqual([0.86, 0.89], config["appraise_extra_sequence_identities"])
+
+            # Repeated thresholds would write to the same tables
+            with self.assertRaises(extern.ExternCalledProcessError):
+                extern.run(cmd.replace("--appraise-extra-sequence-identities 86 89 ", "--appraise-extra-sequence-identities 89 89 "))
+
     def test_coassemble_query_input(self):
         with in_tempdir():
             cmd = (
@@ -918,7 +1019,10 @@ class Tests(unittest.TestCase):
             config_path = os.path.join("test", "config.yaml")
             self.assertTrue(os.path.exists(config_path))
 
-            genomes_to_map_path = os.path.join("test", "coassemble", "mapping", "sample_1_reference.fna")
+            reference_bins_path = os.path.join("test", "coassemble", "mapping", "reference_bins.tsv")
+            self.assertTrue(os.path.exists(reference_bins_path))
+            reference_genomes = pl.read_csv(reference_bins_path, separator="\t").filter(pl.col("sample") == "sample_1").get_column("genome").to_list()
+            genomes_to_map_path = os.path.join("test", "coassemble", "mapping", "references", f"{reference_key(reference_genomes)}.fna")
             self.assertTrue(os.path.exists(genomes_to_map_path))
             with open(genomes_to_map_path) as f:
                 lines = f.read()
@@ -985,7 +1089,7 @@ class Tests(unittest.TestCase):
             self.assertTrue("target_weighting" not in output)
             self.assertTrue("cluster_graph" in output)
             self.assertTrue("qc_reads" not in output)
-            self.assertTrue("collect_genomes" not in output)
+            self.assertTrue("collect_reference_bins" not in output)
             self.assertTrue("map_reads" not in output)
             self.assertTrue("finish_mapping" not in output)
             self.assertTrue("aviary_commands" in output)
@@ -1027,7 +1131,7 @@ class Tests(unittest.TestCase):
             self.assertTrue("target_weighting" not in output)
             self.assertTrue("cluster_graph" in output)
             self.assertTrue("qc_reads" not in output)
-            self.assertTrue("collect_genomes" not in output)
+            self.assertTrue("collect_reference_bins" not in output)
             self.assertTrue("map_reads" not in output)
             self.assertTrue("finish_mapping" not in output)
             self.assertTrue("aviary_commands" not in output)
@@ -1065,16 +1169,18 @@ class Tests(unittest.TestCase):
             self.assertTrue("singlem_appraise" in output)
             self.assertTrue("query_processing" not in output)
             self.assertTrue("single_assembly" not in output)
-            self.assertTrue("count_bp_reads" in output)
+            self.assertTrue("count_bp_reads" not in output)
+            self.assertTrue("harvest_read_size" in output)
             self.assertTrue("abundance_weighting" not in output)
             self.assertTrue("sketch_samples" not in output)
             self.assertTrue("distance_samples" not in output)
             self.assertTrue("target_elusive" in output)
             self.assertTrue("target_weighting" not in output)
             self.assertTrue("cluster_graph" in output)
+            # QC and unmapping wait for cluster_graph to select the coassembly samples
             self.assertTrue("qc_reads" not in output)
-            self.assertTrue("collect_genomes" in output)
-            self.assertTrue("map_reads" in output)
+            self.assertTrue("collect_reference_bins" not in output)
+            self.assertTrue("map_reads" not in output)
             self.assertTrue("finish_mapping" in output)
             self.assertTrue("aviary_commands" not in output)
             self.assertTrue("aviary_assemble" not in output)
@@ -1112,22 +1218,57 @@ class Tests(unittest.TestCase):
             self.assertTrue("singlem_appraise" in output)
             self.assertTrue("query_processing" not in output)
             self.assertTrue("single_assembly" not in output)
-            self.assertTrue("count_bp_reads" in output)
+            self.assertTrue("count_bp_reads" not in output)
+            self.assertTrue("harvest_read_size" in output)
             self.assertTrue("abundance_weighting" not in output)
             self.assertTrue("sketch_samples" not in output)
             self.assertTrue("distance_samples" not in output)
             self.assertTrue("target_elusive" in output)
             self.assertTrue("target_weighting" not in output)
             self.assertTrue("cluster_graph" in output)
-            self.assertTrue("qc_reads" in output)
-            self.assertTrue("collect_genomes" in output)
-            self.assertTrue("map_reads" in output)
+            # QC and unmapping wait for cluster_graph to select the coassembly samples
+            self.assertTrue("qc_reads" not in output)
+            self.assertTrue("collect_reference_bins" not in output)
+            self.assertTrue("map_reads" not in output)
             self.assertTrue("finish_mapping" in output)
             self.assertTrue("aviary_commands" not in output)
             self.assertTrue("aviary_assemble" not in output)
             self.assertTrue("aviary_recover" not in output)
             self.assertTrue("aviary_combine" in output)
 
+    def test_coassemble_intermediate_compression_level_dryrun(self):
+        with in_tempdir():
+            # QC waits for cluster_graph, so its reads are requested directly to show the fastp command
+            qc_reads = os.path.abspath(os.path.join("test", "coassemble", "qc", "sample_1_1.fastq.gz"))
+            cmd = (
+                f"binchicken coassemble "
+                f"--assemble-unmapped "
+                f"--run-qc "
+                f"--forward {SAMPLE_READS_FORWARD} "
+                f"--reverse {SAMPLE_READS_REVERSE} "
+                f"--genomes {GENOMES} "
+                f"--genome-transcripts {GENOME_TRANSCRIPTS} "
+                f"--sample-singlem {SAMPLE_SINGLEM} "
+                f"--sample-read-size {SAMPLE_READ_SIZE} "
+                f"--genome-singlem {GENOME_SINGLEM} "
+                f"--singlem-metapackage {METAPACKAGE} "
+                f"--intermediate-compression-level 9 "
+                f"--output test "
+                f"--conda-prefix {path_to_conda} "
+                f"--dryrun "
+                f"--snakemake-args \" --printshellcmds {qc_reads}\" "
+            )
+            output = extern.run(cmd)
+
+            self.assertRegex(output, r"\nfastp .* -z 9 ")
+
+            config = load_configfile(os.path.join("test", "config.yaml"))
+            self.assertEqual(config["intermediate_compression_level"], 9)
+
+            # fastp only accepts levels 1-9
+            with self.assertRaises(extern.ExternCalledProcessError):
+                extern.run(cmd.replace("--intermediate-compression-level 9", "--intermediate-compression-level 0"))
+
     def test_coassemble_files_of_paths(self):
         with in_tempdir():
             write_string_to_file(SAMPLE_READS_FORWARD, "sample_reads_forward")
@@ -1173,9 +1314,10 @@ class Tests(unittest.TestCase):
             self.assertTrue("target_elusive" in output)
             self.assertTrue("target_weighting" not in output)
             self.assertTrue("cluster_graph" in output)
+            # QC and unmapping wait for cluster_graph to select the coassembly samples
             self.assertTrue("qc_reads" not in output)
-            self.assertTrue("collect_genomes" in output)
-            self.assertTrue("map_reads" in output)
+            self.assertTrue("collect_reference_bins" not in output)
+            self.assertTrue("map_reads" not in output)
             self.assertTrue("finish_mapping" in output)
             self.assertTrue("aviary_commands" in output)
 
@@ -1229,7 +1371,7 @@ class Tests(unittest.TestCase):
             self.assertTrue("target_weighting" not in output)
             self.assertTrue("cluster_graph" in output)
             self.assertTrue("qc_reads" not in output)
-            self.assertTrue("collect_genomes" not in output)
+            self.assertTrue("collect_reference_bins" not in output)
             self.assertTrue("map_reads" not in output)
             self.assertTrue("finish_mapping" not in output)
             self.assertTrue("aviary_commands" in output)
@@ -1269,7 +1411,7 @@ class Tests(unittest.TestCase):
             self.assertTrue("target_weighting" not in output)
             self.assertTrue("cluster_graph" in output)
             self.assertTrue("qc_reads" not in output)
-            self.assertTrue("collect_genomes" not in output)
+            self.assertTrue("collect_reference_bins" not in output)
             self.assertTrue("map_reads" not in output)
             self.assertTrue("finish_mapping" not in output)
             self.assertTrue("aviary_commands" in output)
@@ -1356,15 +1498,46 @@ class Tests(unittest.TestCase):
             self.assertTrue("abundance_weighting" not in output)
             self.assertTrue("sketch_samples" in output)
             self.assertTrue("distance_samples" in output)
+            self.assertTrue("compact_distances" in output)
             self.assertTrue("target_elusive" in output)
             self.assertTrue("target_weighting" not in output)
             self.assertTrue("cluster_graph" in output)
             self.assertTrue("qc_reads" not in output)
-            self.assertTrue("collect_genomes" not in output)
+            self.assertTrue("collect_reference_bins" not in output)
             self.assertTrue("map_reads" not in output)
             self.assertTrue("finish_mapping" not in output)
             self.assertTrue("aviary_commands" in output)
 
+    def test_coassemble_preclustered_sketch_cache_dryrun(self):
+        with in_tempdir():
+            os.makedirs("sketch_cache")
+            cmd = (
+                f"binchicken coassemble "
+                f"--kmer-precluster always "
+                f"--precluster-sketch-cache sketch_cache "
+                f"--forward {SAMPLE_READS_FORWARD} "
+                f"--reverse {SAMPLE_READS_REVERSE} "
+                f"--genomes {GENOMES} "
+                f"--genome-transcripts {GENOME_TRANSCRIPTS} "
+                f"--sample-singlem {SAMPLE_SINGLEM} "
+                f"--sample-read-size {SAMPLE_READ_SIZE} "
+                f"--genome-singlem {GENOME_SINGLEM} "
+                f"--singlem-metapackage {METAPACKAGE} "
+                f"--output test "
+                f"--conda-prefix {path_to_conda} "
+                f"--dryrun "
+                f"--snakemake-args \" --quiet\" "
+            )
+            output = extern.run(cmd)
+
+            self.assertTrue("sketch_samples" in output)
+            self.assertTrue("update_distances" in output)
+            self.assertTrue("distance_samples" not in output)
+            self.assertTrue("target_elusive" in output)
+
+            config = load_configfile(os.path.join("test", "config.yaml"))
+            self.assertEqual(config["precluster_sketch_cache"], os.path.abspath("sketch_cache"))
+
     def test_coassemble_weighted_dryrun(self):
         with in_tempdir():
             cmd = (
@@ -1400,11 +1573,102 @@ class Tests(unittest.TestCase):
             self.assertTrue("target_weighting" in output)
             self.assertTrue("cluster_graph" in output)
             self.assertTrue("qc_reads" not in output)
-            self.assertTrue("collect_genomes" not in output)
+            self.assertTrue("collect_reference_bins" not in output)
             self.assertTrue("map_reads" not in output)
             self.assertTrue("finish_mapping" not in output)
             self.assertTrue("aviary_commands" in output)
 
+    def test_coassemble_pipe_batch_dryrun(self):
+        with in_tempdir():
+            cmd = (
+                f"binchicken coassemble "
+                f"--forward {SAMPLE_READS_FORWARD} "
+                f"--reverse {SAMPLE_READS_REVERSE} "
+                f"--genomes {GENOMES} "
+                f"--singlem-metapackage {METAPACKAGE} "
+                f"--pipe-batch-size 2 "
+                f"--output test "
+                f"--conda-prefix {path_to_conda} "
+                f"--dryrun "
+                f"--snakemake-args \" --quiet\" "
+            )
+            output = extern.run(cmd)
+
+            self.assertRegex(output, r"\nsinglem_pipe_reads_batch +2\n")
+            self.assertRegex(output, r"\nsinglem_split_reads +2\n")
+            self.assertRegex(output, r"\nsinglem_split_reads_all +1\n")
+            self.assertNotRegex(output, r"\nsinglem_pipe_reads +")
+            self.assertRegex(output, r"\ngenome_transcripts +1\n")
+            self.assertRegex(output, r"\nsinglem_pipe_genomes_batch +1\n")
+            self.assertRegex(output, r"\nsinglem_split_genomes +1\n")
+            self.assertRegex(output, r"\nsinglem_split_genomes_all +1\n")
+            self.assertNotRegex(output, r"\nsinglem_pipe_genomes +")
+            self.assertTrue("singlem_summarise_genomes" in output)
+            self.assertTrue("singlem_appraise" in output)
+
+            config = load_configfile(os.path.join("test", "config.yaml"))
+            self.assertEqual(config["pipe_batch_size"], 2)
+
+    def test_coassemble_appraise_batch_dryrun(self):
+        with in_tempdir():
+            cmd = (
+                f"binchicken coassemble "
+                f"--forward {SAMPLE_READS_FORWARD} "
+                f"--reverse {SAMPLE_READS_REVERSE} "
+                f"--genomes {GENOMES} "
+                f"--sample-singlem {SAMPLE_SINGLEM} "
+                f"--sample-read-size {SAMPLE_READ_SIZE} "
+                f"--genome-singlem {GENOME_SINGLEM} "
+                f"--singlem-metapackage {METAPACKAGE} "
+                f"--appraise-batch-size 2 "
+                f"--output test "
+                f"--conda-prefix {path_to_conda} "
+                f"--dryrun "
+                f"--snakemake-args \" --quiet\" "
+            )
+            output = extern.run(cmd)
+
+            self.assertRegex(output, r"\nsinglem_appraise_batch +2\n")
+            self.assertRegex(output, r"\nsinglem_appraise_merge +1\n")
+            self.assertNotRegex(output, r"\nsinglem_appraise +")
+            self.assertTrue("singlem_appraise_filtered" not in output)
+            self.assertTrue("target_elusive" in output)
+
+            config = load_configfile(os.path.join("test", "config.yaml"))
+            self.assertEqual(config["appraise_batch_size"], 2)
+
+    def test_coassemble_native_appraise_dryrun(self):
+        with in_tempdir():
+            cmd = (
+                f"binchicken coassemble "
+                f"--forward {SAMPLE_READS_FORWARD} "
+                f"--reverse {SAMPLE_READS_REVERSE} "
+                f"--genomes {GENOMES} "
+                f"--sample-singlem {SAMPLE_SINGLEM} "
+                f"--sample-read-size {SAMPLE_READ_SIZE} "
+                f"--genome-singlem {GENOME_SINGLEM} "
+                f"--singlem-metapackage {METAPACKAGE} "
+                f"--appraise-engine native "
+                f"--appraise-batch-size 2 "
+                f"--appraise-extra-sequence-identities 86 "
+                f"--output test "
+                f"--conda-prefix {path_to_conda} "
+                f"--dryrun "
+                f"--snakemake-args \" --quiet\" "
+            )
+            output = extern.run(cmd)
+
+            self.assertRegex(output, r"\nnative_appraise +1\n")
+            self.assertNotRegex(output, r"\nsinglem_appraise +")
+            self.assertTrue("singlem_appraise_batch" not in output)
+            self.assertRegex(output, r"\nsinglem_appraise_filtered +1\n")
+            self.assertRegex(output, r"\nsinglem_appraise_filtered_identity +1\n")
+            self.assertTrue("target_elusive" in output)
+
+            config = load_configfile(os.path.join("test", "config.yaml"))
+            self.assertEqual(config["appraise_engine"], "native")
+            self.assertEqual(config["appraise_batch_size"], 0)
+
     def test_coassemble_metapackage_env_variable(self):
         with in_tempdir():
             os.environ['SINGLEM_METAPACKAGE_PATH'] = METAPACKAGE
@@ -1503,7 +1767,7 @@ class Tests(unittest.TestCase):
             with open(read_size_path) as f:
                 self.assertEqual(expected, f.read())
 
-            sketch_path = os.path.join("test", "coassemble", "sketch", "samples.sig")
+            sketch_path = os.path.join("test", "coassemble", "sketch", "samples.sig.zip")
             self.assertTrue(os.path.exists(sketch_path))
 
             distance_path = os.path.join("test", "coassemble", "sketch", "samples.csv")
@@ -1576,7 +1840,7 @@ class Tests(unittest.TestCase):
             config_path = os.path.join("test", "config.yaml")
             self.assertTrue(os.path.exists(config_path))
 
-            sketch_path = os.path.join("test", "coassemble", "sketch", "samples.sig")
+            sketch_path = os.path.join("test", "coassemble", "sketch", "samples.sig.zip")
             self.assertTrue(os.path.exists(sketch_path))
 
             distance_path = os.path.join("test", "coassemble", "sketch", "samples.csv")
@@ -1715,7 +1979,7 @@ class Tests(unittest.TestCase):
             with open(read_size_path) as f:
                 self.assertEqual(expected, f.read())
 
-            sketch_path = os.path.join("test", "coassemble", "sketch", "samples.sig")
+            sketch_path = os.path.join("test", "coassemble", "sketch", "samples.sig.zip")
             self.assertFalse(os.path.exists(sketch_path))
 
             distance_path = os.path.join("test", "coassemble", "sketch", "samples.csv")
@@ -1802,7 +2066,7 @@ class Tests(unittest.TestCase):
             with open(read_size_path) as f:
                 self.assertEqual(expected, f.read())
 
-            sketch_path = os.path.join("test", "coassemble", "sketch", "samples.sig")
+            sketch_path = os.path.join("test", "coassemble", "sketch", "samples.sig.zip")
             self.assertTrue(os.path.exists(sketch_path))
 
             distance_path = os.path.join("test", "coassemble", "sketch", "samples.csv")
@@ -2090,8 +2354,9 @@ class Tests(unittest.TestCase):
             self.assertTrue("target_elusive" in output)
             self.assertTrue("target_weighting" not in output)
             self.assertTrue("cluster_graph" in output)
-            self.assertTrue("qc_reads" in output)
-            self.assertTrue("collect_genomes" not in output)
+            # QC and unmapping wait for cluster_graph to select the coassembly samples
+            self.assertTrue("qc_reads" not in output)
+            self.assertTrue("collect_reference_bins" not in output)
             self.assertTrue("map_reads" not in output)
             self.assertTrue("finish_mapping" not in output)
             self.assertTrue("aviary_commands" in output)
@@ -4,9 +4,12 @@ import unittest
 import os
 os.environ["POLARS_MAX_THREADS"] = "1"
 import polars as pl
-from binchicken.workflow.scripts.collect_reference_bins import pipeline
+from polars.testing import assert_frame_equal
+from bird_tool_utils import in_tempdir
+from binchicken.workflow.scripts.collect_reference_bins import pipeline, batch_pipeline, reference_key, load_reference_sets, prefix_genome
 
 APPRAISE_COLUMNS=["gene", "sample", "sequence", "num_hits", "coverage", "taxonomy", "found_in"]
+REFERENCE_BINS_COLUMNS=["sample", "genome"]
 
 class Tests(unittest.TestCase):
     def test_collect_reference_bins(self):
@@ -116,5 +119,79 @@ class Tests(unittest.TestCase):
         self.assertEqual(expected, observed)
 
 
+    def test_collect_reference_bins_batch(self):
+        appraise_binned = pl.DataFrame([
+            ["S3.1", "sample_1.1", "AAA", 5, 10, "Root", "genome_1_protein,genome_2_protein"],
+            ["S3.2", "sample_1.1", "AAA", 5, 10, "Root", "genome_1_protein"],
+            ["S3.3", "sample_1.1", "AAA", 5, 10, "Root", "genome_1_protein"],
+            ["S3.4", "sample_1.1", "AAA", 5, 10, "Root", "genome_1_protein"],
+            ["S3.5", "sample_1.1", "AAA", 5, 10, "Root", "genome_1_protein"],
+            ["S3.6", "sample_1.1", "AAA", 5, 10, "Root", "genome_1_protein"],
+            ["S3.7", "sample_1.1", "AAA", 5, 10, "Root", "genome_1_protein"],
+            ["S3.8", "sample_1.1", "AAA", 5, 10, "Root", "genome_1_protein"],
+            ["S3.9", "sample_1.1", "AAA", 5, 10, "Root", "genome_1_protein"],
+            ["S3.10", "sample_1.1", "AAA", 5, 10, "Root", "genome_1_protein"],
+            ["S3.1", "sample_2.1", "AAA", 5, 10, "Root", "genome_2_protein"],
+            ["S3.1", "sample_3.1", "AAA", 1, 10, "Root", "genome_3_protein"],
+        ], orient="row", schema=APPRAISE_COLUMNS)
+        appraise_unbinned = pl.DataFrame([
+            ["S3.1", "sample_1.1", "AAA", 5, 10, "Root", ""],
+            ["S3.1", "sample_2.1", "AAA", 5, 10, "Root", ""],
+            ["S3.1", "sample_3.1", "AAA", 20, 10, "Root", ""],
+            ["S3.1", "sample_4.1", "AAA", 5, 10, "Root", ""],
+        ], orient="row", schema=APPRAISE_COLUMNS)
+
+        expected = pl.DataFrame([
+            ["sample_1", "genome_1"],
+            ["sample_2", "genome_2"],
+        ], orient="row", schema=REFERENCE_BINS_COLUMNS)
+        observed = batch_pipeline(appraise_binned, appraise_unbinned, ["sample_1", "sample_2", "sample_3", "sample_4"])
+        assert_frame_equal(expected, observed)
+
+        for sample in ["sample_1", "sample_2", "sample_3", "sample_4"]:
+            self.assertEqual(
+                set(expected.filter(pl.col("sample") == sample).get_column("genome").to_list()),
+                pipeline(appraise_binned, appraise_unbinned, sample),
+                )
+
+    def test_reference_key(self):
+        self.assertEqual(reference_key(["genome_1", "genome_2"]), reference_key(["genome_2", "genome_1"]))
+        self.assertNotEqual(reference_key(["genome_1"]), reference_key(["genome_1", "genome_2"]))
+
+    def test_load_reference_sets(self):
+        with in_tempdir():
+            pl.DataFrame([
+                ["sample_1", "genome_2"],
+                ["sample_1", "genome_1"],
+                ["sample_2", "genome_1"],
+                ["sample_2", "genome_2"],
+                ["sample_3", "genome_1"],
+            ], orient="row", schema=REFERENCE_BINS_COLUMNS).write_csv("reference_bins.tsv", separator="\t")
+
+            sample_keys, key_genomes = load_reference_sets("reference_bins.tsv")
+
+            shared_key = reference_key(["genome_1", "genome_2"])
+            self.assertEqual({"sample_1": shared_key, "sample_2": shared_key, "sample_3": reference_key(["genome_1"])}, sample_keys)
+            self.assertEqual(["genome_1", "genome_2"], key_genomes[shared_key])
+            self.assertEqual(["genome_1"], key_genomes[reference_key(["genome_1"])])
+            self.assertEqual([], key_genomes[reference_key([])])
+
+    def test_prefix_genome(self):
+        with in_tempdir():
+            with open("genome_1.fna", "w") as f:
+                f.write(">contig_1 description\nACGT\nACGT\n>contig_2\nAC>GT\n")
+
+            expected = ">genome_1~contig_1 description\nACGT\nACGT\n>genome_1~contig_2\nAC>GT\n"
+
+            prefix_genome("genome_1.fna", "genome_1", "output.fna")
+            with open("output.fna") as f:
+                self.assertEqual(expected, f.read())
+
+            # Headers split across chunk boundaries
+            for chunk_size in range(1, 8):
+                prefix_genome("genome_1.fna", "genome_1", "output.fna", CHUNK_SIZE=chunk_size)
+                with open("output.fna") as f:
+                    self.assertEqual(expected, f.read())
+
 if __name__ == '__main__':
     unittest.main()
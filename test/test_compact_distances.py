@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+os.environ["POLARS_MAX_THREADS"] = "1"
+import numpy as np
+import polars as pl
+from polars.testing import assert_frame_equal
+from bird_tool_utils import in_tempdir
+from binchicken.workflow.scripts.compact_distances import index_distances, prune_top_k, write_compact_distances, read_compact_distances, pipeline
+from binchicken.workflow.scripts.target_elusive import get_clusters, get_clusters_compact
+
+SAMPLE_DISTANCES_COLUMNS = {
+    "query_name": str,
+    "match_name": str,
+    "jaccard": float,
+}
+
+class Tests(unittest.TestCase):
+    def assertDataFrameEqual(self, a, b):
+        assert_frame_equal(a, b, check_dtypes=False, check_row_order=False)
+
+    def test_index_distances(self):
+        names, query_idx, match_idx = index_distances(
+            np.array(["sample_2", "sample_1"], dtype=object),
+            np.array(["sample_3", "sample_3"], dtype=object),
+            )
+
+        self.assertEqual(["sample_1", "sample_2", "sample_3"], list(names))
+        self.assertEqual([1, 0], list(query_idx))
+        self.assertEqual([2, 2], list(match_idx))
+
+    def test_prune_top_k(self):
+        query_idx = np.array([0, 0, 0, 1, 2])
+        match_idx = np.array([1, 2, 3, 2, 3])
+        jaccard = np.array([0.9, 0.5, 0.1, 0.2, 0.3])
+
+        # Pairs 0-3 and 1-2 are not the top match of either sample
+        observed = prune_top_k(query_idx, match_idx, jaccard, 1)
+        self.assertEqual([0, 1, 4], list(observed))
+
+        observed = prune_top_k(query_idx, match_idx, jaccard, 2)
+        self.assertEqual([0, 1, 2, 3, 4], list(observed))
+
+    def test_compact_distances_roundtrip(self):
+        with in_tempdir():
+            write_compact_distances(
+                "samples.dist",
+                np.array(["sample_1", "sample_2", "sample_3"]),
+                np.array([0, 0]),
+                np.array([1, 2]),
+                np.array([0.5, 0.25]),
+                )
+            names, pairs = read_compact_distances("samples.dist")
+
+            self.assertEqual(["sample_1", "sample_2", "sample_3"], list(names))
+            self.assertEqual([0, 0], list(pairs["query"]))
+            self.assertEqual([1, 2], list(pairs["match"]))
+            self.assertEqual([0.5, 0.25], list(pairs["jaccard"]))
+
+    def test_compact_distances_roundtrip_empty(self):
+        with in_tempdir():
+            write_compact_distances("samples.dist", np.array([]), np.array([]), np.array([]), np.array([]))
+            names, pairs = read_compact_distances("samples.dist")
+
+            self.assertEqual([], list(names))
+            self.assertEqual(0, len(pairs))
+
+    def test_compact_distances_invalid(self):
+        with in_tempdir():
+            with open("samples.dist", "w") as f:
+                f.write("query_name,match_name,jaccard\n")
+
+            with self.assertRaises(ValueError):
+                read_compact_distances("samples.dist")
+
+    def test_get_clusters_compact(self):
+        sample_distances = pl.DataFrame([
+            ["sample_1.1", "sample_2.1", 0.5],
+            ["sample_1.1", "sample_3.1", 0.001],
+            ["sample_2.1", "sample_3.1", 0.1],
+            ["sample_2.1", "sample_4.1", 0.3],
+            ["sample_3.1", "sample_4.1", 0.7],
+        ], orient="row", schema=SAMPLE_DISTANCES_COLUMNS)
+        samples = set(["sample_1", "sample_2", "sample_3", "sample_4"])
+
+        with in_tempdir():
+            sample_distances.write_csv("samples.csv")
+            pipeline("samples.csv", "samples.dist", samples=samples, TOP_K=3)
+
+            expected = get_clusters(sample_distances.filter(pl.col("jaccard") > 0.01), samples, PRECLUSTER_SIZE=3, MAX_COASSEMBLY_SAMPLES=3)
+            observed = get_clusters_compact("samples.dist", PRECLUSTER_SIZE=3, MAX_COASSEMBLY_SAMPLES=3)
+            self.assertDataFrameEqual(expected, observed)
+
+    def test_get_clusters_compact_merged_names(self):
+        # Sketches of the same sample are merged before pruning, summing their distances
+        sample_distances = pl.DataFrame([
+            ["sample_1.1", "sample_2.1", 0.2],
+            ["sample_1_R1", "sample_2.1", 0.2],
+            ["sample_1.1", "sample_1_R1", 0.9],
+            ["sample_2.1", "sample_3.1", 0.3],
+            ["sample_3.1", "sample_4.1", 0.7],
+        ], orient="row", schema=SAMPLE_DISTANCES_COLUMNS)
+        samples = set(["sample_1", "sample_2", "sample_3", "sample_4"])
+
+        with in_tempdir():
+            sample_distances.write_csv("samples.csv")
+            pipeline("samples.csv", "samples.dist", samples=samples, TOP_K=1)
+
+            names, pairs = read_compact_distances("samples.dist")
+            self.assertEqual(["sample_1", "sample_2", "sample_3", "sample_4"], list(names))
+            self.assertEqual([(0, 1), (2, 3)], sorted(zip(pairs["query"].tolist(), pairs["match"].tolist())))
+            self.assertAlmostEqual(0.4, pairs["jaccard"][np.argmin(pairs["query"])], places=6)
+
+            expected = get_clusters(sample_distances, samples)
+            observed = get_clusters_compact("samples.dist")
+            self.assertDataFrameEqual(expected, observed)
+
+    def test_get_clusters_compact_empty(self):
+        with in_tempdir():
+            pl.DataFrame(schema=SAMPLE_DISTANCES_COLUMNS).write_csv("samples.csv")
+            pipeline("samples.csv", "samples.dist")
+
+            observed = get_clusters_compact("samples.dist")
+            self.assertDataFrameEqual(pl.DataFrame(schema={"samples": str}), observed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+import gzip
+import json
+import random
+os.environ["POLARS_MAX_THREADS"] = "1"
+import polars as pl
+from polars.testing import assert_frame_equal
+from bird_tool_utils import in_tempdir
+from binchicken.workflow.scripts.count_bp_reads import count_bases, estimate_bases, file_key, pipeline, harvest_read_size
+
+path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
+SAMPLE_1_F = os.path.join(path_to_data, "sample_1.1.fq")
+SAMPLE_1_R = os.path.join(path_to_data, "sample_1.2.fq")
+
+CACHE_COLUMNS = {
+    "path": str,
+    "size": int,
+    "mtime": int,
+    "bases": int,
+    }
+
+def write_fastq(path, num_records, seed=1):
+    """
+    Write records of varying lengths, optionally as several gzip members
+    """
+    rng = random.Random(seed)
+    records = []
+    for i in range(num_records):
+        length = rng.randint(100, 150)
+        sequence = "".join(rng.choices("ACGT", k=length))
+        quality = "".join(rng.choices("@ABCDEFGHI", k=length))
+        records.append(f"@read_{i} description\n{sequence}\n+\n{quality}\n")
+
+    if path.endswith(".gz"):
+        with open(path, "wb") as f:
+            for i in range(0, num_records, 1000):
+                f.write(gzip.compress("".join(records[i:i + 1000]).encode()))
+    else:
+        with open(path, "w") as f:
+            f.write("".join(records))
+
+    return sum(len(r.split("\n")[1]) for r in records)
+
+def expected_bases(path):
+    with open(path) as f:
+        return sum(len(line.rstrip("\n")) for i, line in enumerate(f) if i % 4 == 1)
+
+class Tests(unittest.TestCase):
+    def assertDataFrameEqual(self, a, b):
+        assert_frame_equal(a, b, check_dtypes=False, check_row_order=False)
+
+    def test_count_bases(self):
+        self.assertEqual(expected_bases(SAMPLE_1_F), count_bases(SAMPLE_1_F))
+
+    def test_count_bases_chunked(self):
+        with in_tempdir():
+            with open(SAMPLE_1_F) as f:
+                content = f.read()
+            with gzip.open("reads.fq.gz", "wt") as f:
+                f.write(content)
+            with open("reads_no_newline.fq", "w") as f:
+                f.write(content.rstrip("\n"))
+
+            expected = expected_bases(SAMPLE_1_F)
+            for chunk_size in [1, 3, 17, 1000]:
+                self.assertEqual(expected, count_bases("reads.fq.gz", CHUNK_SIZE=chunk_size))
+                self.assertEqual(expected, count_bases("reads_no_newline.fq", CHUNK_SIZE=chunk_size))
+
+    def test_count_bases_sequence_line_only(self):
+        with in_tempdir():
+            with open("reads.fq", "w") as f:
+                f.write("@read_1 description\nACGT\n+\nIIII\n@read_2\nACG\n+read_2\nIII\n")
+
+            self.assertEqual(7, count_bases("reads.fq", CHUNK_SIZE=5))
+
+    def test_pipeline(self):
+        with in_tempdir():
+            with open("sample_2.1.fq", "w") as f:
+                f.write("@read_1\nACGT\n+\nIIII\n")
+            with open("sample_2.2.fq", "w") as f:
+                f.write("@read_1\nACGTA\n+\nIIIII\n")
+
+            read_size, cache = pipeline(
+                ["sample_1", "sample_2"],
+                [SAMPLE_1_F, "sample_2.1.fq"],
+                [SAMPLE_1_R, "sample_2.2.fq"],
+                threads=2,
+                )
+
+            expected = pl.DataFrame([
+                ["sample_1", expected_bases(SAMPLE_1_F) + expected_bases(SAMPLE_1_R)],
+                ["sample_2", 9],
+            ], orient="row", schema={"sample": str, "bases": int})
+            self.assertDataFrameEqual(expected, read_size)
+            self.assertEqual(4, cache.height)
+
+    def test_pipeline_cache(self):
+        with in_tempdir():
+            with open("sample_2.1.fq", "w") as f:
+                f.write("@read_1\nACGT\n+\nIIII\n")
+            with open("sample_2.2.fq", "w") as f:
+                f.write("@read_1\nACGTA\n+\nIIIII\n")
+
+            path, size, mtime = file_key("sample_2.1.fq")
+            stale_path, stale_size, stale_mtime = file_key("sample_2.2.fq")
+            cache = pl.DataFrame([
+                [path, size, mtime, 100],
+                [stale_path, stale_size + 1, stale_mtime, 200],
+                ["other.fq", 1, 1, 300],
+            ], orient="row", schema=CACHE_COLUMNS)
+
+            read_size, updated_cache = pipeline(["sample_2"], ["sample_2.1.fq"], ["sample_2.2.fq"], cache=cache)
+
+            # Unchanged file reuses cached count, changed file is recounted
+            expected = pl.DataFrame([
+                ["sample_2", 105],
+            ], orient="row", schema={"sample": str, "bases": int})
+            self.assertDataFrameEqual(expected, read_size)
+
+            expected_cache = pl.DataFrame([
+                [path, size, mtime, 100],
+                [stale_path, stale_size, stale_mtime, 5],
+                ["other.fq", 1, 1, 300],
+            ], orient="row", schema=CACHE_COLUMNS)
+            self.assertDataFrameEqual(expected_cache, updated_cache)
+
+    def test_estimate_bases(self):
+        with in_tempdir():
+            for path in ["reads.fq", "reads.fq.gz"]:
+                expected = write_fastq(path, 20000)
+                estimate, lower, upper = estimate_bases(path, SAMPLE_RECORDS=2000, BLOCK_SIZE=256 * 1024)
+
+                self.assertAlmostEqual(1, estimate / expected, delta=0.05)
+                self.assertLessEqual(lower, estimate)
+                self.assertGreaterEqual(upper, estimate)
+
+    def test_estimate_bases_single_member(self):
+        with in_tempdir():
+            expected = write_fastq("reads.fq", 20000)
+            with open("reads.fq", "rb") as f:
+                content = f.read()
+            with open("reads.fq.gz", "wb") as f:
+                f.write(gzip.compress(content))
+
+            # Only the start of the file can be sampled, widening the interval
+            with self.assertLogs(level="WARNING"):
+                estimate, lower, upper = estimate_bases("reads.fq.gz", SAMPLE_RECORDS=2000, BLOCK_SIZE=256 * 1024)
+            self.assertAlmostEqual(1, estimate / expected, delta=0.1)
+            self.assertLessEqual(lower, expected)
+            self.assertGreaterEqual(upper, expected)
+
+            plain_estimate, plain_lower, plain_upper = estimate_bases("reads.fq", SAMPLE_RECORDS=2000, BLOCK_SIZE=256 * 1024)
+            self.assertGreater((upper - lower) / estimate, (plain_upper - plain_lower) / plain_estimate)
+
+    def test_estimate_bases_empty(self):
+        with in_tempdir():
+            open("reads.fq", "w").close()
+            self.assertEqual((0, 0, 0), estimate_bases("reads.fq"))
+
+    def test_pipeline_estimate(self):
+        with in_tempdir():
+            expected_1 = write_fastq("sample_1.1.fq", 5000, seed=1)
+            expected_2 = write_fastq("sample_1.2.fq", 5000, seed=2)
+            path, size, mtime = file_key("sample_1.2.fq")
+            cache = pl.DataFrame([
+                [path, size, mtime, expected_2],
+            ], orient="row", schema=CACHE_COLUMNS)
+
+            read_size, updated_cache = pipeline(["sample_1"], ["sample_1.1.fq"], ["sample_1.2.fq"], cache=cache, ESTIMATE=True)
+
+            self.assertEqual(["sample", "bases", "lower", "upper"], read_size.columns)
+            bases, lower, upper = read_size.select("bases", "lower", "upper").row(0)
+            self.assertAlmostEqual(1, bases / (expected_1 + expected_2), delta=0.05)
+            self.assertLessEqual(lower, bases)
+            self.assertGreaterEqual(upper, bases)
+            # Estimates are not cached
+            self.assertDataFrameEqual(cache, updated_cache)
+
+    def test_harvest_read_size(self):
+        with in_tempdir():
+            with open("sample_1.json", "w") as f:
+                json.dump({"summary": {"before_filtering": {"total_bases": 1000}, "after_filtering": {"total_bases": 900}}}, f)
+            with open("sample_2_unmapped.bases", "w") as f:
+                f.write("42\n")
+
+            expected = pl.DataFrame([
+                ["sample_1", 900],
+                ["sample_2", 42],
+            ], orient="row", schema={"sample": str, "bases": int})
+            observed = harvest_read_size(["sample_1.json", "sample_2_unmapped.bases"])
+            self.assertDataFrameEqual(expected, observed)
+
+
+if __name__ == '__main__':
+    unittest.main()
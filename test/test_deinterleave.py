@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+import gzip
+import stat
+from unittest.mock import patch
+from bird_tool_utils import in_tempdir
+import extern
+from binchicken.workflow.scripts.deinterleave import pipeline
+
+path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
+path_to_script = os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','binchicken','workflow','scripts','deinterleave.py')
+
+path_to_sra = os.path.join(path_to_data, "sra")
+SRA_INTERLEAVED = os.path.join(path_to_sra, "SRR3309137.fastq")
+SRA_INTERLEAVED_GZ = os.path.join(path_to_sra, "SRR3309137.fastq.gz")
+SRA_ODD = os.path.join(path_to_sra, "SRR3309137_odd.fastq")
+SRA_MISMATCHED_GZ = os.path.join(path_to_sra, "SRR3309137_mismatched.fastq.gz")
+SRA_EMPTY = os.path.join(path_to_sra, "SRR3309137_empty.fastq")
+
+# Stands in for pigz, using gzip's exit status for corrupt input and logging its arguments
+MOCK_PIGZ = """#!/bin/sh
+echo "$@" >> pigz.log
+if [ "$1" = "-dc" ]; then exec gzip -dc "$4"; fi
+exec gzip "$1" -c
+"""
+
+def mock_pigz():
+    os.makedirs("bin", exist_ok=True)
+    with open(os.path.join("bin", "pigz"), "w") as f:
+        f.write(MOCK_PIGZ)
+    os.chmod(os.path.join("bin", "pigz"), stat.S_IRWXU)
+    return patch.dict(os.environ, {"PATH": os.path.abspath("bin") + os.pathsep + os.environ["PATH"]})
+
+def read_records(path):
+    with open(path) as f:
+        lines = f.read().splitlines()
+    return [lines[i:i+4] for i in range(0, len(lines), 4)]
+
+class Tests(unittest.TestCase):
+    def assertDeinterleaved(self, input_path, forward_path, reverse_path):
+        records = read_records(input_path)
+        with gzip.open(forward_path, "rt") as f:
+            self.assertEqual(sum(records[0::2], []), f.read().splitlines())
+        with gzip.open(reverse_path, "rt") as f:
+            self.assertEqual(sum(records[1::2], []), f.read().splitlines())
+
+    def test_deinterleave(self):
+        with in_tempdir():
+            observed_outcome, observed_reason = pipeline(SRA_INTERLEAVED, "reads_1.fastq.gz", "reads_2.fastq.gz")
+            self.assertEqual("Duplicate read names in consecutive reads with even readcount", observed_reason)
+            self.assertEqual(True, observed_outcome)
+            self.assertDeinterleaved(SRA_INTERLEAVED, "reads_1.fastq.gz", "reads_2.fastq.gz")
+
+    def test_deinterleave_gz_chunked(self):
+        with in_tempdir():
+            for chunk_size in [1, 13, 100]:
+                observed_outcome, _ = pipeline(SRA_INTERLEAVED_GZ, "reads_1.fastq.gz", "reads_2.fastq.gz", COMPRESSION_LEVEL=1, CHUNK_SIZE=chunk_size)
+                self.assertEqual(True, observed_outcome)
+                self.assertDeinterleaved(SRA_INTERLEAVED, "reads_1.fastq.gz", "reads_2.fastq.gz")
+
+    def test_deinterleave_uncompressed_level(self):
+        with in_tempdir():
+            observed_outcome, _ = pipeline(SRA_INTERLEAVED, "reads_1.fastq.gz", "reads_2.fastq.gz", COMPRESSION_LEVEL=0)
+            self.assertEqual(True, observed_outcome)
+            self.assertDeinterleaved(SRA_INTERLEAVED, "reads_1.fastq.gz", "reads_2.fastq.gz")
+            self.assertTrue(os.path.getsize("reads_1.fastq.gz") > os.path.getsize(SRA_INTERLEAVED) / 2)
+
+    def test_deinterleave_no_final_newline(self):
+        with in_tempdir():
+            with open(SRA_INTERLEAVED) as f:
+                content = f.read()
+            with open("reads.fastq", "w") as f:
+                f.write(content.rstrip("\n"))
+
+            observed_outcome, _ = pipeline("reads.fastq", "reads_1.fastq.gz", "reads_2.fastq.gz")
+            self.assertEqual(True, observed_outcome)
+            self.assertDeinterleaved(SRA_INTERLEAVED, "reads_1.fastq.gz", "reads_2.fastq.gz")
+
+    def test_deinterleave_odd(self):
+        with in_tempdir():
+            # Dropped read shifts every following pair out of register
+            observed_outcome, observed_reason = pipeline(SRA_ODD, "reads_1.fastq.gz", "reads_2.fastq.gz")
+            self.assertEqual("Consecutive reads do not match (read pair 6)", observed_reason)
+            self.assertEqual(False, observed_outcome)
+            self.assertFalse(os.path.exists("reads_1.fastq.gz"))
+            self.assertFalse(os.path.exists("reads_2.fastq.gz"))
+
+    def test_deinterleave_odd_final(self):
+        with in_tempdir():
+            with open(SRA_INTERLEAVED) as f:
+                lines = f.readlines()
+            with open("reads.fastq", "w") as f:
+                f.writelines(lines[:-4])
+
+            observed_outcome, observed_reason = pipeline("reads.fastq", "reads_1.fastq.gz", "reads_2.fastq.gz")
+            self.assertEqual("Odd readcount", observed_reason)
+            self.assertEqual(False, observed_outcome)
+            self.assertFalse(os.path.exists("reads_1.fastq.gz"))
+            self.assertFalse(os.path.exists("reads_2.fastq.gz"))
+
+    def test_deinterleave_mismatched(self):
+        with in_tempdir():
+            observed_outcome, observed_reason = pipeline(SRA_MISMATCHED_GZ, "reads_1.fastq.gz", "reads_2.fastq.gz")
+            self.assertEqual("Consecutive reads do not match (read pair 1)", observed_reason)
+            self.assertEqual(False, observed_outcome)
+            self.assertFalse(os.path.exists("reads_1.fastq.gz"))
+            self.assertFalse(os.path.exists("reads_2.fastq.gz"))
+
+    def test_deinterleave_empty(self):
+        with in_tempdir():
+            observed_outcome, observed_reason = pipeline(SRA_EMPTY, "reads_1.fastq.gz", "reads_2.fastq.gz")
+            self.assertEqual("Empty file", observed_reason)
+            self.assertEqual(False, observed_outcome)
+            self.assertFalse(os.path.exists("reads_1.fastq.gz"))
+
+    def test_deinterleave_pigz_truncated(self):
+        with in_tempdir():
+            with open(SRA_INTERLEAVED_GZ, "rb") as f:
+                content = f.read()
+            with open("reads.fastq.gz", "wb") as f:
+                f.write(content[:len(content) * 2 // 3])
+
+            with mock_pigz():
+                with self.assertRaises(Exception) as context:
+                    pipeline("reads.fastq.gz", "reads_1.fastq.gz", "reads_2.fastq.gz", threads=2)
+            self.assertEqual("Decompression of reads.fastq.gz failed", str(context.exception))
+            self.assertFalse(os.path.exists("reads_1.fastq.gz"))
+            self.assertFalse(os.path.exists("reads_2.fastq.gz"))
+
+    def test_deinterleave_pigz(self):
+        with in_tempdir():
+            with mock_pigz():
+                observed_outcome, _ = pipeline(SRA_INTERLEAVED_GZ, "reads_1.fastq.gz", "reads_2.fastq.gz", threads=2)
+                self.assertEqual(True, observed_outcome)
+                self.assertDeinterleaved(SRA_INTERLEAVED, "reads_1.fastq.gz", "reads_2.fastq.gz")
+
+                # Stopping early at a mismatch is not a decompression failure
+                observed_outcome, observed_reason = pipeline(SRA_MISMATCHED_GZ, "reads_1.fastq.gz", "reads_2.fastq.gz", threads=2, CHUNK_SIZE=100)
+                self.assertEqual(False, observed_outcome)
+                self.assertTrue(observed_reason.startswith("Consecutive reads do not match"))
+                self.assertFalse(os.path.exists("reads_1.fastq.gz"))
+
+    def test_deinterleave_pigz_compression_level(self):
+        with in_tempdir():
+            cmd = (
+                f"python {path_to_script} "
+                f"--input {SRA_INTERLEAVED_GZ} "
+                f"--output-forward reads_1.fastq.gz "
+                f"--output-reverse reads_2.fastq.gz "
+                f"--compression-level 9 "
+                f"--threads 2 "
+            )
+            with mock_pigz():
+                extern.run(cmd)
+
+            with open("pigz.log") as f:
+                observed = sorted(f.read().splitlines())
+            self.assertEqual(["-9 -p 1 -c", "-9 -p 1 -c", "-dc -p 2 " + SRA_INTERLEAVED_GZ], observed)
+            self.assertDeinterleaved(SRA_INTERLEAVED, "reads_1.fastq.gz", "reads_2.fastq.gz")
+
+    def test_deinterleave_stdin_bases(self):
+        with in_tempdir():
+            cmd = (
+                f"cat {SRA_INTERLEAVED} | "
+                f"python {path_to_script} "
+                f"--input - "
+                f"--output-forward reads_1.fastq.gz "
+                f"--output-reverse reads_2.fastq.gz "
+                f"--output-bases reads.bases "
+                f"--strict "
+            )
+            extern.run(cmd)
+
+            self.assertDeinterleaved(SRA_INTERLEAVED, "reads_1.fastq.gz", "reads_2.fastq.gz")
+            with open("reads.bases") as f:
+                expected = sum(len(record[1]) for record in read_records(SRA_INTERLEAVED))
+                self.assertEqual(f"{expected}\n", f.read())
+
+    def test_deinterleave_allow_empty(self):
+        with in_tempdir():
+            observed_outcome, _ = pipeline(SRA_EMPTY, "reads_1.fastq.gz", "reads_2.fastq.gz", output_bases="reads.bases", ALLOW_EMPTY=True)
+            self.assertEqual(True, observed_outcome)
+            with gzip.open("reads_1.fastq.gz", "rt") as f:
+                self.assertEqual("", f.read())
+            with open("reads.bases") as f:
+                self.assertEqual("0\n", f.read())
+
+    def test_deinterleave_strict(self):
+        with in_tempdir():
+            cmd = (
+                f"python {path_to_script} "
+                f"--input {SRA_MISMATCHED_GZ} "
+                f"--output-forward reads_1.fastq.gz "
+                f"--output-reverse reads_2.fastq.gz "
+                f"--strict "
+            )
+            with self.assertRaises(extern.ExternCalledProcessError):
+                extern.run(cmd)
+
+    def test_deinterleave_cli(self):
+        with in_tempdir():
+            cmd = (
+                f"python {path_to_script} "
+                f"--input {SRA_INTERLEAVED_GZ} "
+                f"--output-forward reads_1.fastq.gz "
+                f"--output-reverse reads_2.fastq.gz "
+                f"--compression-level 1 "
+                f"--threads 2 "
+            )
+            output = extern.run(cmd)
+
+            output_text = output.strip().split("\t")
+            self.assertEqual("True", output_text[0])
+            self.assertEqual("Duplicate read names in consecutive reads with even readcount", output_text[1])
+            self.assertDeinterleaved(SRA_INTERLEAVED, "reads_1.fastq.gz", "reads_2.fastq.gz")
+
+
+if __name__ == '__main__':
+    unittest.main()
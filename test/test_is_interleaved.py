@@ -181,6 +181,22 @@ class Tests(unittest.TestCase):
         self.assertEqual("Consecutive reads do not match (1/5)", observed_reason)
         self.assertEqual(False, observed_outcome)
 
+    def test_is_interleaved_pipeline_chunked(self):
+        for path, expected in [
+            (SRA_INTERLEAVED, "Duplicate read names in consecutive reads with even readcount"),
+            (SRA_INTERLEAVED_GZ, "Duplicate read names in consecutive reads with even readcount"),
+            (SRA_ODD, "Odd readcount"),
+            (SRA_MISMATCHED_GZ, "Consecutive reads do not match (1/5)"),
+            ]:
+            for chunk_size in [1, 7, 100]:
+                _, observed_reason = pipeline(path, 2, 3, CHUNK_SIZE=chunk_size)
+                self.assertEqual(expected, observed_reason)
+
+    def test_is_interleaved_pipeline_threads(self):
+        observed_outcome, observed_reason = pipeline(SRA_MISMATCHED_GZ, 5, 5, threads=2)
+        self.assertEqual("Consecutive reads do not match (1/10)", observed_reason)
+        self.assertEqual(False, observed_outcome)
+
     def test_is_interleaved_pipeline_empty(self):
         observed_outcome, observed_reason = pipeline(SRA_EMPTY, 2, 3)
         self.assertEqual("Empty file", observed_reason)
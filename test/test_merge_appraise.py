@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+os.environ["POLARS_MAX_THREADS"] = "1"
+import polars as pl
+from polars.testing import assert_frame_equal
+from bird_tool_utils import in_tempdir
+from binchicken.workflow.scripts.merge_appraise import pipeline
+
+APPRAISE_COLUMNS = ["gene", "sample", "sequence", "num_hits", "coverage", "taxonomy", "found_in"]
+
+class Tests(unittest.TestCase):
+    def assertDataFrameEqual(self, a, b):
+        assert_frame_equal(a, b, check_dtypes=False)
+
+    def test_merge_appraise(self):
+        unbinned_1 = pl.DataFrame([
+            ["S3.1", "sample_1.1", "AAA", "5", "10.00", "Root", ""],
+            ["S3.18.EIF_2_alpha", "sample_1.1", "CCC", "5", "10.00", "Root", ""],
+        ], orient="row", schema=APPRAISE_COLUMNS)
+        unbinned_2 = pl.DataFrame([
+            ["S3.1", "sample_2.1", "GGG", "3", "6.50", "Root; d__Bacteria", ""],
+        ], orient="row", schema=APPRAISE_COLUMNS)
+        binned_1 = pl.DataFrame([
+            ["S3.2", "sample_1.1", "TTT", "2", "4.10", "Root", "genome_1_protein"],
+        ], orient="row", schema=APPRAISE_COLUMNS)
+        binned_2 = pl.DataFrame(schema={c: str for c in APPRAISE_COLUMNS})
+
+        with in_tempdir():
+            unbinned_1.write_csv("0_unbinned.tsv", separator="\t")
+            unbinned_2.write_csv("1_unbinned.tsv", separator="\t")
+            binned_1.write_csv("0_binned.tsv", separator="\t")
+            binned_2.write_csv("1_binned.tsv", separator="\t")
+
+            pipeline(
+                ["0_unbinned.tsv", "1_unbinned.tsv"],
+                ["0_binned.tsv", "1_binned.tsv"],
+                "unbinned.tsv",
+                "binned.tsv",
+                )
+
+            expected = pl.DataFrame([
+                ["S3.1", "sample_1.1", "AAA", "5", "10.00", "Root", ""],
+                ["S3.1", "sample_2.1", "GGG", "3", "6.50", "Root; d__Bacteria", ""],
+            ], orient="row", schema=APPRAISE_COLUMNS)
+            observed = pl.read_csv("unbinned.tsv", separator="\t", infer_schema_length=0)
+            self.assertDataFrameEqual(expected, observed)
+
+            observed = pl.read_csv("binned.tsv", separator="\t", infer_schema_length=0)
+            self.assertDataFrameEqual(binned_1, observed)
+
+            # Values are kept as text
+            with open("unbinned.tsv") as f:
+                self.assertTrue("\t10.00\t" in f.read())
+
+            # Typed Arrow IPC copies are written alongside
+            observed = pl.read_ipc("unbinned.arrow", memory_map=False)
+            self.assertEqual(pl.Categorical, observed.schema["sample"])
+            self.assertEqual(pl.Int64, observed.schema["num_hits"])
+            self.assertEqual([10.0, 6.5], observed.get_column("coverage").to_list())
+            self.assertEqual(1, pl.read_ipc("binned.arrow", memory_map=False).height)
+
+    def test_merge_appraise_empty(self):
+        with in_tempdir():
+            pl.DataFrame(schema={c: str for c in APPRAISE_COLUMNS}).write_csv("0_unbinned.tsv", separator="\t")
+            pl.DataFrame(schema={c: str for c in APPRAISE_COLUMNS}).write_csv("0_binned.tsv", separator="\t")
+
+            pipeline(["0_unbinned.tsv"], ["0_binned.tsv"], "unbinned.tsv", "binned.tsv")
+
+            with open("unbinned.tsv") as f:
+                self.assertEqual("\t".join(APPRAISE_COLUMNS) + "\n", f.read())
+            self.assertEqual(APPRAISE_COLUMNS, pl.read_ipc("unbinned.arrow", memory_map=False).columns)
+
+
+if __name__ == '__main__':
+    unittest.main()
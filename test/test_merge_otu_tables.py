@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+import json
+import shutil
+os.environ["POLARS_MAX_THREADS"] = "1"
+import polars as pl
+from polars.testing import assert_frame_equal
+from bird_tool_utils import in_tempdir
+from binchicken.workflow.scripts.merge_otu_tables import read_target_domains, merge_otu_tables, pipeline
+
+OTU_TABLE_COLUMNS = ["gene", "sample", "sequence", "num_hits", "coverage", "taxonomy"]
+
+path_to_data = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), "data"))
+METAPACKAGE = os.path.join(path_to_data, "singlem_metapackage_EIF.smpkg")
+
+class Tests(unittest.TestCase):
+    def assertDataFrameEqual(self, a, b):
+        assert_frame_equal(a, b, check_dtypes=False, check_row_order=False)
+
+    def test_read_target_domains(self):
+        observed = read_target_domains(METAPACKAGE)
+        self.assertEqual(["Bacteria", "Archaea"], observed["S3.18.EIF_2_alpha"])
+        self.assertEqual({"S3.7.ribosomal_protein_S7", "S3.18.EIF_2_alpha"}, set(observed))
+
+    def test_exclude_off_target_hits_no_target_domains(self):
+        genomes = pl.DataFrame([
+            ["S3.18.EIF_2_alpha", "genome_1_protein", "AGCC", "1", "1.64", "Root; d__Eukaryota"],
+            ["S3.7.ribosomal_protein_S7", "genome_2_protein", "AGCG", "1", "1.64", "Root; d__Eukaryota"],
+        ], orient="row", schema=OTU_TABLE_COLUMNS)
+
+        with in_tempdir():
+            # Package without target domains, as from older SingleM versions
+            shutil.copytree(METAPACKAGE, "metapackage.smpkg")
+            contents_path = os.path.join("metapackage.smpkg", "S3.7.ribosomal_protein_S7.spkg", "CONTENTS.json")
+            with open(contents_path) as f:
+                contents = json.load(f)
+            contents.pop("target_domains", None)
+            with open(contents_path, "w") as f:
+                json.dump(contents, f)
+
+            self.assertEqual({"S3.18.EIF_2_alpha"}, set(read_target_domains("metapackage.smpkg")))
+
+            genomes.write_csv("genomes.otu_table.tsv", separator="\t")
+            pipeline(["genomes.otu_table.tsv"], "merged.otu_table.tsv", metapackage="metapackage.smpkg")
+            observed = pl.read_csv("merged.otu_table.tsv", separator="\t", infer_schema_length=0)
+
+        self.assertDataFrameEqual(genomes.slice(1), observed)
+
+    def test_merge_otu_tables(self):
+        genome_1 = pl.DataFrame([
+            ["S3.1", "genome_1_protein", "AGCT", "1", "1.64", "Root; d__Bacteria"],
+            ["S3.2", "genome_1_protein", "AGCC", "1", "1.00", "Root"],
+        ], orient="row", schema=OTU_TABLE_COLUMNS)
+        genome_2 = pl.DataFrame([
+            ["S3.1", "genome_2_protein", "GGCT", "2", "3.00", "Root; d__Archaea"],
+        ], orient="row", schema=OTU_TABLE_COLUMNS)
+
+        with in_tempdir():
+            genome_1.write_csv("genome_1.otu_table.tsv", separator="\t")
+            genome_2.write_csv("genome_2.otu_table.tsv", separator="\t")
+            pl.DataFrame(schema={c: str for c in OTU_TABLE_COLUMNS}).write_csv("genome_3.otu_table.tsv", separator="\t")
+
+            num_rows = merge_otu_tables(
+                ["genome_1.otu_table.tsv", "genome_2.otu_table.tsv", "genome_3.otu_table.tsv"],
+                "merged.otu_table.tsv",
+                FILES_PER_CHUNK=2,
+                )
+            with open("merged.otu_table.tsv") as f:
+                lines = f.readlines()
+
+        self.assertEqual(3, num_rows)
+        self.assertEqual(4, len(lines))
+        self.assertEqual("\t".join(OTU_TABLE_COLUMNS) + "\n", lines[0])
+        self.assertEqual("S3.1\tgenome_1_protein\tAGCT\t1\t1.64\tRoot; d__Bacteria\n", lines[1])
+        self.assertEqual("S3.1\tgenome_2_protein\tGGCT\t2\t3.00\tRoot; d__Archaea\n", lines[3])
+
+    def test_merge_otu_tables_empty(self):
+        with in_tempdir():
+            num_rows = merge_otu_tables([], "merged.otu_table.tsv")
+            observed = pl.read_csv("merged.otu_table.tsv", separator="\t")
+
+        self.assertEqual(0, num_rows)
+        self.assertEqual(OTU_TABLE_COLUMNS, observed.columns)
+
+    def test_exclude_off_target_hits(self):
+        genomes = pl.DataFrame([
+            ["S3.18.EIF_2_alpha", "genome_1_protein", "AGCT", "1", "1.64", "Root; d__Bacteria; p__Firmicutes"],
+            ["S3.18.EIF_2_alpha", "genome_1_protein", "AGCC", "1", "1.64", "Root; d__Eukaryota"],
+            ["S3.18.EIF_2_alpha", "genome_2_protein", "AGCA", "1", "1.64", "Root"],
+            ["S3.7.ribosomal_protein_S7", "genome_2_protein", "AGCG", "1", "1.64", "Root; d__Archaea"],
+            ["S3.1", "genome_2_protein", "AGCG", "1", "1.64", "Root; d__Eukaryota"],
+        ], orient="row", schema=OTU_TABLE_COLUMNS)
+
+        with in_tempdir():
+            genomes.write_csv("genomes.otu_table.tsv", separator="\t")
+            pipeline(["genomes.otu_table.tsv"], "merged.otu_table.tsv", metapackage=METAPACKAGE)
+            observed = pl.read_csv("merged.otu_table.tsv", separator="\t", infer_schema_length=0)
+
+        expected = pl.DataFrame([
+            ["S3.18.EIF_2_alpha", "genome_1_protein", "AGCT", "1", "1.64", "Root; d__Bacteria; p__Firmicutes"],
+            ["S3.18.EIF_2_alpha", "genome_2_protein", "AGCA", "1", "1.64", "Root"],
+            ["S3.7.ribosomal_protein_S7", "genome_2_protein", "AGCG", "1", "1.64", "Root; d__Archaea"],
+            ["S3.1", "genome_2_protein", "AGCG", "1", "1.64", "Root; d__Eukaryota"],
+        ], orient="row", schema=OTU_TABLE_COLUMNS)
+        self.assertDataFrameEqual(expected, observed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+os.environ["POLARS_MAX_THREADS"] = "1"
+import random
+import polars as pl
+from polars.testing import assert_frame_equal
+from bird_tool_utils import in_tempdir
+from binchicken.workflow.scripts.native_appraise import block_bounds, query_chunks, nearest_windows, pipeline
+
+PIPE_COLUMNS = ["gene", "sample", "sequence", "num_hits", "coverage", "taxonomy"]
+APPRAISE_COLUMNS = ["gene", "sample", "sequence", "num_hits", "coverage", "taxonomy", "found_in"]
+
+SEQUENCE = "TATCAAGTTCCACAAGAAGTTAGAGGAGAAAGAAGAATCTCGTTAGCTATTAGATGGATT"
+
+def mutate(sequence, positions, base="C"):
+    sequence = list(sequence)
+    for position in positions:
+        sequence[position] = base if sequence[position] != base else "G"
+    return "".join(sequence)
+
+class Tests(unittest.TestCase):
+    def assertDataFrameEqual(self, a, b):
+        assert_frame_equal(a, b, check_dtypes=False, check_row_order=False)
+
+    def test_block_bounds(self):
+        # Within 8 mismatches, at least one of 9 blocks is identical
+        self.assertEqual(10, len(block_bounds(60, 8)))
+        # Exact matches still use blocks that fit in a packed word
+        self.assertEqual([0, 30, 60], list(block_bounds(60, 0)))
+
+    def test_nearest_windows(self):
+        genomes = [mutate(SEQUENCE, [0, 20]), mutate(SEQUENCE, [40]), mutate(SEQUENCE, [1, 2, 3, 4, 5, 6, 7, 8, 9])]
+        queries = [SEQUENCE, mutate(SEQUENCE, [40, 50]), mutate(SEQUENCE, range(0, 60, 5))]
+
+        observed = nearest_windows(queries, genomes, 8)
+        expected = pl.DataFrame([
+            [0, 1, 1],
+            [1, 1, 1],
+        ], orient="row", schema=["query", "genome", "divergence"])
+        self.assertDataFrameEqual(expected, observed)
+
+    def test_nearest_windows_ties(self):
+        genomes = [mutate(SEQUENCE, [0]), mutate(SEQUENCE, [59]), mutate(SEQUENCE, [10, 11])]
+
+        observed = nearest_windows([SEQUENCE], genomes, 8)
+        expected = pl.DataFrame([
+            [0, 0, 1],
+            [0, 1, 1],
+        ], orient="row", schema=["query", "genome", "divergence"])
+        self.assertDataFrameEqual(expected, observed)
+
+    def test_nearest_windows_gaps(self):
+        # Gaps and Ns are compared exactly, matching only themselves
+        genomes = [SEQUENCE[:58] + "--", SEQUENCE[:58] + "NN"]
+        queries = [SEQUENCE[:58] + "--", SEQUENCE[:58] + "AA", SEQUENCE[:58]]
+
+        observed = nearest_windows(queries, genomes, 1)
+        expected = pl.DataFrame([
+            [0, 0, 0],
+            [2, 0, 0],
+        ], orient="row", schema=["query", "genome", "divergence"])
+        self.assertDataFrameEqual(expected, observed)
+
+    def test_nearest_windows_brute_force(self):
+        random.seed(42)
+        base = ["".join(random.choice("ACGT") for _ in range(60)) for _ in range(10)]
+        genomes = [mutate(random.choice(base), random.sample(range(60), random.randint(0, 12)), random.choice("ACGT-N")) for _ in range(100)]
+        queries = [mutate(random.choice(base), random.sample(range(60), random.randint(0, 12)), random.choice("ACGT-N")) for _ in range(100)]
+
+        for max_divergence in [0, 3, 8]:
+            expected = []
+            for i, query in enumerate(queries):
+                divergences = [sum(a != b for a, b in zip(query, genome)) for genome in genomes]
+                if min(divergences) <= max_divergence:
+                    expected.extend([i, j, d] for j, d in enumerate(divergences) if d == min(divergences))
+            expected = pl.DataFrame(expected, orient="row", schema=["query", "genome", "divergence"])
+
+            observed = nearest_windows(queries, genomes, max_divergence)
+            self.assertDataFrameEqual(expected, observed)
+
+    def test_query_chunks(self):
+        self.assertEqual([0, 2, 3, 5], query_chunks([3, 2, 10, 1, 4], 5))
+        self.assertEqual([0, 5], query_chunks([3, 2, 10, 1, 4], 100))
+        self.assertEqual([0], query_chunks([], 5))
+
+    def test_nearest_windows_many_genome_windows(self):
+        # Low-complexity windows share most seeds, so queries are joined and verified in chunks
+        random.seed(42)
+        base = "A" * 60
+        genomes = [mutate(base, random.sample(range(60), random.randint(0, 10)), random.choice("CGT")) for _ in range(5000)]
+        queries = [mutate(base, random.sample(range(60), random.randint(0, 10)), random.choice("CGT")) for _ in range(50)]
+
+        expected = []
+        for i, query in enumerate(queries):
+            divergences = [sum(a != b for a, b in zip(query, genome)) for genome in genomes]
+            nearest = min(divergences)
+            if nearest <= 8:
+                expected.extend([i, j, d] for j, d in enumerate(divergences) if d == nearest)
+        expected = pl.DataFrame(expected, orient="row", schema=["query", "genome", "divergence"])
+
+        for chunk_size in [1, 10000, 1 << 20]:
+            observed = nearest_windows(queries, genomes, 8, CANDIDATE_CHUNK_SIZE=chunk_size)
+            self.assertDataFrameEqual(expected, observed)
+
+    def test_native_appraise(self):
+        reads = pl.DataFrame([
+            ["S3.1", "sample_1.1", SEQUENCE, "5", "10.00", "Root"],
+            ["S3.1", "sample_1.1", mutate(SEQUENCE, range(0, 60, 5)), "3", "6.50", "Root"],
+            ["S3.2", "sample_1.1", SEQUENCE, "2", "4.10", "Root"],
+        ], orient="row", schema=PIPE_COLUMNS)
+        reads_2 = pl.DataFrame([
+            ["S3.1", "sample_2.1", mutate(SEQUENCE, [1, 2, 3, 4, 5]), "4", "8.00", "Root"],
+        ], orient="row", schema=PIPE_COLUMNS)
+        genomes = pl.DataFrame([
+            ["S3.1", "genome_2_protein", mutate(SEQUENCE, [1]), "1", "1.64", "Root"],
+            ["S3.1", "genome_1_protein", mutate(SEQUENCE, [1]), "1", "1.64", "Root"],
+            ["S3.1", "genome_3_protein", mutate(SEQUENCE, [1, 2]), "1", "1.64", "Root"],
+        ], orient="row", schema=PIPE_COLUMNS)
+
+        with in_tempdir():
+            reads.write_csv("sample_1_read.otu_table.tsv", separator="\t")
+            reads_2.write_csv("sample_2_read.otu_table.tsv", separator="\t")
+            genomes.write_csv("bins_summarised.otu_table.tsv", separator="\t")
+
+            outputs = pipeline(
+                ["sample_1_read.otu_table.tsv", "sample_2_read.otu_table.tsv"],
+                "bins_summarised.otu_table.tsv",
+                SEQUENCE_IDENTITIES=[0.98, 0.86],
+                )
+
+        (binned, unbinned), (binned_86, unbinned_86) = outputs
+        expected_binned = pl.DataFrame([
+            ["S3.1", "sample_1.1", SEQUENCE, "5", "10.00", "Root", "genome_1_protein,genome_2_protein"],
+        ], orient="row", schema={c: str for c in APPRAISE_COLUMNS})
+        expected_unbinned = pl.DataFrame([
+            ["S3.1", "sample_1.1", mutate(SEQUENCE, range(0, 60, 5)), "3", "6.50", "Root", None],
+            ["S3.2", "sample_1.1", SEQUENCE, "2", "4.10", "Root", None],
+            ["S3.1", "sample_2.1", mutate(SEQUENCE, [1, 2, 3, 4, 5]), "4", "8.00", "Root", None],
+        ], orient="row", schema={c: str for c in APPRAISE_COLUMNS})
+        self.assertDataFrameEqual(expected_binned, binned)
+        self.assertDataFrameEqual(expected_unbinned, unbinned)
+
+        expected_binned_86 = pl.DataFrame([
+            ["S3.1", "sample_1.1", SEQUENCE, "5", "10.00", "Root", "genome_1_protein,genome_2_protein"],
+            ["S3.1", "sample_2.1", mutate(SEQUENCE, [1, 2, 3, 4, 5]), "4", "8.00", "Root", "genome_3_protein"],
+        ], orient="row", schema={c: str for c in APPRAISE_COLUMNS})
+        expected_unbinned_86 = pl.DataFrame([
+            ["S3.1", "sample_1.1", mutate(SEQUENCE, range(0, 60, 5)), "3", "6.50", "Root", None],
+            ["S3.2", "sample_1.1", SEQUENCE, "2", "4.10", "Root", None],
+        ], orient="row", schema={c: str for c in APPRAISE_COLUMNS})
+        self.assertDataFrameEqual(expected_binned_86, binned_86)
+        self.assertDataFrameEqual(expected_unbinned_86, unbinned_86)
+
+    def test_native_appraise_empty_input(self):
+        with in_tempdir():
+            pl.DataFrame(schema={c: str for c in PIPE_COLUMNS}).write_csv("sample_1_read.otu_table.tsv", separator="\t")
+            pl.DataFrame(schema={c: str for c in PIPE_COLUMNS}).write_csv("bins_summarised.otu_table.tsv", separator="\t")
+
+            [(binned, unbinned)] = pipeline(["sample_1_read.otu_table.tsv"], "bins_summarised.otu_table.tsv")
+
+        self.assertEqual(APPRAISE_COLUMNS, binned.columns)
+        self.assertEqual(0, binned.height)
+        self.assertEqual(APPRAISE_COLUMNS, unbinned.columns)
+        self.assertEqual(0, unbinned.height)
+
+
+if __name__ == '__main__':
+    unittest.main()
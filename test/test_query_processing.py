@@ -5,7 +5,8 @@ import os
 os.environ["POLARS_MAX_THREADS"] = "1"
 import polars as pl
 from polars.testing import assert_frame_equal
-from binchicken.workflow.scripts.query_processing import processing
+from bird_tool_utils import in_tempdir
+from binchicken.workflow.scripts.query_processing import processing, processing_thresholds, pipeline, scan_pipeline, resumable_pipeline, batch_digest
 
 QUERY_COLUMNS = {
     "query_name": str,
@@ -199,6 +200,229 @@ class Tests(unittest.TestCase):
         self.assertDataFrameEqual(expected_binned, observed_binned)
         self.assertDataFrameEqual(expected_unbinned, observed_unbinned)
 
+    def test_query_processing_pipeline_threads(self):
+        with in_tempdir():
+            query_paths = []
+            pipe_paths = []
+            for i in range(1, 6):
+                pl.DataFrame([
+                    [f"sample_{i}", "AAA", 1, 5, 10, "genome_1", "S3.1", "AAA", "Root"],
+                ], orient="row", schema=QUERY_COLUMNS).write_csv(f"sample_{i}_query.tsv", separator="\t")
+                pl.DataFrame([
+                    ["S3.1", f"sample_{i}", "AAA", 5, 10, "Root"],
+                    ["S3.1", f"sample_{i}", "AAB", 5, 10, "Root"],
+                ], orient="row", schema=PIPE_COLUMNS).write_csv(f"sample_{i}_pipe.tsv", separator="\t")
+                query_paths.append(f"sample_{i}_query.tsv")
+                pipe_paths.append(f"sample_{i}_pipe.tsv")
+
+            expected_binned = pl.DataFrame([
+                ["S3.1", f"sample_{i}", "AAA", 5, 10, "Root", "genome_1"] for i in range(1, 6)
+            ], orient="row", schema=APPRAISE_COLUMNS)
+            expected_unbinned = pl.DataFrame([
+                ["S3.1", f"sample_{i}", "AAB", 5, 10, "Root", None] for i in range(1, 6)
+            ], orient="row", schema=APPRAISE_COLUMNS)
+
+            outputs = list(pipeline(query_paths, pipe_paths, threads=2))
+            observed_binned = pl.concat([o[0][0] for o in outputs])
+            observed_unbinned = pl.concat([o[0][1] for o in outputs])
+            self.assertDataFrameEqual(expected_binned, observed_binned)
+            self.assertDataFrameEqual(expected_unbinned, observed_unbinned)
+
+
+    def test_query_processing_scan_pipeline(self):
+        with in_tempdir():
+            pl.DataFrame([
+                ["sample_1", "AAA", 1, 5, 10, "genome_1", "S3.1", "AAA", "Root"],
+                ["sample_1", "AAA", 1, 5, 10, "genome_2", "S3.1", "AAA", "Root"],
+                ["sample_1", "AAB", 10, 5, 10, "genome_1", "S3.1", "AAA", "Root"],
+                ["sample_1", "BBB", 1, 5, 10, "genome_1", "S3.2", "BBB", "Root"],
+            ], orient="row", schema=QUERY_COLUMNS).write_csv("sample_1_query.tsv", separator="\t")
+            pl.DataFrame([
+                ["S3.1", "sample_1", "AAA", 5, 10, "Root"],
+                ["S3.1", "sample_1", "AAB", 5, 10, "Root"],
+                ["S3.1", "sample_1", "AAC", 5, 10, "Root"],
+            ], orient="row", schema=PIPE_COLUMNS).write_csv("sample_1_pipe.tsv", separator="\t")
+            pl.DataFrame([
+                ["sample_2", "AAA", 1, 5, 10, "genome_3", "S3.1", "AAA", "Root"],
+                ["sample_2", "AAA", 9, 5, 10, "genome_4", "S3.1", "AAA", "Root"],
+            ], orient="row", schema=QUERY_COLUMNS).write_csv("sample_2_query.tsv", separator="\t")
+            pl.DataFrame([
+                ["S3.1", "sample_2", "AAA", 3, 6, "Root"],
+            ], orient="row", schema=PIPE_COLUMNS).write_csv("sample_2_pipe.tsv", separator="\t")
+
+            expected_binned = pl.DataFrame([
+                ["S3.1", "sample_1", "AAA", 5, 10, "Root", "genome_1,genome_2"],
+                ["S3.1", "sample_2", "AAA", 3, 6, "Root", "genome_3"],
+            ], orient="row", schema=APPRAISE_COLUMNS)
+            expected_unbinned = pl.DataFrame([
+                ["S3.1", "sample_1", "AAB", 5, 10, "Root", None],
+                ["S3.1", "sample_1", "AAC", 5, 10, "Root", None],
+                ["S3.1", "sample_2", "AAA", 3, 6, "Root", None],
+            ], orient="row", schema=APPRAISE_COLUMNS)
+
+            query_paths = ["sample_1_query.tsv", "sample_2_query.tsv"]
+            pipe_paths = ["sample_1_pipe.tsv", "sample_2_pipe.tsv"]
+            [(observed_binned, observed_unbinned)] = scan_pipeline(query_paths, pipe_paths)
+            self.assertDataFrameEqual(expected_binned, observed_binned.sort("sample", "sequence"))
+            self.assertDataFrameEqual(expected_unbinned, observed_unbinned.sort("sample", "sequence"))
+
+            outputs = list(pipeline(query_paths, pipe_paths))
+            self.assertDataFrameEqual(observed_binned.sort("sample", "sequence"), pl.concat([o[0][0] for o in outputs]).sort("sample", "sequence"))
+            self.assertDataFrameEqual(observed_unbinned.sort("sample", "sequence"), pl.concat([o[0][1] for o in outputs]).sort("sample", "sequence"))
+
+    def test_query_processing_scan_pipeline_empty_query(self):
+        with in_tempdir():
+            pl.DataFrame([
+                ["sample_1", "AAA", 1, 5, 10, "genome_1", "S3.1", "AAA", "Root"],
+            ], orient="row", schema=QUERY_COLUMNS).write_csv("sample_1_query.tsv", separator="\t")
+            pl.DataFrame([
+                ["S3.1", "sample_1", "AAA", 5, 10, "Root"],
+                ["S3.1", "sample_1", "AAB", 5, 10, "Root"],
+            ], orient="row", schema=PIPE_COLUMNS).write_csv("sample_1_pipe.tsv", separator="\t")
+            pl.DataFrame(schema=QUERY_COLUMNS).write_csv("sample_2_query.tsv", separator="\t")
+            pl.DataFrame([
+                ["S3.1", "sample_2", "AAA", 3, 6, "Root"],
+            ], orient="row", schema=PIPE_COLUMNS).write_csv("sample_2_pipe.tsv", separator="\t")
+
+            query_paths = ["sample_1_query.tsv", "sample_2_query.tsv"]
+            pipe_paths = ["sample_1_pipe.tsv", "sample_2_pipe.tsv"]
+            [(observed_binned, observed_unbinned)] = scan_pipeline(query_paths, pipe_paths)
+            outputs = list(pipeline(query_paths, pipe_paths))
+            self.assertDataFrameEqual(pl.concat([o[0][0] for o in outputs]).sort("sample", "sequence"), observed_binned.sort("sample", "sequence"))
+            self.assertDataFrameEqual(pl.concat([o[0][1] for o in outputs]).sort("sample", "sequence"), observed_unbinned.sort("sample", "sequence"))
+            self.assertEqual(["sample_1"], observed_unbinned.get_column("sample").to_list())
+
+            [(observed_binned, observed_unbinned)] = scan_pipeline(["sample_2_query.tsv"], ["sample_2_pipe.tsv"])
+            self.assertEqual(list(APPRAISE_COLUMNS), observed_binned.columns)
+            self.assertEqual(0, observed_binned.height)
+            self.assertEqual(0, observed_unbinned.height)
+
+    def test_query_processing_resumable_pipeline(self):
+        with in_tempdir():
+            query_paths = []
+            pipe_paths = []
+            for i in range(1, 6):
+                pl.DataFrame([
+                    [f"sample_{i}", "AAA", 1, 5, 10, "genome_1", "S3.1", "AAA", "Root"],
+                ], orient="row", schema=QUERY_COLUMNS).write_csv(f"sample_{i}_query.tsv", separator="\t")
+                pl.DataFrame([
+                    ["S3.1", f"sample_{i}", "AAA", 5, 10, "Root"],
+                    ["S3.1", f"sample_{i}", "AAB", 5, 10, "Root"],
+                ], orient="row", schema=PIPE_COLUMNS).write_csv(f"sample_{i}_pipe.tsv", separator="\t")
+                query_paths.append(f"sample_{i}_query.tsv")
+                pipe_paths.append(f"sample_{i}_pipe.tsv")
+
+            expected_binned = pl.DataFrame([
+                ["S3.1", f"sample_{i}", "AAA", 5, 10, "Root", "genome_1"] for i in range(1, 6)
+            ], orient="row", schema=APPRAISE_COLUMNS)
+            expected_unbinned = pl.DataFrame([
+                ["S3.1", f"sample_{i}", "AAB", 5, 10, "Root", None] for i in range(1, 6)
+            ], orient="row", schema=APPRAISE_COLUMNS)
+
+            # Simulate an interrupted run with the first batch finished, using a marker to check it is reused
+            os.makedirs("partial")
+            digest = batch_digest(query_paths[:2], pipe_paths[:2])
+            pl.DataFrame([
+                ["S3.1", "marker", "AAA", 5, 10, "Root", "genome_1"],
+            ], orient="row", schema=APPRAISE_COLUMNS).write_csv(os.path.join("partial", f"{digest}_0_binned.tsv"), separator="\t")
+            pl.DataFrame(schema=APPRAISE_COLUMNS).write_csv(os.path.join("partial", f"{digest}_0_unbinned.tsv"), separator="\t")
+            with open(os.path.join("partial", "manifest.txt"), "w") as f:
+                f.write(digest + "\n")
+                f.write("unfinished\n")
+
+            resumable_pipeline(query_paths, pipe_paths, [("binned.tsv", "unbinned.tsv")], "partial", BATCH_SIZE=2, threads=2)
+
+            observed_binned = pl.read_csv("binned.tsv", separator="\t")
+            observed_unbinned = pl.read_csv("unbinned.tsv", separator="\t")
+            expected_resumed_binned = pl.concat([
+                pl.DataFrame([["S3.1", "marker", "AAA", 5, 10, "Root", "genome_1"]], orient="row", schema=APPRAISE_COLUMNS),
+                expected_binned.slice(2),
+                ])
+            self.assertDataFrameEqual(expected_resumed_binned, observed_binned)
+            self.assertDataFrameEqual(expected_unbinned.slice(2), observed_unbinned)
+            self.assertFalse(os.path.exists("partial"))
+
+            # Fresh run produces every sample exactly once
+            resumable_pipeline(query_paths, pipe_paths, [("binned.tsv", "unbinned.tsv")], "partial", BATCH_SIZE=2, threads=2)
+            self.assertDataFrameEqual(expected_binned, pl.read_csv("binned.tsv", separator="\t"))
+            self.assertDataFrameEqual(expected_unbinned, pl.read_csv("unbinned.tsv", separator="\t", schema_overrides=APPRAISE_COLUMNS))
+
+    def test_query_processing_batch_digest(self):
+        with in_tempdir():
+            pl.DataFrame(schema=QUERY_COLUMNS).write_csv("sample_1_query.tsv", separator="\t")
+            pl.DataFrame(schema=PIPE_COLUMNS).write_csv("sample_1_pipe.tsv", separator="\t")
+            digest = batch_digest(["sample_1_query.tsv"], ["sample_1_pipe.tsv"])
+
+            self.assertEqual(digest, batch_digest(["sample_1_query.tsv"], ["sample_1_pipe.tsv"]))
+            self.assertNotEqual(digest, batch_digest(["sample_1_query.tsv"], ["sample_1_pipe.tsv"], SEQUENCE_IDENTITIES=[0.89]))
+
+            # Inputs rewritten by a rerun upstream invalidate finished batches
+            os.utime("sample_1_pipe.tsv", ns=(0, 0))
+            self.assertNotEqual(digest, batch_digest(["sample_1_query.tsv"], ["sample_1_pipe.tsv"]))
+
+    def test_query_processing_resumable_pipeline_failure(self):
+        with in_tempdir():
+            pl.DataFrame([
+                ["sample_1", "AAA", 1, 5, 10, "genome_1", "S3.1", "AAA", "Root"],
+            ], orient="row", schema=QUERY_COLUMNS).write_csv("sample_1_query.tsv", separator="\t")
+            with open("sample_1_pipe.tsv", "w") as f:
+                f.write("not an otu table\n")
+
+            with self.assertRaises(Exception):
+                resumable_pipeline(["sample_1_query.tsv"], ["sample_1_pipe.tsv"], [("binned.tsv", "unbinned.tsv")], "partial")
+            self.assertEqual(["manifest.txt"], os.listdir("partial"))
+
+            with self.assertRaises(ValueError):
+                resumable_pipeline(
+                    ["sample_1_query.tsv"], ["sample_1_pipe.tsv"],
+                    [("binned.tsv", "unbinned.tsv"), ("binned_89.tsv", "unbinned_89.tsv"), ("binned_89.tsv", "unbinned_89.tsv")],
+                    "partial", SEQUENCE_IDENTITIES=[0.86, 0.89, 0.89],
+                    )
+
+    def test_query_processing_thresholds(self):
+        query = pl.DataFrame([
+            ["sample_1", "AAA", 1, 5, 10, "genome_1", "S3.1", "AAA", "Root"],
+            ["sample_1", "AAB", 4, 5, 10, "genome_1", "S3.1", "AAA", "Root"],
+            ["sample_1", "AAC", 8, 5, 10, "genome_2", "S3.1", "AAA", "Root"],
+        ], orient="row", schema=QUERY_COLUMNS)
+        pipe = pl.DataFrame([
+            ["S3.1", "sample_1", "AAA", 5, 10, "Root"],
+            ["S3.1", "sample_1", "AAB", 5, 10, "Root"],
+            ["S3.1", "sample_1", "AAC", 5, 10, "Root"],
+            ["S3.1", "sample_1", "AAD", 5, 10, "Root"],
+        ], orient="row", schema=PIPE_COLUMNS)
+
+        identities = [0.86, 0.89, 0.96]
+        observed = processing_thresholds(query, pipe, identities)
+        self.assertEqual(len(identities), len(observed))
+        for identity, (observed_binned, observed_unbinned) in zip(identities, observed):
+            expected_binned, expected_unbinned = processing(query, pipe, SEQUENCE_IDENTITY=identity)
+            self.assertDataFrameEqual(expected_binned.sort("sequence"), observed_binned.sort("sequence"))
+            self.assertDataFrameEqual(expected_unbinned.sort("sequence"), observed_unbinned.sort("sequence"))
+
+        self.assertEqual(["AAA", "AAB", "AAC"], observed[0][0].sort("sequence").get_column("sequence").to_list())
+        self.assertEqual(["AAA", "AAB"], observed[1][0].sort("sequence").get_column("sequence").to_list())
+        self.assertEqual(["AAA"], observed[2][0].sort("sequence").get_column("sequence").to_list())
+
+    def test_query_processing_scan_pipeline_thresholds(self):
+        with in_tempdir():
+            pl.DataFrame([
+                ["sample_1", "AAA", 1, 5, 10, "genome_1", "S3.1", "AAA", "Root"],
+                ["sample_1", "AAB", 4, 5, 10, "genome_1", "S3.1", "AAA", "Root"],
+                ["sample_1", "AAB", 8, 5, 10, "genome_2", "S3.1", "AAA", "Root"],
+            ], orient="row", schema=QUERY_COLUMNS).write_csv("sample_1_query.tsv", separator="\t")
+            pl.DataFrame([
+                ["S3.1", "sample_1", "AAA", 5, 10, "Root"],
+                ["S3.1", "sample_1", "AAB", 5, 10, "Root"],
+                ["S3.1", "sample_1", "AAC", 5, 10, "Root"],
+            ], orient="row", schema=PIPE_COLUMNS).write_csv("sample_1_pipe.tsv", separator="\t")
+
+            identities = [0.86, 0.96]
+            observed = scan_pipeline(["sample_1_query.tsv"], ["sample_1_pipe.tsv"], SEQUENCE_IDENTITIES=identities)
+            [expected] = list(pipeline(["sample_1_query.tsv"], ["sample_1_pipe.tsv"], SEQUENCE_IDENTITIES=identities))
+            for (expected_binned, expected_unbinned), (observed_binned, observed_unbinned) in zip(expected, observed):
+                self.assertDataFrameEqual(expected_binned.sort("sequence", "found_in"), observed_binned.sort("sequence", "found_in"))
+                self.assertDataFrameEqual(expected_unbinned.sort("sequence"), observed_unbinned.sort("sequence"))
 
 if __name__ == '__main__':
     unittest.main()
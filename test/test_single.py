@@ -294,7 +294,7 @@ class Tests(unittest.TestCase):
             config_path = os.path.join("test", "config.yaml")
             self.assertTrue(os.path.exists(config_path))
 
-            sketch_path = os.path.join("test", "coassemble", "sketch", "samples.sig")
+            sketch_path = os.path.join("test", "coassemble", "sketch", "samples.sig.zip")
             self.assertFalse(os.path.exists(sketch_path))
 
             distances_path = os.path.join("test", "coassemble", "sketch", "samples.csv")
@@ -4,7 +4,7 @@ import unittest
 import os
 os.environ["POLARS_MAX_THREADS"] = "1"
 import polars as pl
-from binchicken.workflow.scripts.sketch_samples import processing
+from binchicken.workflow.scripts.sketch_samples import processing, sample_digest
 from sourmash import load_file_as_signatures
 from bird_tool_utils import in_tempdir
 
@@ -43,7 +43,7 @@ class Tests(unittest.TestCase):
                 "sample_4",
             ]
 
-            signatures_path = processing(unbinned, output_path="./signatures.sig", threads=1)
+            signatures_path = processing(unbinned, output_path="./signatures.sig.zip", threads=1)
             signatures = [s for s in load_file_as_signatures(signatures_path)]
             observed_names = [s.name for s in signatures]
             self.assertEqual(sorted(expected_names), sorted(observed_names))
@@ -60,6 +60,72 @@ class Tests(unittest.TestCase):
             self.assertEqual(sample_2_sig.jaccard(sample_4_sig), 0.25)
             self.assertEqual(sample_3_sig.jaccard(sample_4_sig), 0.5)
 
+    def test_sketch_samples_threads(self):
+        with in_tempdir():
+            unbinned = pl.DataFrame([
+                ["S3.1", f"sample_{i}", "ATGACTAGTCATAGCTAGATTTGAGGCAGCAGGAGTTAGGAAAGCCCCCGGAGTTAGCTA", 5, 10, "Root"]
+                for i in range(10)
+            ], orient="row", schema=OTU_TABLE_COLUMNS)
+
+            expected_names = [f"sample_{i}" for i in range(10)]
+
+            signatures_path = processing(unbinned, output_path="./signatures.sig.zip", threads=3)
+            signatures = [s for s in load_file_as_signatures(signatures_path)]
+            observed_names = [s.name for s in signatures]
+            self.assertEqual(sorted(expected_names), sorted(observed_names))
+            self.assertEqual(["signatures.sig.zip"], os.listdir("."))
+
+    def test_sketch_samples_cache(self):
+        with in_tempdir():
+            seq_1 = "ATGACTAGTCATAGCTAGATTTGAGGCAGCAGGAGTTAGGAAAGCCCCCGGAGTTAGCTA"
+            seq_2 = "TGACTAGCTGGGCTAGCTATATTCTTTTTACGAGCGCGAGGAAAGCGACAGCGGCCAGGC"
+            seq_3 = "ATCGACTGACTTGATCGATCTTTGACGACGAGAGAGAGAGCGACGCGCCGAGAGGTTTCA"
+
+            os.makedirs("cache")
+            cached = pl.DataFrame([
+                ["S3.1", "sample_1", seq_3, 5, 10, "Root"],
+                ["S3.1", "sample_2", seq_3, 5, 10, "Root"],
+            ], orient="row", schema=OTU_TABLE_COLUMNS)
+            processing(cached, output_path=os.path.join("cache", "samples.sig.zip"), threads=1)
+            # sample_1 is recorded with the digest of its new window set, so its cached sketch is reused
+            with open(os.path.join("cache", "samples_digests.tsv"), "w") as f:
+                f.write("sample\tdigest\n")
+                f.write(f"sample_1\t{sample_digest([seq_2, seq_1])}\n")
+                f.write(f"sample_2\t{sample_digest([seq_3])}\n")
+
+            unbinned = pl.DataFrame([
+                ["S3.1", "sample_1", seq_1, 5, 10, "Root"],
+                ["S3.1", "sample_1", seq_2, 5, 10, "Root"],
+                ["S3.1", "sample_2", seq_1, 5, 10, "Root"],
+                ["S3.1", "sample_3", seq_3, 5, 10, "Root"],
+            ], orient="row", schema=OTU_TABLE_COLUMNS)
+
+            signatures_path = processing(
+                unbinned,
+                output_path="./signatures.sig.zip",
+                digests_path="./digests.tsv",
+                cache_dir="cache",
+                threads=1,
+                )
+            signatures = {s.name: s for s in load_file_as_signatures(signatures_path)}
+            self.assertEqual(["sample_1", "sample_2", "sample_3"], sorted(signatures))
+
+            self.assertEqual(signatures["sample_1"].jaccard(signatures["sample_3"]), 1.0)
+            self.assertEqual(signatures["sample_2"].jaccard(signatures["sample_3"]), 0.0)
+
+            expected_digests = pl.DataFrame([
+                ["sample_1", sample_digest([seq_1, seq_2])],
+                ["sample_2", sample_digest([seq_1])],
+                ["sample_3", sample_digest([seq_3])],
+            ], orient="row", schema=["sample", "digest"])
+            observed_digests = pl.read_csv("digests.tsv", separator="\t").sort("sample")
+            self.assertEqual(expected_digests.rows(), observed_digests.rows())
+
+    def test_sample_digest(self):
+        self.assertEqual(sample_digest(["AAA", "CCC"]), sample_digest(["CCC", "AAA", "AAA"]))
+        self.assertNotEqual(sample_digest(["AAA", "CCC"]), sample_digest(["AAA"]))
+        self.assertNotEqual(sample_digest(["AAA"]), sample_digest(["AAA"], TAXA_OF_INTEREST="p__Bacillota"))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+os.environ["POLARS_MAX_THREADS"] = "1"
+import polars as pl
+from polars.testing import assert_frame_equal
+from bird_tool_utils import in_tempdir
+from binchicken.workflow.scripts.split_otu_table import singlem_sample_name, batch_inputs, pipeline
+
+OTU_TABLE_COLUMNS = ["gene", "sample", "sequence", "num_hits", "coverage", "taxonomy"]
+
+class Tests(unittest.TestCase):
+    def assertDataFrameEqual(self, a, b):
+        assert_frame_equal(a, b, check_dtypes=False)
+
+    def test_singlem_sample_name(self):
+        self.assertEqual("sample_1.1", singlem_sample_name("/path/to/sample_1.1.fq"))
+        self.assertEqual("sample_1.1", singlem_sample_name("/path/to/sample_1.1.fq.gz"))
+        self.assertEqual("SRR8334323_1", singlem_sample_name("sra/SRR8334323_1.fastq.gz"))
+        self.assertEqual("genome_1_protein", singlem_sample_name("transcripts/genome_1_protein.fna"))
+
+    def test_batch_inputs(self):
+        observed = batch_inputs(["sample_3", "sample_1", "sample_2"], 2)
+        self.assertEqual({"0": ["sample_1", "sample_2"], "1": ["sample_3"]}, observed)
+
+        observed = batch_inputs(["sample_3", "sample_1", "sample_2"], 1)
+        self.assertEqual({"0": ["sample_1"], "1": ["sample_2"], "2": ["sample_3"]}, observed)
+
+        self.assertEqual({}, batch_inputs([], 2))
+
+    def test_split_otu_table(self):
+        otu_table = pl.DataFrame([
+            ["S3.1", "sample_1.1", "AAA", "5", "10.00", "Root"],
+            ["S3.1", "sample_2.1", "AAA", "3", "6.50", "Root"],
+            ["S3.2", "sample_1.1", "TTT", "2", "4.10", "Root; d__Bacteria"],
+        ], orient="row", schema=OTU_TABLE_COLUMNS)
+
+        with in_tempdir():
+            otu_table.write_csv("batch.otu_table.tsv", separator="\t")
+
+            observed, observed_2 = pipeline("batch.otu_table.tsv", ["sample_1.1", "sample_2.1"])
+            expected = pl.DataFrame([
+                ["S3.1", "sample_1.1", "AAA", "5", "10.00", "Root"],
+                ["S3.2", "sample_1.1", "TTT", "2", "4.10", "Root; d__Bacteria"],
+            ], orient="row", schema=OTU_TABLE_COLUMNS)
+            self.assertDataFrameEqual(expected, observed)
+            expected_2 = pl.DataFrame([
+                ["S3.1", "sample_2.1", "AAA", "3", "6.50", "Root"],
+            ], orient="row", schema=OTU_TABLE_COLUMNS)
+            self.assertDataFrameEqual(expected_2, observed_2)
+
+            # Values are kept as text, so split tables match unbatched SingleM output
+            observed.write_csv("sample_1.otu_table.tsv", separator="\t")
+            with open("sample_1.otu_table.tsv") as f:
+                self.assertTrue("\t10.00\t" in f.read())
+
+    def test_split_otu_table_no_hits(self):
+        otu_table = pl.DataFrame([
+            ["S3.1", "sample_2.1", "AAA", "3", "6.50", "Root"],
+        ], orient="row", schema=OTU_TABLE_COLUMNS)
+
+        with in_tempdir():
+            otu_table.write_csv("batch.otu_table.tsv", separator="\t")
+
+            observed, _ = pipeline("batch.otu_table.tsv", ["sample_1.1", "sample_2.1"])
+            self.assertEqual(OTU_TABLE_COLUMNS, observed.columns)
+            self.assertEqual(0, observed.height)
+
+    def test_split_otu_table_unexpected_sample(self):
+        otu_table = pl.DataFrame([
+            ["S3.1", "sample_3.1", "AAA", "3", "6.50", "Root"],
+        ], orient="row", schema=OTU_TABLE_COLUMNS)
+
+        with in_tempdir():
+            otu_table.write_csv("batch.otu_table.tsv", separator="\t")
+
+            with self.assertRaises(ValueError):
+                pipeline("batch.otu_table.tsv", ["sample_1.1", "sample_2.1"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -319,16 +319,49 @@ class Tests(unittest.TestCase):
             self.assertTrue("singlem_appraise" not in output)
             self.assertTrue("query_processing" not in output)
             self.assertTrue("single_assembly" not in output)
-            self.assertTrue("count_bp_reads" in output)
+            self.assertTrue("count_bp_reads" not in output)
+            self.assertTrue("harvest_read_size" in output)
             self.assertTrue("target_elusive" not in output)
             self.assertTrue("cluster_graph" not in output)
             self.assertTrue("qc_reads" in output)
-            self.assertTrue("collect_genomes" in output)
+            self.assertTrue("collect_reference_bins" in output)
             self.assertTrue("map_reads" in output)
             self.assertTrue("finish_mapping" in output)
             self.assertTrue("aviary_commands" in output)
             self.assertTrue("summary" in output)
 
+    def test_update_unmapping_streaming(self):
+        with in_tempdir():
+            cmd = (
+                f"binchicken update "
+                f"--assemble-unmapped "
+                f"--unmapping-streaming "
+                f"--forward {SAMPLE_READS_FORWARD} "
+                f"--reverse {SAMPLE_READS_REVERSE} "
+                f"--genomes {GENOMES} "
+                f"--coassemble-unbinned {MOCK_UNBINNED} "
+                f"--coassemble-binned {MOCK_BINNED} "
+                f"--coassemble-targets {MOCK_TARGETS} "
+                f"--coassemble-elusive-edges {MOCK_ELUSIVE_EDGES} "
+                f"--coassemble-elusive-clusters {MOCK_ELUSIVE_CLUSTERS} "
+                f"--output test "
+                f"--conda-prefix {path_to_conda} "
+                f"--dryrun "
+                f"--snakemake-args \" --quiet\" "
+            )
+            output = extern.run(cmd)
+
+            self.assertTrue("map_reads_streaming" in output)
+            self.assertTrue("filter_bam_files" not in output)
+            self.assertTrue("bam_to_fastq" not in output)
+            self.assertTrue("harvest_read_size" in output)
+            self.assertTrue("finish_mapping" in output)
+            self.assertTrue("aviary_commands" in output)
+
+            config_path = os.path.join("test", "config.yaml")
+            config = load_configfile(config_path)
+            self.assertTrue(config["unmapping_streaming"])
+
     def test_update_read_identity(self):
         with in_tempdir():
             cmd = (
@@ -392,11 +425,12 @@ class Tests(unittest.TestCase):
             self.assertTrue("singlem_appraise" not in output)
             self.assertTrue("query_processing" not in output)
             self.assertTrue("single_assembly" not in output)
-            self.assertTrue("count_bp_reads" in output)
+            self.assertTrue("count_bp_reads" not in output)
+            self.assertTrue("harvest_read_size" in output)
             self.assertTrue("target_elusive" not in output)
             self.assertTrue("cluster_graph" not in output)
             self.assertTrue("qc_reads" in output)
-            self.assertTrue("collect_genomes" in output)
+            self.assertTrue("collect_reference_bins" in output)
             self.assertTrue("map_reads" in output)
             self.assertTrue("finish_mapping" in output)
             self.assertTrue("aviary_commands" in output)
@@ -480,7 +514,7 @@ class Tests(unittest.TestCase):
             expected = "\n".join(
                 [
                     "\t".join(["sra", "reason"]),
-                    "\t".join(["SRR3309137_mismatched", "Consecutive reads do not match (1/10)"]),
+                    "\t".join(["SRR3309137_mismatched", "Consecutive reads do not match (read pair 1)"]),
                     ""
                 ]
             )
@@ -600,11 +634,12 @@ class Tests(unittest.TestCase):
             self.assertTrue("singlem_appraise" not in output)
             self.assertTrue("query_processing" not in output)
             self.assertTrue("single_assembly" not in output)
-            self.assertTrue("count_bp_reads" in output)
+            self.assertTrue("count_bp_reads" not in output)
+            self.assertTrue("harvest_read_size" in output)
             self.assertTrue("target_elusive" not in output)
             self.assertTrue("cluster_graph" not in output)
             self.assertTrue("qc_reads" in output)
-            self.assertTrue("collect_genomes" in output)
+            self.assertTrue("collect_reference_bins" in output)
             self.assertTrue("map_reads" in output)
             self.assertTrue("finish_mapping" in output)
             self.assertTrue("aviary_commands" not in output)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+os.environ["POLARS_MAX_THREADS"] = "1"
+import polars as pl
+from polars.testing import assert_frame_equal
+from binchicken.workflow.scripts.update_distances import changed_samples, merge_distances
+
+DIGESTS_COLUMNS = {
+    "sample": str,
+    "digest": str,
+    }
+
+DISTANCE_COLUMNS = {
+    "query_name": str,
+    "query_md5": str,
+    "match_name": str,
+    "match_md5": str,
+    "containment": float,
+    "max_containment": float,
+    "jaccard": float,
+    "intersect_hashes": float,
+    }
+
+class Tests(unittest.TestCase):
+    def assertDataFrameEqual(self, a, b):
+        assert_frame_equal(a, b, check_dtypes=False, check_row_order=False)
+
+    def test_changed_samples(self):
+        digests = pl.DataFrame([
+            ["sample_1", "a"],
+            ["sample_2", "b"],
+            ["sample_3", "c"],
+        ], orient="row", schema=DIGESTS_COLUMNS)
+        prior_digests = pl.DataFrame([
+            ["sample_1", "a"],
+            ["sample_2", "x"],
+            ["sample_4", "d"],
+        ], orient="row", schema=DIGESTS_COLUMNS)
+
+        expected = set(["sample_2", "sample_3"])
+        observed = changed_samples(digests, prior_digests)
+        self.assertEqual(expected, observed)
+
+    def test_merge_distances(self):
+        prior_distances = pl.DataFrame([
+            ["sample_1", "md5_1", "sample_2", "md5_2", 0.5, 0.5, 0.5, 1.0],
+            ["sample_1", "md5_1", "sample_3", "md5_3", 0.5, 0.5, 0.5, 1.0],
+            ["sample_2", "md5_2", "sample_3", "md5_3", 0.5, 0.5, 0.5, 1.0],
+            ["sample_1", "md5_1", "sample_4", "md5_4", 0.5, 0.5, 0.5, 1.0],
+        ], orient="row", schema=DISTANCE_COLUMNS)
+        changed_distances = pl.DataFrame([
+            ["sample_2", "new_2", "sample_2", "new_2", 1.0, 1.0, 1.0, 2.0],
+            ["sample_2", "new_2", "sample_1", "md5_1", 0.2, 0.2, 0.2, 1.0],
+            ["sample_2", "new_2", "sample_5", "md5_5", 0.3, 0.3, 0.3, 1.0],
+            ["sample_5", "md5_5", "sample_5", "md5_5", 1.0, 1.0, 1.0, 2.0],
+            ["sample_5", "md5_5", "sample_2", "new_2", 0.3, 0.3, 0.3, 1.0],
+            ["sample_5", "md5_5", "sample_3", "md5_3", 0.4, 0.4, 0.4, 1.0],
+        ], orient="row", schema=DISTANCE_COLUMNS)
+
+        expected = pl.DataFrame([
+            ["sample_1", "md5_1", "sample_3", "md5_3", 0.5, 0.5, 0.5, 1.0],
+            ["sample_2", "new_2", "sample_1", "md5_1", 0.2, 0.2, 0.2, 1.0],
+            ["sample_2", "new_2", "sample_5", "md5_5", 0.3, 0.3, 0.3, 1.0],
+            ["sample_5", "md5_5", "sample_3", "md5_3", 0.4, 0.4, 0.4, 1.0],
+        ], orient="row", schema=DISTANCE_COLUMNS)
+        observed = merge_distances(
+            prior_distances,
+            changed_distances,
+            ["sample_1", "sample_2", "sample_3", "sample_5"],
+            set(["sample_2", "sample_5"]),
+            )
+        self.assertDataFrameEqual(expected, observed)
+
+    def test_merge_distances_no_changes(self):
+        prior_distances = pl.DataFrame([
+            ["sample_1", "md5_1", "sample_2", "md5_2", 0.5, 0.5, 0.5, 1.0],
+        ], orient="row", schema=DISTANCE_COLUMNS)
+
+        observed = merge_distances(
+            prior_distances,
+            prior_distances.clear(),
+            ["sample_1", "sample_2"],
+            set(),
+            )
+        self.assertDataFrameEqual(prior_distances, observed)
+
+
+if __name__ == '__main__':
+    unittest.main()